@@ -0,0 +1,155 @@
+"""Compare tile formats on real slides: bytes per tile, encode time and fidelity.
+
+Samples tiles from every pyramid level of each slide, encodes them with the
+server's encoder (quality profile per level, shared encoder pool) in every
+format this Pillow build supports, and reports the mean size, encode latency
+percentiles and PSNR against the decoded source per format and level. The
+pool scenario encodes the same tiles with several requests in flight.
+
+Usage:
+    python benchmarks/bench_encoding.py --slide-dir /data/slides --output encoding.json
+    python benchmarks/bench_encoding.py --formats jpeg,webp --tiles 100
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BACKEND_DIR)
+
+from bench_server import summarize, git_revision  # noqa: E402
+from make_fixtures import make_fixture  # noqa: E402
+
+
+def sample_tiles(slide, read_tile_image, tiles_per_level, rng, tile_size):
+    """Decoded RGB tiles at random positions of every level, as [(level, image)]."""
+    samples = []
+    for level, (width, height) in enumerate(slide.level_dimensions):
+        for _ in range(tiles_per_level):
+            x = int(rng.integers(0, max(1, width // tile_size)))
+            y = int(rng.integers(0, max(1, height // tile_size)))
+            samples.append((level, read_tile_image(slide, level, x, y)))
+    return samples
+
+
+def psnr(reference, data):
+    """Peak signal-to-noise ratio (dB) of encoded `data` against the `reference` image."""
+    from PIL import Image
+    decoded = np.asarray(Image.open(io.BytesIO(data)).convert('RGB'), dtype=np.float64)
+    mse = np.mean((np.asarray(reference, dtype=np.float64) - decoded) ** 2)
+    return float('inf') if mse == 0 else float(10 * np.log10(255.0 ** 2 / mse))
+
+
+def measure(encoder, samples, tile_format):
+    """Encode every sample sequentially; returns per-level and overall results."""
+    per_level = {}
+    for level, image in samples:
+        t0 = time.perf_counter()
+        data, _ = encoder.encode(image, tile_format, level)
+        elapsed = time.perf_counter() - t0
+        entry = per_level.setdefault(level, {'latencies': [], 'bytes': [], 'psnr': []})
+        entry['latencies'].append(elapsed)
+        entry['bytes'].append(len(data))
+        entry['psnr'].append(psnr(image, data))
+
+    def result(entries):
+        latencies = [t for e in entries for t in e['latencies']]
+        sizes = [b for e in entries for b in e['bytes']]
+        scores = [p for e in entries for p in e['psnr'] if np.isfinite(p)]
+        summary = summarize(latencies, sum(latencies))
+        summary['bytes_per_tile'] = float(np.mean(sizes))
+        summary['psnr_db'] = float(np.mean(scores)) if scores else None  # None: lossless
+        return summary
+
+    results = {'all': result(per_level.values())}
+    for level, entry in sorted(per_level.items()):
+        results[f'level_{level}'] = result([entry])
+        results[f'level_{level}']['quality'] = encoder.quality(tile_format, level)
+    return results
+
+
+def measure_pool(encoder, samples, tile_format, in_flight):
+    """Encode every sample with `in_flight` requests outstanding, as the server does under load."""
+    def timed(sample):
+        t0 = time.perf_counter()
+        encoder.encode(sample[1], tile_format, sample[0])
+        return time.perf_counter() - t0
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=in_flight) as pool:
+        latencies = list(pool.map(timed, samples))
+    result = summarize(latencies, time.perf_counter() - start)
+    result['in_flight'] = in_flight
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--slide-dir', default=os.path.join(BENCH_DIR, 'fixtures'),
+                        help='slides to sample (a synthetic slide is generated if there are none)')
+    parser.add_argument('--formats', help='comma-separated formats (default: all this Pillow build can encode)')
+    parser.add_argument('--tiles', type=int, default=50, help='tiles sampled per level and slide')
+    parser.add_argument('--in-flight', type=int, default=8, help='concurrent encodes in the pool scenario')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write results JSON to this path')
+    args = parser.parse_args(argv)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        import server
+    from scripts.tile_encoder import TILE_FORMATS, format_supported
+
+    os.makedirs(args.slide_dir, exist_ok=True)
+    slide_names = sorted(f for f in os.listdir(args.slide_dir) if server.allowed_file(f))
+    if not slide_names:
+        make_fixture(args.slide_dir, seed=args.seed)
+        slide_names = ['synthetic.tiff']
+    formats = args.formats.split(',') if args.formats else [name for name in TILE_FORMATS if format_supported(name)]
+
+    rng = np.random.default_rng(args.seed)
+    samples = []
+    for name in slide_names:
+        slide = server.open_wsi(os.path.join(args.slide_dir, name))
+        samples.extend(sample_tiles(slide, server.read_tile_image, args.tiles, rng, server.TILE_SIZE))
+    print(f"{len(samples)} tiles from {len(slide_names)} slide(s)\n")
+
+    results = {}
+    print(f"{'format':<8} {'level':<8} {'quality':>7} {'bytes/tile':>11} {'p50':>9} {'p99':>9} {'PSNR':>8}")
+    for tile_format in formats:
+        results[tile_format] = measure(server.tile_encoder, samples, tile_format)
+        for key, result in results[tile_format].items():
+            quality = result.get('quality', '')
+            fidelity = 'lossless' if result['psnr_db'] is None else f"{result['psnr_db']:.1f}dB"
+            print(f"{tile_format:<8} {key:<8} {'' if quality is None else quality:>7} "
+                  f"{result['bytes_per_tile']:11.0f} {result['p50_ms']:7.2f}ms {result['p99_ms']:7.2f}ms {fidelity:>8}")
+        results[tile_format]['pool'] = measure_pool(server.tile_encoder, samples, tile_format, args.in_flight)
+        pool = results[tile_format]['pool']
+        print(f"{tile_format:<8} {'pool':<8} {'':>7} {'':>11} {pool['p50_ms']:7.2f}ms {pool['p99_ms']:7.2f}ms "
+              f"{pool['throughput_per_s']:8.1f}/s ({args.in_flight} in flight)")
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'slides': slide_names,
+            'tiles': len(samples),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
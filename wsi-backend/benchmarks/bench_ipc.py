@@ -0,0 +1,191 @@
+"""Compare the framed IPC channel (ipc_server.py) with the HTTP API (server.py).
+
+Starts both backends as child processes on the same synthetic slide and
+measures round-trip latency of sequential calls and throughput with several
+calls in flight, for JPEG tiles, decoded RGB tiles (shared memory and
+inline) and viewport contours (JSON over HTTP, flat buffers over IPC).
+
+Usage:
+    python benchmarks/bench_ipc.py --output ipc.json
+"""
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BACKEND_DIR)
+
+from bench_server import run_scenario, summarize, git_revision  # noqa: E402
+from make_fixtures import make_fixture  # noqa: E402
+from scripts.ipc import IPCClient  # noqa: E402
+
+
+def start_http_server(port, env):
+    env = dict(env, WSI_BACKEND_PORT=str(port), WSI_BACKEND_DEBUG='0')
+    process = subprocess.Popen([sys.executable, os.path.join(BACKEND_DIR, 'server.py')], env=env, cwd=BACKEND_DIR,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            http_get(port, '/api/health')
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"server.py did not come up on port {port}")
+
+
+def http_get(port, path):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise RuntimeError(f"Unexpected status {response.status} for {path}: {body[:200]!r}")
+        return body
+    finally:
+        connection.close()
+
+
+def ipc_get(client, method, **params):
+    with client.call(method, **params) as reply:
+        # Touch the payload like a consumer would
+        for array in reply.arrays.values():
+            array.sum()
+
+
+def random_tiles(level_dimensions, count, rng, tile_size=254):
+    tiles = []
+    for _ in range(count):
+        level = int(rng.integers(0, len(level_dimensions)))
+        width, height = level_dimensions[level]
+        tiles.append((level, int(rng.integers(0, max(1, width // tile_size))),
+                      int(rng.integers(0, max(1, height // tile_size)))))
+    return tiles
+
+
+def random_viewports(dimensions, count, rng, viewport=1024):
+    return [(int(rng.integers(0, max(1, dimensions[0] - viewport))),
+             int(rng.integers(0, max(1, dimensions[1] - viewport))), viewport) for _ in range(count)]
+
+
+def run_concurrent(name, calls, in_flight):
+    """Run zero-argument callables with `in_flight` of them outstanding at a time."""
+    latencies = []
+
+    def timed(call):
+        t0 = time.perf_counter()
+        call()
+        return time.perf_counter() - t0
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=in_flight) as pool:
+        latencies = list(pool.map(timed, calls))
+    result = summarize(latencies, time.perf_counter() - start)
+    result['in_flight'] = in_flight
+    print(f"{name:<24} n={result['count']:<5} {result['throughput_per_s']:8.1f}/s  "
+          f"p50={result['p50_ms']:7.2f}ms  p99={result['p99_ms']:7.2f}ms  ({in_flight} in flight)")
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixtures', default=os.path.join(BENCH_DIR, 'fixtures'))
+    parser.add_argument('--name', default='synthetic.tiff')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=300, help='calls per scenario')
+    parser.add_argument('--in-flight', type=int, default=8, help='concurrent calls in the throughput scenarios')
+    parser.add_argument('--port', type=int, default=5099, help='port for the HTTP server under test')
+    parser.add_argument('--output', help='write results JSON to this path')
+    args = parser.parse_args(argv)
+
+    slide_path = os.path.join(args.fixtures, args.name)
+    if not os.path.exists(slide_path):
+        make_fixture(args.fixtures, args.name, 8192, 8192, 300, seed=args.seed)
+
+    # Same slide directory for both; no prefetching so both do the same work per call
+    env = dict(os.environ, WSI_SLIDE_DIR=os.path.abspath(args.fixtures), WSI_PREFETCH_DEPTH='0')
+    http_server = start_http_server(args.port, env)
+    ipc_script = os.path.join(BACKEND_DIR, 'ipc_server.py')
+    shm_client = IPCClient.spawn(ipc_script, env=env, stderr=subprocess.DEVNULL)
+    inline_client = IPCClient.spawn(ipc_script, env=env, stderr=subprocess.DEVNULL, shared_memory=False)
+
+    results = {}
+    try:
+        info = shm_client.call('slideInfo', slide=args.name).result
+        level_dimensions = [(level['width'], level['height']) for level in info['levelDimensions']]
+        dimensions = (info['dimensions']['width'], info['dimensions']['height'])
+        rng = np.random.default_rng(args.seed)
+        tiles = random_tiles(level_dimensions, args.requests, rng)
+        viewports = random_viewports(dimensions, max(1, args.requests // 10), rng)
+
+        def http_tile(tile):
+            return lambda: http_get(args.port, f'/api/slides/{args.name}/tile/{tile[0]}/{tile[1]}/{tile[2]}')
+
+        def ipc_tile(client, tile, tile_format='jpeg'):
+            return lambda: ipc_get(client, 'tile', slide=args.name, level=tile[0], x=tile[1], y=tile[2],
+                                   format=tile_format)
+
+        def http_contours(viewport):
+            x, y, size = viewport
+            return lambda: json.loads(http_get(
+                args.port, f'/api/slides/{args.name}/segmentation/contours?x={x}&y={y}&width={size}&height={size}'))
+
+        def ipc_contours(viewport):
+            x, y, size = viewport
+            return lambda: ipc_get(shm_client, 'contours', slide=args.name, x=x, y=y, width=size, height=size)
+
+        # Render every tile once so the JPEG scenarios compare transport, not decoding
+        for tile in tiles:
+            http_tile(tile)()
+            ipc_tile(shm_client, tile)()
+            ipc_tile(inline_client, tile)()
+
+        results['http_tile_jpeg'] = run_scenario('http_tile_jpeg', [http_tile(t) for t in tiles])
+        results['ipc_tile_jpeg'] = run_scenario('ipc_tile_jpeg', [ipc_tile(shm_client, t) for t in tiles])
+        results['ipc_tile_raw_shm'] = run_scenario(
+            'ipc_tile_raw_shm', [ipc_tile(shm_client, t, 'raw') for t in tiles])
+        results['ipc_tile_raw_inline'] = run_scenario(
+            'ipc_tile_raw_inline', [ipc_tile(inline_client, t, 'raw') for t in tiles])
+        results['http_contours'] = run_scenario('http_contours', [http_contours(v) for v in viewports])
+        results['ipc_contours'] = run_scenario('ipc_contours', [ipc_contours(v) for v in viewports])
+
+        results['http_tile_jpeg_concurrent'] = run_concurrent(
+            'http_tile_jpeg_concurrent', [http_tile(t) for t in tiles], args.in_flight)
+        results['ipc_tile_jpeg_concurrent'] = run_concurrent(
+            'ipc_tile_jpeg_concurrent', [ipc_tile(shm_client, t) for t in tiles], args.in_flight)
+        results['ipc_tile_raw_shm_concurrent'] = run_concurrent(
+            'ipc_tile_raw_shm_concurrent', [ipc_tile(shm_client, t, 'raw') for t in tiles], args.in_flight)
+    finally:
+        shm_client.close()
+        inline_client.close()
+        http_server.terminate()
+        http_server.wait()
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'slide': {'name': args.name, 'dimensions': list(dimensions)},
+            'args': vars(args),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
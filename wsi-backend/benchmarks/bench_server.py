@@ -0,0 +1,391 @@
+"""Benchmark the WSI backend against synthetic fixtures.
+
+Drives the Flask test client for the tile, contour (whole and streamed),
+polygon aggregate and export endpoints and calls the underlying functions (`read_region`,
+`PostProcess.object_detector`) directly.
+Reports throughput, latency percentiles and RSS growth per scenario and writes
+the results as JSON so that two runs can be compared.
+
+Usage:
+    python benchmarks/bench_server.py --output results.json
+    python benchmarks/bench_server.py --output new.json --compare results.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BACKEND_DIR)
+
+from make_fixtures import make_fixture  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None if unavailable.
+
+    This is the high-water mark over the whole run, so it is reported once rather than per scenario.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def current_rss_mb():
+    """Current resident set size of this process in MB, or None where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+class RSSSampler:
+    """Sample the RSS in a background thread while a scenario runs.
+
+    `growth_mb` is the highest sample minus the RSS at the start, so each
+    scenario reports the memory it needed on top of what earlier ones left.
+    """
+
+    def __init__(self, interval=0.005) -> None:
+        self.interval = interval
+        self.start = self.peak = None
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self.stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss_mb())
+
+    def __enter__(self):
+        self.start = self.peak = current_rss_mb()
+        if self.start is not None:
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            self.stop.set()
+            self.thread.join()
+            self.peak = max(self.peak, current_rss_mb())
+
+    @property
+    def growth_mb(self):
+        return None if self.start is None else self.peak - self.start
+
+
+def summarize(latencies, elapsed):
+    """Turn a list of per-call latencies (seconds) into a result dict."""
+    ms = np.asarray(latencies) * 1000.0
+    return {
+        'count': len(latencies),
+        'throughput_per_s': len(latencies) / elapsed if elapsed > 0 else None,
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p90_ms': float(np.percentile(ms, 90)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'max_ms': float(ms.max()),
+    }
+
+
+def run_scenario(name, calls, quiet=True):
+    """Time each zero-argument callable in `calls` and summarize.
+
+    A number in `calls` is an untimed pause of that many seconds.
+    """
+    latencies = []
+    paused = 0.0
+    sink = io.StringIO()
+    start = time.perf_counter()
+    with RSSSampler() as rss:
+        for call in calls:
+            if isinstance(call, (int, float)):
+                time.sleep(call)
+                paused += call
+                continue
+            t0 = time.perf_counter()
+            # server.py prints on every request; keep that out of the timings' output
+            with contextlib.redirect_stdout(sink) if quiet else contextlib.nullcontext():
+                call()
+            latencies.append(time.perf_counter() - t0)
+            sink.seek(0)
+            sink.truncate()
+    result = summarize(latencies, time.perf_counter() - start - paused)
+    result['rss_growth_mb'] = rss.growth_mb
+    growth = 'n/a' if rss.growth_mb is None else f"{rss.growth_mb:+.1f}MB"
+    print(f"{name:<24} n={result['count']:<5} {result['throughput_per_s']:8.1f}/s  "
+          f"p50={result['p50_ms']:7.2f}ms  p99={result['p99_ms']:7.2f}ms  rss growth={growth}")
+    return result
+
+
+def _expect_ok(response):
+    if response.status_code != 200:
+        raise RuntimeError(f"Unexpected status {response.status_code}: {response.data[:200]!r}")
+    return response
+
+
+def tile_requests(client, slide_name, level_dimensions, count, rng, tile_size=254):
+    """Random tile requests spread over all pyramid levels."""
+    calls = []
+    for _ in range(count):
+        level = int(rng.integers(0, len(level_dimensions)))
+        width, height = level_dimensions[level]
+        x = int(rng.integers(0, max(1, width // tile_size)))
+        y = int(rng.integers(0, max(1, height // tile_size)))
+        url = f'/api/slides/{slide_name}/tile/{level}/{x}/{y}'
+        calls.append(lambda url=url: _expect_ok(client.get(url)))
+    return calls
+
+
+def contour_requests(client, slide_name, dimensions, count, rng, viewport=1024):
+    """Random contour requests for square level 0 viewports."""
+    calls = []
+    for _ in range(count):
+        x = int(rng.integers(0, max(1, dimensions[0] - viewport)))
+        y = int(rng.integers(0, max(1, dimensions[1] - viewport)))
+        url = f'/api/slides/{slide_name}/segmentation/contours?x={x}&y={y}&width={viewport}&height={viewport}'
+        calls.append(lambda url=url: _expect_ok(client.get(url)))
+    return calls
+
+
+def contour_stream_requests(client, slide_name, dimensions, count, rng, viewport=4096, first_batch_only=False):
+    """Streamed (NDJSON) contour requests for large viewports.
+
+    With `first_batch_only` the client hangs up after the first batch, which
+    measures time to first contours and exercises the disconnect path.
+    """
+    calls = []
+    for _ in range(count):
+        x = int(rng.integers(0, max(1, dimensions[0] - viewport)))
+        y = int(rng.integers(0, max(1, dimensions[1] - viewport)))
+        url = (f'/api/slides/{slide_name}/segmentation/contours'
+               f'?x={x}&y={y}&width={viewport}&height={viewport}&stream=1')
+
+        def stream(url=url):
+            response = _expect_ok(client.get(url, buffered=False))
+            for _ in response.response:
+                if first_batch_only:
+                    break
+            response.close()
+        calls.append(stream)
+    return calls
+
+
+def contour_pan_requests(client, slide_name, dimensions, steps, delta, step=128, viewport=1024):
+    """Contour requests for a viewport panning right by `step` level 0 pixels at a time.
+
+    With `delta` each request names the previous viewport and only gets the
+    instances entering the view; otherwise the whole viewport is requested.
+    """
+    columns = max(1, (dimensions[0] - viewport) // step)
+    calls = []
+    for i in range(steps):
+        x, y = (i % columns) * step, max(0, dimensions[1] // 2 - viewport // 2)
+        if not delta:
+            url = f'/api/slides/{slide_name}/segmentation/contours?x={x}&y={y}&width={viewport}&height={viewport}'
+        elif i % columns == 0:
+            url = f'/api/slides/{slide_name}/segmentation/contours/delta?x={x}&y={y}&width={viewport}&height={viewport}'
+        else:
+            url = (f'/api/slides/{slide_name}/segmentation/contours/delta?x={x}&y={y}&width={viewport}&height={viewport}'
+                   f'&previous={x - step},{y},{viewport},{viewport}')
+        calls.append(lambda url=url: _expect_ok(client.get(url)))
+    return calls
+
+
+def aggregate_requests(client, slide_name, dimensions, count, rng, vertices=200):
+    """Aggregate queries for random star-shaped polygons, from small regions up to the whole slide.
+
+    Every polygon is new, so no answer comes from the aggregate cache.
+    """
+    calls = []
+    for _ in range(count):
+        radius = float(rng.uniform(0.05, 0.75)) * max(dimensions)
+        center = rng.uniform(0, 1, 2) * dimensions
+        angles = np.sort(rng.uniform(0, 2 * np.pi, vertices))
+        radii = radius * rng.uniform(0.6, 1.0, vertices)
+        polygon = np.stack([center[0] + radii * np.cos(angles), center[1] + radii * np.sin(angles)], axis=1)
+        body = {'polygon': polygon.tolist()}
+        calls.append(lambda body=body: _expect_ok(
+            client.post(f'/api/slides/{slide_name}/segmentation/aggregate', json=body)))
+    return calls
+
+
+def run_job(job):
+    """Run a batch job generator to completion outside the scheduler."""
+    for _ in job:
+        pass
+
+
+def pan_requests(client, slide_name, level_dimensions, steps, think_time=0.05, viewport=(4, 3), tile_size=254):
+    """A viewer session panning right across level 0, one column per step.
+
+    Every step requests the whole viewport and then pauses (untimed) for
+    `think_time` seconds, which is when the prefetcher gets to work.
+    """
+    columns = max(1, level_dimensions[0][0] // tile_size - viewport[0])
+    calls = []
+    for step in range(steps):
+        left = step % columns
+        for x in range(left, left + viewport[0]):
+            for y in range(viewport[1]):
+                url = f'/api/slides/{slide_name}/tile/0/{x}/{y}'
+                calls.append(lambda url=url: _expect_ok(client.get(url, headers={'X-Session-ID': 'bench-pan'})))
+        calls.append(think_time)
+    return calls
+
+
+def export_requests(client, slide_name, count, export_format='png', magnification=10):
+    """Whole-slide region exports, consuming the streamed body chunk by chunk."""
+    url = f'/api/slides/{slide_name}/export?format={export_format}&magnification={magnification}&overlay=1'
+
+    def export():
+        response = _expect_ok(client.get(url, buffered=False))
+        for _ in response.response:
+            pass
+        response.close()
+    return [export for _ in range(count)]
+
+
+def read_region_calls(slide, count, rng, tile_size=254):
+    """Direct `read_region` calls at level 0, bypassing Flask."""
+    width, height = slide.dimensions
+    calls = []
+    for _ in range(count):
+        x = int(rng.integers(0, max(1, width - tile_size)))
+        y = int(rng.integers(0, max(1, height - tile_size)))
+        calls.append(lambda x=x, y=y: slide.read_region((x, y), 0, (tile_size, tile_size)))
+    return calls
+
+
+def object_detector_calls(slide, count, rng, tile_size=512):
+    """`PostProcess.object_detector` on pre-read level 0 tiles."""
+    from scripts.tile_post_process import PostProcess
+    width, height = slide.dimensions
+    tiles = []
+    for _ in range(count):
+        x = int(rng.integers(0, max(1, width - tile_size)))
+        y = int(rng.integers(0, max(1, height - tile_size)))
+        tiles.append(slide.read_region((x, y), 0, (tile_size, tile_size)).convert('RGB'))
+    return [lambda img=img: PostProcess(img, 0, None).object_detector() for img in tiles]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(current, baseline_path):
+    """Print the relative change of each metric against a previous results file."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nComparison against {baseline_path} (revision {baseline['meta'].get('revision')}):")
+    for name, result in current['results'].items():
+        previous = baseline['results'].get(name)
+        if previous is None:
+            print(f"{name:<24} (new scenario)")
+            continue
+        changes = []
+        for metric in ('throughput_per_s', 'p50_ms', 'p99_ms', 'rss_growth_mb'):
+            old, new = previous.get(metric), result.get(metric)
+            if old and new is not None:
+                changes.append(f"{metric}={(new - old) / old * 100:+.1f}%")
+        print(f"{name:<24} " + '  '.join(changes))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixtures', default=os.path.join(BENCH_DIR, 'fixtures'),
+                        help='directory holding (or receiving) the synthetic slide')
+    parser.add_argument('--name', default='synthetic.tiff')
+    parser.add_argument('--width', type=int, default=8192)
+    parser.add_argument('--height', type=int, default=8192)
+    parser.add_argument('--density', type=float, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=200, help='calls per scenario')
+    parser.add_argument('--output', help='write results JSON to this path')
+    parser.add_argument('--compare', help='previous results JSON to compare against')
+    args = parser.parse_args(argv)
+
+    slide_path = os.path.join(args.fixtures, args.name)
+    if not os.path.exists(slide_path):
+        make_fixture(args.fixtures, args.name, args.width, args.height, args.density, seed=args.seed)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        import server
+    server.SLIDE_DIR = os.path.abspath(args.fixtures)
+    client = server.app.test_client()
+    slide = server.open_wsi(slide_path)
+    rng = np.random.default_rng(args.seed)
+
+    results = {}
+    results['tile'] = run_scenario(
+        'tile', tile_requests(client, args.name, slide.level_dimensions, args.requests, rng))
+    results['pan'] = run_scenario(
+        'pan', pan_requests(client, args.name, slide.level_dimensions, max(1, args.requests // 10)))
+    results['pan']['prefetch'] = client.get('/api/prefetch/stats').get_json()['prefetch']
+    results['contours'] = run_scenario(
+        'contours', contour_requests(client, args.name, slide.dimensions, max(1, args.requests // 10), rng))
+    results['contours_pan_full'] = run_scenario(
+        'contours_pan_full', contour_pan_requests(client, args.name, slide.dimensions, max(1, args.requests // 10), False))
+    results['contours_pan_delta'] = run_scenario(
+        'contours_pan_delta', contour_pan_requests(client, args.name, slide.dimensions, max(1, args.requests // 10), True))
+    results['contours_stream'] = run_scenario(
+        'contours_stream', contour_stream_requests(client, args.name, slide.dimensions, max(1, args.requests // 50), rng))
+    results['contours_first_batch'] = run_scenario(
+        'contours_first_batch', contour_stream_requests(
+            client, args.name, slide.dimensions, max(1, args.requests // 50), rng, first_batch_only=True))
+    with contextlib.redirect_stdout(io.StringIO()):
+        run_job(server.build_slide_density(args.name))
+    results['aggregate'] = run_scenario(
+        'aggregate', aggregate_requests(client, args.name, slide.dimensions, max(1, args.requests // 2), rng))
+    results['export_png'] = run_scenario(
+        'export_png', export_requests(client, args.name, max(1, args.requests // 50)))
+    results['read_region'] = run_scenario(
+        'read_region', read_region_calls(slide, args.requests, rng))
+    results['object_detector'] = run_scenario(
+        'object_detector', object_detector_calls(slide, max(1, args.requests // 10), rng))
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'slide': {'name': args.name, 'dimensions': list(slide.dimensions), 'levels': len(slide.level_dimensions)},
+            'args': vars(args),
+            'peak_rss_mb': peak_rss_mb(),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        compare(report, args.compare)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
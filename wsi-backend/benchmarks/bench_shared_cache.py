@@ -0,0 +1,138 @@
+"""Compare per-process tile caches with one shared memory cache across workers.
+
+Starts several worker processes that each replay a skewed (Zipf) stream of
+tile requests over the same slides, as a multi-process server does when any
+worker may get any request. On a miss a worker "renders" the tile (a random
+payload of realistic size) and caches it. With `private` caches every worker
+gets an equal share of the memory budget; with `shared` all workers use one
+SharedTileCache of the whole budget. Reports hit rate, get latency and the
+bytes held per mode, and the shared cache's estimate of the memory it saves.
+
+Usage:
+    python benchmarks/bench_shared_cache.py --workers 4 --budget-mb 64 --output shared_cache.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BACKEND_DIR)
+
+from bench_server import summarize, git_revision  # noqa: E402
+from scripts import shared_cache  # noqa: E402
+from scripts.tile_cache import TileCache  # noqa: E402
+
+
+def request_stream(count, tiles, skew, seed, popularity_seed):
+    """Tile indices drawn from a Zipf distribution: a few tiles are requested very often.
+
+    The same `popularity_seed` gives every worker the same popular tiles, as
+    when they serve viewers of the same slides.
+    """
+    ranks = np.random.default_rng(seed).zipf(skew, size=count * 2)
+    ranks = ranks[ranks <= tiles][:count]
+    return np.random.default_rng(popularity_seed).permutation(tiles)[ranks - 1]
+
+
+def run_worker(mode, name, budget_bytes, workers, requests, tiles, skew, tile_bytes, seed, popularity_seed,
+               barrier, results):
+    if mode == 'shared':
+        cache = shared_cache.SharedTileCache(name, max_bytes=budget_bytes)
+    else:
+        cache = TileCache(max_bytes=budget_bytes // workers)
+    rng = np.random.default_rng(seed)
+    payload = rng.integers(0, 256, size=tile_bytes * 2, dtype=np.uint8).tobytes()
+    get_latencies = []
+    hits = 0
+    start = time.perf_counter()
+    for tile in request_stream(requests, tiles, skew, seed, popularity_seed):
+        key = ('bench.svs', 0, int(tile) % 1000, int(tile) // 1000, 'jpeg')
+        t0 = time.perf_counter()
+        cached = cache.get(key)
+        get_latencies.append(time.perf_counter() - t0)
+        if cached is not None:
+            hits += 1
+        else:
+            # Encoded tiles vary in size; take a slice of the payload
+            size = tile_bytes // 2 + int(tile) * 7919 % tile_bytes
+            cache.put(key, payload[:size], 'image/jpeg')
+    elapsed = time.perf_counter() - start
+    # Take the shared stats while every worker (and its reader bit) is still alive
+    barrier.wait()
+    stats = cache.stats()
+    results.put({'hits': hits, 'requests': len(get_latencies), 'latencies': get_latencies, 'elapsed': elapsed,
+                 'bytes': stats['bytes'], 'stats': stats if mode == 'shared' else None})
+    barrier.wait()
+
+
+def run_mode(mode, args):
+    name = f'wsi-bench-{os.getpid()}'
+    shared_cache.remove(name)
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    barrier = context.Barrier(args.workers)
+    processes = [
+        context.Process(target=run_worker, args=(mode, name, args.budget_mb * 1024 * 1024, args.workers,
+                                                 args.requests, args.tiles, args.skew, args.tile_kb * 1024,
+                                                 args.seed + 1 + i, args.seed, barrier, results))
+        for i in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    worker_results = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    shared_cache.remove(name)
+
+    latencies = [t for result in worker_results for t in result['latencies']]
+    hits = sum(result['hits'] for result in worker_results)
+    requests = sum(result['requests'] for result in worker_results)
+    summary = summarize(latencies, max(result['elapsed'] for result in worker_results))
+    summary['hit_rate'] = hits / requests
+    if mode == 'shared':
+        stats = worker_results[-1]['stats']
+        summary['cache_bytes'] = stats['bytes']
+        summary['per_process_bytes'] = stats['perProcessBytes']
+        summary['saved_bytes'] = stats['savedBytes']
+        summary['evictions'] = stats['evictions']
+        summary['reinserted'] = stats['reinserted']
+    else:
+        summary['cache_bytes'] = sum(result['bytes'] for result in worker_results)
+    print(f"{mode:<8} hit rate {summary['hit_rate']:6.1%}  get p50={summary['p50_ms'] * 1000:6.1f}us "
+          f"p99={summary['p99_ms'] * 1000:6.1f}us  held {summary['cache_bytes'] / 2 ** 20:7.1f}MB"
+          + (f"  saved ~{summary['saved_bytes'] / 2 ** 20:.1f}MB" if mode == 'shared' else ''))
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--budget-mb', type=int, default=64, help='total cache memory for all workers')
+    parser.add_argument('--requests', type=int, default=20000, help='tile requests per worker')
+    parser.add_argument('--tiles', type=int, default=20000, help='distinct tiles')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of the request stream')
+    parser.add_argument('--tile-kb', type=int, default=20, help='typical encoded tile size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write results JSON to this path')
+    args = parser.parse_args(argv)
+
+    results = {mode: run_mode(mode, args) for mode in ('private', 'shared')}
+    report = {
+        'meta': {'revision': git_revision(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'args': vars(args)},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
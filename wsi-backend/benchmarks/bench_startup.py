@@ -0,0 +1,166 @@
+"""Measure backend cold start and fail if it exceeds a budget.
+
+Imports server.py in fresh interpreters with `-X importtime` and reports the
+cost of each module it pulls in, checks that the heavy libraries that are
+meant to load on first use (slide reader, h5py, OpenCV, PIL, scikit-image,
+SciPy) are not imported eagerly, and times how long a spawned server.py takes
+to answer /api/health (liveness) and /api/ready (readiness).
+
+Exits with status 1 if a budget is exceeded or a heavy library is imported
+eagerly, so it can run in CI.
+
+Usage:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --import-budget-ms 400 --output startup.json
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BACKEND_DIR)
+
+from bench_server import git_revision  # noqa: E402
+
+# Imported on first use; none of these may be loaded by `import server`
+LAZY_MODULES = ['openslide', 'tiffslide', 'h5py', 'cv2', 'PIL.Image', 'skimage', 'scipy', 'tifffile']
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+MARKER = 'LOADED_MODULES='
+
+
+def profile_import(module, env):
+    """Import `module` in a fresh interpreter; returns ({name: (self_us, cumulative_us, depth)}, eager lazy modules)."""
+    code = (f"import {module}, sys, json; "
+            f"print({MARKER!r} + json.dumps([m for m in {LAZY_MODULES!r} if m in sys.modules]))")
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=BACKEND_DIR, env=env,
+                            capture_output=True, text=True, check=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules[name] = (int(self_us), int(cumulative_us), len(indent) // 2)
+    eager = []
+    for line in result.stdout.splitlines():
+        if line.startswith(MARKER):
+            eager = json.loads(line[len(MARKER):])
+    return modules, eager
+
+
+def wait_for(url, deadline):
+    """Poll `url` until it answers 200; returns False if `deadline` passes first."""
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return True
+        except (urllib.error.URLError, ConnectionError, TimeoutError):
+            pass
+        time.sleep(0.01)
+    return False
+
+
+def time_to_serve(port, env, timeout=60):
+    """Spawn server.py and time its first 200 from /api/health and from /api/ready (seconds)."""
+    env = dict(env, WSI_BACKEND_PORT=str(port), WSI_BACKEND_DEBUG='0')
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(BACKEND_DIR, 'server.py')], cwd=BACKEND_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = start + timeout
+        health = time.perf_counter() - start if wait_for(f'http://127.0.0.1:{port}/api/health', deadline) else None
+        ready = time.perf_counter() - start if wait_for(f'http://127.0.0.1:{port}/api/ready', deadline) else None
+    finally:
+        process.terminate()
+        process.wait()
+    return health, ready
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per measurement (median is used)')
+    parser.add_argument('--top', type=int, default=15, help='modules to list')
+    parser.add_argument('--slide-dir', default=os.path.join(BENCH_DIR, 'fixtures'))
+    parser.add_argument('--port', type=int, default=5098, help='port for the spawned server.py')
+    parser.add_argument('--import-budget-ms', type=float, default=600, help='budget for `import server`')
+    parser.add_argument('--health-budget-ms', type=float, default=1500, help='budget for the first /api/health')
+    parser.add_argument('--ready-budget-ms', type=float, default=3000, help='budget for the first /api/ready')
+    parser.add_argument('--output', help='write results JSON to this path')
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.slide_dir, exist_ok=True)
+    env = dict(os.environ, WSI_SLIDE_DIR=os.path.abspath(args.slide_dir))
+
+    runs = []
+    eager = set()
+    for _ in range(args.repeat):
+        modules, eager_modules = profile_import('server', env)
+        runs.append(modules)
+        eager.update(eager_modules)
+    names = set.intersection(*(set(run) for run in runs))
+    median = {
+        name: {
+            'self_ms': float(np.median([run[name][0] for run in runs])) / 1000,
+            'cumulative_ms': float(np.median([run[name][1] for run in runs])) / 1000,
+            'depth': runs[0][name][2],
+        }
+        for name in names
+    }
+    import_ms = median['server']['cumulative_ms']
+
+    # Direct imports of server.py (depth 1) show which dependency is to blame
+    direct = sorted((name for name, m in median.items() if m['depth'] == 1), key=lambda n: -median[n]['cumulative_ms'])
+    print(f"import server: {import_ms:.1f} ms (median of {args.repeat})\n")
+    print(f"{'module imported by server.py':<40} {'cumulative':>11} {'self':>9}")
+    for name in direct[:args.top]:
+        print(f"{name:<40} {median[name]['cumulative_ms']:9.1f}ms {median[name]['self_ms']:7.1f}ms")
+    print(f"\n{'slowest modules (self time)':<40} {'self':>11}")
+    for name in sorted(median, key=lambda n: -median[n]['self_ms'])[:args.top]:
+        print(f"{name:<40} {median[name]['self_ms']:9.1f}ms")
+
+    serve_times = [time_to_serve(args.port, env) for _ in range(args.repeat)]
+    health_ms = [t[0] * 1000 for t in serve_times if t[0] is not None]
+    ready_ms = [t[1] * 1000 for t in serve_times if t[1] is not None]
+    health_ms = float(np.median(health_ms)) if len(health_ms) == len(serve_times) else None
+    ready_ms = float(np.median(ready_ms)) if len(ready_ms) == len(serve_times) else None
+    print(f"\nserver.py first /api/health: {health_ms if health_ms is None else round(health_ms, 1)} ms, "
+          f"first /api/ready: {ready_ms if ready_ms is None else round(ready_ms, 1)} ms")
+
+    failures = []
+    if eager:
+        failures.append(f"imported eagerly by server.py: {', '.join(sorted(eager))}")
+    if import_ms > args.import_budget_ms:
+        failures.append(f"import server took {import_ms:.1f} ms (budget {args.import_budget_ms} ms)")
+    if health_ms is None or health_ms > args.health_budget_ms:
+        failures.append(f"first /api/health after {health_ms} ms (budget {args.health_budget_ms} ms)")
+    if ready_ms is None or ready_ms > args.ready_budget_ms:
+        failures.append(f"first /api/ready after {ready_ms} ms (budget {args.ready_budget_ms} ms)")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'meta': {'revision': git_revision(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                         'args': vars(args)},
+                'results': {'import_ms': import_ms, 'health_ms': health_ms, 'ready_ms': ready_ms,
+                            'eager': sorted(eager), 'modules': median, 'failures': failures},
+            }, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if not failures:
+        print("OK: within budget")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""Generate synthetic whole slide images and segmentation masks for benchmarks.
+
+Writes a pyramidal tiled TIFF that tiffslide can open and a matching
+`<slide>.seg.h5` label mask in the layout `server.py` expects. Everything is
+rendered strip by strip from a seeded list of nuclei, so slides much larger
+than memory can be produced and the same seed always gives the same files.
+
+Usage:
+    python benchmarks/make_fixtures.py --out benchmarks/fixtures --width 16384 --height 16384 --density 300
+"""
+import argparse
+import os
+import sys
+
+import cv2
+import h5py
+import numpy as np
+import tifffile
+
+TILE_SIZE = 256
+STRIP_HEIGHT = 1024
+BACKGROUND_RGB = (236, 200, 220)  # Eosin-ish pink
+NUCLEUS_RGB = (90, 50, 140)  # Hematoxylin-ish purple
+
+
+def generate_nuclei(width, height, density, seed=0, min_radius=5, max_radius=12):
+    """Sample nuclei as (x, y, rx, ry, angle) rows sorted by y.
+
+    `density` is the expected number of nuclei per 1000x1000 level 0 pixels.
+    """
+    rng = np.random.default_rng(seed)
+    count = rng.poisson(density * (width / 1000.0) * (height / 1000.0))
+    nuclei = np.empty((count, 5), dtype=np.float64)
+    nuclei[:, 0] = rng.uniform(0, width, count)
+    nuclei[:, 1] = rng.uniform(0, height, count)
+    nuclei[:, 2] = rng.uniform(min_radius, max_radius, count)
+    nuclei[:, 3] = nuclei[:, 2] * rng.uniform(0.6, 1.0, count)
+    nuclei[:, 4] = rng.uniform(0, 180, count)
+    return nuclei[np.argsort(nuclei[:, 1], kind='stable')]
+
+
+def _nuclei_in_rows(nuclei, y0, y1):
+    """Return indices of nuclei that can touch level 0 rows [y0, y1)."""
+    max_radius = nuclei[:, 2].max() if len(nuclei) else 0
+    start = np.searchsorted(nuclei[:, 1], y0 - max_radius, side='left')
+    stop = np.searchsorted(nuclei[:, 1], y1 + max_radius, side='right')
+    return range(start, stop)
+
+
+def render_rgb_strip(nuclei, width, y0, y1, downsample, seed=0):
+    """Render image rows [y0, y1) of a level with the given downsample."""
+    rng = np.random.default_rng((seed, y0, int(downsample)))
+    strip = np.empty((y1 - y0, width, 3), dtype=np.uint8)
+    strip[:] = BACKGROUND_RGB
+    noise = rng.integers(-12, 13, size=strip.shape, dtype=np.int16)
+    for i in _nuclei_in_rows(nuclei, y0 * downsample, y1 * downsample):
+        cx, cy, rx, ry, angle = nuclei[i]
+        cv2.ellipse(
+            strip,
+            (int(round(cx / downsample)), int(round(cy / downsample - y0))),
+            (max(1, int(round(rx / downsample))), max(1, int(round(ry / downsample)))),
+            angle, 0, 360, NUCLEUS_RGB, -1
+        )
+    return np.clip(strip.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+def render_label_strip(nuclei, width, y0, y1):
+    """Render level 0 label rows [y0, y1); nucleus i gets label i + 1."""
+    strip = np.zeros((y1 - y0, width), dtype=np.int32)
+    for i in _nuclei_in_rows(nuclei, y0, y1):
+        cx, cy, rx, ry, angle = nuclei[i]
+        cv2.ellipse(
+            strip,
+            (int(round(cx)), int(round(cy - y0))),
+            (int(round(rx)), int(round(ry))),
+            angle, 0, 360, int(i + 1), -1
+        )
+    return strip
+
+
+def _level_tiles(nuclei, width, height, downsample, seed):
+    """Yield the tiles of one pyramid level in row-major order."""
+    for y0 in range(0, height, TILE_SIZE):
+        y1 = min(height, y0 + TILE_SIZE)
+        strip = render_rgb_strip(nuclei, width, y0, y1, downsample, seed)
+        padded = np.zeros((TILE_SIZE, width + (-width) % TILE_SIZE, 3), dtype=np.uint8)
+        padded[:y1 - y0, :width] = strip
+        for x0 in range(0, width, TILE_SIZE):
+            yield padded[:, x0:x0 + TILE_SIZE]
+
+
+def write_slide(path, nuclei, width, height, levels=3, seed=0):
+    """Write a pyramidal tiled TIFF with levels downsampled by 4 each."""
+    downsamples = [4 ** i for i in range(levels)]
+    with tifffile.TiffWriter(path, bigtiff=True) as tif:
+        for i, downsample in enumerate(downsamples):
+            level_width = width // downsample
+            level_height = height // downsample
+            tif.write(
+                _level_tiles(nuclei, level_width, level_height, downsample, seed),
+                shape=(level_height, level_width, 3),
+                dtype=np.uint8,
+                tile=(TILE_SIZE, TILE_SIZE),
+                photometric='rgb',
+                compression='jpeg',
+                subifds=levels - 1 if i == 0 else None,
+                subfiletype=1 if i > 0 else 0,
+                metadata=None,
+            )
+
+
+def write_segmentation(path, nuclei, width, height):
+    """Write the level 0 label mask to an H5 file under the `masks` key."""
+    with h5py.File(path, 'w') as f:
+        dataset = f.create_dataset(
+            'masks', shape=(height, width), dtype=np.int32,
+            chunks=(min(height, 512), min(width, 512)), compression='gzip', compression_opts=1
+        )
+        for y0 in range(0, height, STRIP_HEIGHT):
+            y1 = min(height, y0 + STRIP_HEIGHT)
+            dataset[y0:y1] = render_label_strip(nuclei, width, y0, y1)
+
+
+def make_fixture(out_dir, name='synthetic.tiff', width=8192, height=8192, density=300, levels=3, seed=0):
+    """Create one slide and its segmentation in `out_dir`; returns both paths."""
+    os.makedirs(out_dir, exist_ok=True)
+    nuclei = generate_nuclei(width, height, density, seed)
+    slide_path = os.path.join(out_dir, name)
+    seg_path = os.path.join(out_dir, f"{name}.seg.h5")
+    write_slide(slide_path, nuclei, width, height, levels, seed)
+    write_segmentation(seg_path, nuclei, width, height)
+    print(f"Wrote {slide_path} ({width}x{height}, {levels} levels) with {len(nuclei)} nuclei")
+    return slide_path, seg_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures'))
+    parser.add_argument('--name', default='synthetic.tiff')
+    parser.add_argument('--width', type=int, default=8192)
+    parser.add_argument('--height', type=int, default=8192)
+    parser.add_argument('--density', type=float, default=300, help='nuclei per 1000x1000 level 0 pixels')
+    parser.add_argument('--levels', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    make_fixture(args.out, args.name, args.width, args.height, args.density, args.levels, args.seed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+"""Build the cell-density overlay maps of slides ahead of time.
+
+For each slide with a segmentation file, finds the centroid and class of
+every instance (from stored centroids, or in one pass over the label mask),
+counts them into per-class density rasters at a few resolutions and writes
+them next to the slide as `<slide>.density/`. The server memory-maps these and
+serves them as colour-mapped overlay tiles at
+/api/slides/<slide>/density/tile/<level>/<x>/<y>. The same build runs as a
+background job via POST /api/slides/<slide>/density/build.
+
+Usage:
+    python build_density.py                      # every slide in WSI_SLIDE_DIR with a segmentation
+    python build_density.py --slide-dir /data/slides slide1.svs slide2.svs
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('slides', nargs='*', help='slide file names (default: all slides with a segmentation)')
+    parser.add_argument('--slide-dir', help='directory of the slides (default: WSI_SLIDE_DIR)')
+    args = parser.parse_args(argv)
+
+    if args.slide_dir:
+        os.environ['WSI_SLIDE_DIR'] = os.path.abspath(args.slide_dir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import server
+
+    slide_names = args.slides or sorted(f for f in os.listdir(server.SLIDE_DIR) if server.allowed_file(f))
+    failed = 0
+    for slide_name in slide_names:
+        with contextlib.redirect_stdout(io.StringIO()):
+            h5_path = server.find_segmentation_h5(slide_name)
+        if h5_path is None:
+            if args.slides:
+                print(f"{slide_name}: no segmentation file")
+                failed += 1
+            continue
+        start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                job = server.build_slide_density(slide_name)
+                while True:
+                    try:
+                        next(job)
+                    except StopIteration as stop:
+                        result = stop.value
+                        break
+        except Exception as e:
+            print(f"{slide_name}: failed: {e}")
+            failed += 1
+            continue
+        print(f"{slide_name}: {result['instances']} instances, classes {', '.join(result['classes'])}, "
+              f"cells {result['cells']} in {time.perf_counter() - start:.1f}s -> {server.density_dir(slide_name)}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""Serve the backend over a binary framed protocol instead of HTTP.
+
+Meant to be spawned by the Electron app, which then talks to it over the
+child's stdin and stdout (`--stdio`, the default), or to listen on a Unix
+domain socket (`--socket PATH`). Frames are length-prefixed (see
+scripts/ipc.py); decoded tiles and contour buffers travel as raw arrays, and
+replies of 64 KB or more are placed in shared memory segments that the client
+maps by name instead of reading them through the pipe.
+
+Methods: health, ready, slides, slideInfo, tile, contours, stats.
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# With --stdio the frames own the real stdout; send everything printed (server.py logs a lot) to stderr
+FRAME_OUTPUT = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+import numpy as np  # noqa: E402
+
+import server  # noqa: E402
+from scripts.ipc import IPCConnection, IPCError, serve_socket  # noqa: E402
+from scripts.scheduler import INTERACTIVE  # noqa: E402
+
+MAX_WORKERS = int(os.environ.get('WSI_IPC_WORKERS', 16))
+
+
+def open_slide(params):
+    slide_name = params.get('slide')
+    slide = server.get_cached_slide(slide_name) if slide_name else None
+    if slide is None:
+        raise IPCError('not_found', f"Slide not found: {slide_name}")
+    return slide_name, slide
+
+
+def health(params, call):
+    return {'status': 'ok'}, None
+
+
+def ready(params, call):
+    """Same answer as /api/ready; `ready` is False while the slide reader is still loading."""
+    status, is_ready = server.readiness()
+    return dict(status, ready=is_ready), None
+
+
+def list_slides(params, call):
+    return {'slides': [f for f in os.listdir(server.SLIDE_DIR) if server.allowed_file(f)]}, None
+
+
+def slide_info(params, call):
+    slide_name, _ = open_slide(params)
+    return server.get_slide_info_dict(slide_name), None
+
+
+def tile(params, call):
+    """One tile, encoded (`format=jpeg`, default, `webp`, `avif` or `png`) or as a decoded RGB array (`format=raw`)."""
+    slide_name, slide = open_slide(params)
+    level, x, y = int(params.get('level', 0)), int(params.get('x', 0)), int(params.get('y', 0))
+    if not server.tile_in_bounds(slide, level, x, y):
+        raise IPCError('out_of_bounds', f"Tile out of bounds: level={level}, x={x}, y={y}")
+
+    tile_format = params.get('format', server.FALLBACK_FORMAT)
+    if tile_format == 'raw':
+        with server.scheduler.slot(INTERACTIVE, request_id=call.key):
+            pixels = np.asarray(server.read_tile_image(slide, level, x, y))
+        return {'width': pixels.shape[1], 'height': pixels.shape[0]}, {'pixels': pixels}
+
+    if tile_format not in server.TILE_FORMATS or not server.format_supported(tile_format):
+        raise IPCError('bad_request', f"Unsupported tile format: {tile_format}")
+
+    tile_key = (slide_name, level, x, y, tile_format)
+    cached = server.tile_cache.get(tile_key)
+    if cached is not None:
+        data, mimetype = cached
+    else:
+        with server.scheduler.slot(INTERACTIVE, request_id=call.key):
+            data, mimetype = server.read_tile_bytes(slide, level, x, y, tile_format)
+        server.tile_cache.put(tile_key, data, mimetype)
+    if server.PREFETCH_DEPTH > 0:
+        server.prefetcher.record(call.session_id, slide_name, level, x, y, cached is not None, tile_format)
+    return {'mimetype': mimetype}, {'data': np.frombuffer(data, dtype=np.uint8)}
+
+
+def contours(params, call):
+    """Contours in a level 0 viewport as flat buffers.
+
+    `points` holds the (x, y) vertices of all contours back to back; contour i
+    is points[offsets[i]:offsets[i + 1]], with label labels[i] and colour
+    colors[i] (RGB).
+    """
+    slide_name, _ = open_slide(params)
+    x, y = float(params.get('x', 0)), float(params.get('y', 0))
+    width, height = float(params.get('width', 1000)), float(params.get('height', 1000))
+    h5_path = server.find_segmentation_h5(slide_name)
+    slide_info = server.get_slide_info_dict(slide_name)
+    found = []
+    if h5_path and slide_info:
+        with server.scheduler.slot(INTERACTIVE, request_id=call.key) as task:
+            found = server.viewport_contours(
+                h5_path, slide_info['dimensions']['width'], slide_info['dimensions']['height'],
+                x, y, width, height, task) or []
+
+    counts = [len(contour['points']) for contour in found]
+    points = np.array([(p['x'], p['y']) for contour in found for p in contour['points']], dtype=np.float32)
+    return {'count': len(found), 'segmentation': bool(h5_path)}, {
+        'points': points.reshape(-1, 2),
+        'offsets': np.concatenate([[0], np.cumsum(counts)]).astype(np.int32),
+        'labels': np.array([contour['label'] for contour in found], dtype=np.int32),
+        'colors': np.array([[int(contour['color'][i:i + 2], 16) for i in (1, 3, 5)] for contour in found],
+                           dtype=np.uint8).reshape(-1, 3),
+    }
+
+
+def stats(params, call):
+    return {
+        'tileCache': server.tile_cache.stats(),
+        'geometryCache': server.geometry_cache.stats(),
+        'aggregateCache': server.aggregate_cache.stats(),
+        'encoder': server.tile_encoder.stats(),
+        'scheduler': server.scheduler.stats(),
+    }, None
+
+
+HANDLERS = {
+    'health': health,
+    'ready': ready,
+    'slides': list_slides,
+    'slideInfo': slide_info,
+    'tile': tile,
+    'contours': contours,
+    'stats': stats,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stdio', action='store_true', help='serve one client over stdin/stdout (default)')
+    parser.add_argument('--socket', help='listen on this Unix domain socket instead')
+    args = parser.parse_args(argv)
+
+    server.start_warm_up()
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='ipc')
+    if args.socket:
+        print(f"WSI IPC server listening on {args.socket}, slides in {server.SLIDE_DIR}")
+        serve_socket(args.socket, HANDLERS, executor, on_cancel=server.scheduler.cancel)
+    else:
+        print(f"WSI IPC server on stdio, slides in {server.SLIDE_DIR}")
+        connection = IPCConnection(sys.stdin.buffer, FRAME_OUTPUT, HANDLERS, executor,
+                                   on_cancel=server.scheduler.cancel)
+        connection.serve()
+    executor.shutdown(wait=False, cancel_futures=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
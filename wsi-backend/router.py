@@ -0,0 +1,328 @@
+from flask import Flask, Response, request, jsonify
+import os
+import sys
+import json
+import time
+import atexit
+import signal
+import argparse
+import threading
+import subprocess
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+from flask_cors import CORS
+import logging
+from scripts.hash_ring import ConsistentHashRing
+from scripts import shared_cache
+
+# Create Flask app
+app = Flask(__name__)
+CORS(app, resources={r"/api/*": {"origins": "*"}}, supports_credentials=True)
+
+log = logging.getLogger('werkzeug')
+log.setLevel(logging.INFO)
+
+# Configuration
+PORT = int(os.environ.get('WSI_ROUTER_PORT', 5050))  # Same port as a single server.py, so clients need no changes
+HEALTH_INTERVAL = float(os.environ.get('WSI_ROUTER_HEALTH_INTERVAL', 2.0))  # Seconds between health checks
+HEALTH_TIMEOUT = 1.0
+PROXY_TIMEOUT = 300
+CHUNK_SIZE = 64 * 1024
+
+# Headers that describe a single connection and must not be forwarded
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers',
+    'transfer-encoding', 'upgrade', 'host', 'content-length',
+}
+
+# Every known backend node (base URL) and whether its last health check passed
+nodes = {}
+nodes_lock = threading.Lock()
+# Only healthy nodes are on the ring; slides of a failed node move to the others until it recovers
+ring = ConsistentHashRing()
+# Backend processes started by --spawn
+spawned = []
+
+def add_node(url):
+    url = url.rstrip('/')
+    with nodes_lock:
+        nodes.setdefault(url, {'healthy': False, 'lastCheck': None, 'error': None})
+    check_node(url)
+    return url
+
+def remove_node(url):
+    url = url.rstrip('/')
+    with nodes_lock:
+        known = nodes.pop(url, None) is not None
+    ring.remove(url)
+    return known
+
+def check_node(url):
+    """Probe a node's /api/ready and put it on (or take it off) the ring"""
+    try:
+        # Readiness rather than liveness: a node that is still loading its slide reader gets no slides yet
+        with urllib.request.urlopen(f"{url}/api/ready", timeout=HEALTH_TIMEOUT) as response:
+            healthy = response.status == 200
+        error = None
+    except Exception as e:
+        healthy = False
+        error = str(e)
+    with nodes_lock:
+        if url not in nodes:
+            return
+        was_healthy = nodes[url]['healthy']
+        nodes[url].update({'healthy': healthy, 'lastCheck': time.time(), 'error': error})
+    if healthy and ring.add(url):
+        print(f"Node joined the ring: {url}")
+    elif not healthy and ring.remove(url) and was_healthy:
+        print(f"Node left the ring: {url} ({error})")
+
+def health_loop():
+    while True:
+        with nodes_lock:
+            urls = list(nodes)
+        for url in urls:
+            check_node(url)
+        time.sleep(HEALTH_INTERVAL)
+
+def mark_failed(url, error):
+    with nodes_lock:
+        if url in nodes:
+            nodes[url].update({'healthy': False, 'lastCheck': time.time(), 'error': str(error)})
+    if ring.remove(url):
+        print(f"Node left the ring: {url} ({error})")
+
+def client_headers():
+    """Headers that tell a node who the client is: its address and its viewer session
+    
+    Nodes key prefetching and viewport cancellation by session, falling back to the peer address, which
+    behind the router would be the router's own for every client.
+    """
+    session_id = request.headers.get('X-Session-ID') or request.args.get('session') or request.remote_addr or ''
+    return {'X-Forwarded-For': request.remote_addr or '', 'X-Session-ID': session_id}
+
+def forward(url, path):
+    """Send the current request to a node; returns the upstream response (which may be an HTTP error)"""
+    target = f"{url}{path}"
+    if request.query_string:
+        target += '?' + request.query_string.decode('latin-1')
+    headers = {key: value for key, value in request.headers.items() if key.lower() not in HOP_BY_HOP_HEADERS}
+    headers.update(client_headers())
+    body = request.get_data() if request.method in ('POST', 'PUT', 'PATCH') else None
+    upstream_request = urllib.request.Request(target, data=body, headers=headers, method=request.method)
+    try:
+        return urllib.request.urlopen(upstream_request, timeout=PROXY_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        # 4xx/5xx answers are still answers; pass them on unchanged
+        return e
+
+def stream_response(upstream):
+    """Turn an upstream response into a streaming Flask response"""
+    def generate():
+        try:
+            while True:
+                # read1: pass on whatever has arrived (e.g. one NDJSON contour batch) instead of waiting for a full chunk
+                chunk = upstream.read1(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            upstream.close()
+    headers = [(key, value) for key, value in upstream.headers.items() if key.lower() not in HOP_BY_HOP_HEADERS]
+    return Response(generate(), status=upstream.status, headers=headers)
+
+def proxy_to_owner(key, path):
+    """Proxy the current request to the node that owns `key`, failing over once if it is unreachable"""
+    for _ in range(2):
+        url = ring.get_node(key)
+        if url is None:
+            return jsonify({'error': 'No healthy backend nodes'}), 503
+        try:
+            upstream = forward(url, path)
+        except (urllib.error.URLError, ConnectionError, TimeoutError) as e:
+            print(f"Error reaching {url}: {e}")
+            mark_failed(url, e)
+            continue
+        response = stream_response(upstream)
+        response.headers['X-Backend-Node'] = url
+        return response
+    return jsonify({'error': 'Backend nodes unreachable'}), 502
+
+def fan_out(path, method='GET', body=None):
+    """Send a request to every healthy node in parallel; returns {url: parsed JSON or error}"""
+    headers = client_headers()
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    if data is not None:
+        headers['Content-Type'] = 'application/json'
+    
+    def call(url):
+        upstream_request = urllib.request.Request(f"{url}{path}", data=data, method=method, headers=headers)
+        try:
+            with urllib.request.urlopen(upstream_request, timeout=PROXY_TIMEOUT) as response:
+                return url, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return url, {'status': e.code, 'error': e.read().decode('utf-8', 'replace')}
+        except Exception as e:
+            return url, {'error': str(e)}
+    urls = ring.members()
+    if not urls:
+        return {}
+    with ThreadPoolExecutor(max_workers=len(urls)) as pool:
+        return dict(pool.map(call, urls))
+
+# Routes
+@app.route('/api/health', methods=['GET'])
+def health_check():
+    healthy = len(ring)
+    return jsonify({'status': 'ok' if healthy else 'unavailable', 'healthyNodes': healthy}), 200 if healthy else 503
+
+@app.route('/api/router/nodes', methods=['GET'])
+def list_nodes():
+    """Return every known node, its health and a sample of slide assignments"""
+    with nodes_lock:
+        status = {url: dict(info) for url, info in nodes.items()}
+    assignments = {}
+    for result in fan_out('/api/slides').values():
+        for slide_name in result.get('slides', []):
+            assignments[slide_name] = ring.get_node(slide_name)
+    return jsonify({'nodes': status, 'assignments': assignments}), 200
+
+@app.route('/api/router/nodes', methods=['POST'])
+def join_node():
+    """Add a node; it joins the ring as soon as its health check passes"""
+    data = request.get_json(silent=True) or {}
+    if not data.get('url'):
+        return jsonify({'error': 'Missing url in request'}), 400
+    url = add_node(data['url'])
+    with nodes_lock:
+        info = dict(nodes[url])
+    return jsonify({'url': url, **info}), 200
+
+@app.route('/api/router/nodes', methods=['DELETE'])
+def leave_node():
+    """Remove a node; its slides move to the remaining nodes"""
+    data = request.get_json(silent=True) or {}
+    if not data.get('url'):
+        return jsonify({'error': 'Missing url in request'}), 400
+    if not remove_node(data['url']):
+        return jsonify({'error': 'Unknown node'}), 404
+    return jsonify({'message': 'Node removed', 'url': data['url'].rstrip('/')}), 200
+
+@app.route('/api/slides', methods=['GET'])
+def list_slides():
+    """Union of the slides visible to all healthy nodes"""
+    slide_files = set()
+    for result in fan_out('/api/slides').values():
+        slide_files.update(result.get('slides', []))
+    return jsonify({'slides': sorted(slide_files)}), 200
+
+@app.route('/api/slides/upload', methods=['POST'])
+def upload_slide():
+    # Place the upload on the node that will serve the slide afterwards. Parsing the form reads the request
+    # stream, so buffer the body first: forward() sends the buffered copy on to the node
+    request.get_data(cache=True)
+    file = request.files.get('file')
+    if file is None or file.filename == '':
+        return jsonify({'error': 'No file part'}), 400
+    return proxy_to_owner(file.filename, '/api/slides/upload')
+
+@app.route('/api/slides/<slide_name>', methods=['GET'])
+@app.route('/api/slides/<slide_name>/<path:rest>', methods=['GET', 'POST'])
+def proxy_slide(slide_name, rest=None):
+    return proxy_to_owner(slide_name, request.path)
+
+@app.route('/api/segmentation/<slide_name>/h5', methods=['GET'])
+def proxy_segmentation_h5(slide_name):
+    return proxy_to_owner(slide_name, request.path)
+
+@app.route('/api/requests/cancel', methods=['POST'])
+def cancel_requests():
+    """Request IDs are not tied to slides, so ask every node to cancel them"""
+    results = fan_out('/api/requests/cancel', method='POST', body=request.get_json(silent=True) or {})
+    return jsonify({'cancelled': sum(result.get('cancelled', 0) for result in results.values())}), 200
+
+@app.route('/api/jobs/<request_id>', methods=['GET'])
+def get_job(request_id):
+    for result in fan_out(f'/api/jobs/{request_id}').values():
+        if 'data' in result:
+            return jsonify(result), 200
+    return jsonify({'error': 'Job not found'}), 404
+
+@app.route('/api/prefetch/stats', methods=['GET'])
+@app.route('/api/scheduler/stats', methods=['GET'])
+@app.route('/api/encoding/stats', methods=['GET'])
+@app.route('/api/segmentation/cache/stats', methods=['GET'])
+def node_stats():
+    """Per-node statistics, keyed by node URL"""
+    return jsonify({'nodes': fan_out(request.path)}), 200
+
+def spawn_nodes(count, base_port, slide_dir=None, cache_name=None):
+    """Start `count` local server.py processes on consecutive ports; returns their URLs"""
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    urls = []
+    for i in range(count):
+        port = base_port + i
+        env = dict(os.environ, WSI_BACKEND_PORT=str(port), WSI_BACKEND_DEBUG='0', WSI_TRUSTED_PROXIES='127.0.0.1,::1')
+        if slide_dir:
+            env['WSI_SLIDE_DIR'] = os.path.abspath(slide_dir)
+        if cache_name:
+            env['WSI_SHARED_CACHE'] = cache_name
+        process = subprocess.Popen([sys.executable, server_path], env=env, cwd=os.path.dirname(server_path))
+        spawned.append(process)
+        urls.append(f"http://127.0.0.1:{port}")
+        print(f"Spawned backend node {i} (pid {process.pid}) on port {port}")
+    return urls
+
+def stop_spawned(cache_name=None):
+    for process in spawned:
+        process.terminate()
+    for process in spawned:
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    if cache_name:
+        # The caches server.py creates under this name outlive the nodes; nothing else uses them
+        for kind in ('tiles', 'geometry', 'aggregates'):
+            shared_cache.remove(f'{cache_name}-{kind}')
+
+def wait_for_nodes(urls, timeout=60):
+    """Block until every node answers its health check or `timeout` seconds pass"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        for url in urls:
+            check_node(url)
+        if all(url in ring for url in urls):
+            return True
+        time.sleep(0.5)
+    return False
+
+# Main function to run the router
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Route /api/slides/<slide>/... to backend nodes by consistent hashing on the slide name')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--nodes', default=os.environ.get('WSI_ROUTER_NODES', ''),
+                        help='comma-separated backend base URLs, e.g. http://10.0.0.2:5050,http://10.0.0.3:5050')
+    parser.add_argument('--spawn', type=int, default=0, help='start this many local server.py nodes')
+    parser.add_argument('--spawn-port', type=int, default=5051, help='port of the first spawned node')
+    parser.add_argument('--slide-dir', help='slide directory for spawned nodes (default: their own)')
+    parser.add_argument('--shared-cache', metavar='NAME',
+                        help='let spawned nodes share tile and contour caches in shared memory under this name')
+    args = parser.parse_args()
+
+    urls = [url for url in args.nodes.split(',') if url.strip()]
+    if args.spawn:
+        atexit.register(stop_spawned, args.shared_cache)
+        # Run atexit handlers (and stop the nodes) on SIGTERM too
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        urls += spawn_nodes(args.spawn, args.spawn_port, args.slide_dir, args.shared_cache)
+    for url in urls:
+        with nodes_lock:
+            nodes.setdefault(url.rstrip('/'), {'healthy': False, 'lastCheck': None, 'error': None})
+    if args.spawn:
+        wait_for_nodes([url.rstrip('/') for url in urls])
+
+    print(f"WSI Router starting on port {args.port} with {len(ring)}/{len(urls)} healthy nodes")
+    threading.Thread(target=health_loop, name='health-checks', daemon=True).start()
+    app.run(host='0.0.0.0', port=args.port, threaded=True)
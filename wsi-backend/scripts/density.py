@@ -0,0 +1,273 @@
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+from scripts.instance_index import write_instance_index
+
+DENSITY_SUFFIX = '.density'  # Density maps of `slide.svs` live in the directory `slide.svs.density`
+META_FILE = 'meta.json'
+BASE_CELL = 128  # Level 0 pixels per raster cell at the finest resolution
+CELL_FACTOR = 4  # Each further resolution has cells this many times larger per side
+RESOLUTIONS = 3
+STRIP_PIXELS = 16 * 1024 * 1024  # Mask pixels read per step of the centroid pass
+MIN_CELLS_PER_TILE = 8  # A tile uses the coarsest raster that still has this many cells across it
+SMOOTHING_CELLS = 1.0  # Gaussian sigma, in cells, applied to the counts at every resolution
+SCALE_PERCENTILE = 99  # Density mapped to the top of the colour map, per resolution and class
+
+# Optional class information next to the label mask
+CLASS_MAP_KEYS = ['classes', 'class_map', 'types', 'type_map']  # Per-pixel class, same shape as the mask
+INSTANCE_CLASS_KEYS = ['instance_classes', 'inst_type', 'instance_types']  # Class per label ID (or per centroid)
+CENTROID_KEYS = ['centroids', 'inst_centroid']  # (N, 2) instance centroids (x, y) in mask pixels
+AREA_KEYS = ['areas', 'inst_area']  # Instance areas in mask pixels, aligned with the centroids
+CLASS_NAMES_KEY = 'class_names'  # Attribute or dataset with one name per class
+
+# Heat colour map anchors (position, RGBA): transparent at zero, then blue, cyan, yellow and red
+COLORMAP = [
+    (0.0, (0, 0, 255, 0)),
+    (0.15, (0, 64, 255, 110)),
+    (0.4, (0, 200, 255, 160)),
+    (0.7, (255, 230, 0, 190)),
+    (1.0, (255, 32, 0, 220)),
+]
+
+
+def colormap_lut():
+    """256-entry RGBA lookup table interpolated between the COLORMAP anchors."""
+    positions = [anchor[0] for anchor in COLORMAP]
+    steps = np.linspace(0.0, 1.0, 256)
+    channels = [np.interp(steps, positions, [anchor[1][c] for anchor in COLORMAP]) for c in range(4)]
+    return np.stack(channels, axis=1).round().astype(np.uint8)
+
+
+LUT = colormap_lut()
+
+
+def find_class_source(f, dataset):
+    """Class information stored next to the label mask in an open H5 file.
+
+    Returns (class map dataset, instance classes array, centroids array, areas
+    array, class names); any of them may be None. Instance classes are indexed
+    by label ID, or aligned with the centroids when the file stores centroids.
+    """
+    def first(keys):
+        for key in keys:
+            for group in (f, dataset.parent):
+                if key in group:
+                    return group[key]
+        return None
+
+    class_map = first(CLASS_MAP_KEYS)
+    centroids = first(CENTROID_KEYS)
+    instance_classes = first(INSTANCE_CLASS_KEYS)
+    areas = first(AREA_KEYS)
+    names = dataset.attrs.get(CLASS_NAMES_KEY, f.attrs.get(CLASS_NAMES_KEY))
+    if names is None and CLASS_NAMES_KEY in f:
+        names = f[CLASS_NAMES_KEY][()]
+    if names is not None:
+        names = [name.decode('utf-8') if isinstance(name, bytes) else str(name) for name in np.atleast_1d(names)]
+    return (class_map,
+            None if instance_classes is None else np.asarray(instance_classes[()]).reshape(-1).astype(np.int64),
+            None if centroids is None else np.asarray(centroids[()], dtype=np.float64).reshape(-1, 2),
+            None if areas is None else np.asarray(areas[()], dtype=np.float64).reshape(-1),
+            names)
+
+
+def label_centroids(dataset, shape, read_window, class_map=None, instance_classes=None):
+    """Centroid and class of every instance in a label mask, reading it in row strips.
+
+    A generator: yields progress dicts and returns (xs, ys, classes, areas) in
+    mask pixels. The class of an instance is the most frequent value of
+    `class_map` over its pixels, or `instance_classes[label]`, or 0.
+    """
+    height, width = shape
+    strip_rows = max(16, STRIP_PIXELS // max(1, width))
+    parts = []
+    for y0 in range(0, height, strip_rows):
+        y1 = min(height, y0 + strip_rows)
+        strip = np.asarray(read_window(dataset, y0, y1, 0, width))
+        rows, columns = np.nonzero(strip > 0)
+        if rows.size:
+            labels, inverse = np.unique(strip[rows, columns], return_inverse=True)
+            votes = None
+            if class_map is not None:
+                pixel_classes = np.maximum(np.asarray(read_window(class_map, y0, y1, 0, width))[rows, columns], 0)
+                class_count = int(pixel_classes.max()) + 1
+                votes = np.bincount(inverse * class_count + pixel_classes.astype(np.int64),
+                                    minlength=len(labels) * class_count).reshape(len(labels), class_count)
+            parts.append((labels, np.bincount(inverse), np.bincount(inverse, weights=columns),
+                          np.bincount(inverse, weights=rows + y0), votes))
+        yield {'stage': 'centroids', 'rows': y1, 'totalRows': height}
+
+    if not parts:
+        return np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    # Instances spanning several strips: add up their partial sums
+    labels, inverse = np.unique(np.concatenate([part[0] for part in parts]), return_inverse=True)
+    count = np.bincount(inverse, weights=np.concatenate([part[1] for part in parts]))
+    xs = np.bincount(inverse, weights=np.concatenate([part[2] for part in parts])) / count + 0.5
+    ys = np.bincount(inverse, weights=np.concatenate([part[3] for part in parts])) / count + 0.5
+    if class_map is not None:
+        class_count = max(part[4].shape[1] for part in parts)
+        votes = np.zeros((len(labels), class_count))
+        np.add.at(votes, inverse, np.concatenate([np.pad(part[4], ((0, 0), (0, class_count - part[4].shape[1])))
+                                                  for part in parts]))
+        classes = votes.argmax(axis=1)
+    elif instance_classes is not None:
+        in_range = labels < len(instance_classes)
+        classes = np.zeros(len(labels), dtype=np.int64)
+        classes[in_range] = instance_classes[labels[in_range]]
+    else:
+        classes = np.zeros(len(labels), dtype=np.int64)
+    return xs, ys, np.maximum(classes, 0), count
+
+
+def density_rasters(xs, ys, classes, class_count, width, height,
+                    base_cell=BASE_CELL, factor=CELL_FACTOR, resolutions=RESOLUTIONS):
+    """{cell size: float32 (classes, rows, columns) array} of smoothed instance counts per cell.
+
+    `xs` and `ys` are level 0 coordinates. Coarser resolutions sum the cells
+    of the finer one, so every resolution counts the same instances.
+    """
+    from scipy import ndimage
+    rows, columns = math.ceil(height / base_cell), math.ceil(width / base_cell)
+    cell_x = np.clip((xs // base_cell).astype(np.int64), 0, columns - 1)
+    cell_y = np.clip((ys // base_cell).astype(np.int64), 0, rows - 1)
+    counts = np.bincount((classes * rows + cell_y) * columns + cell_x, minlength=class_count * rows * columns)
+    counts = counts.reshape(class_count, rows, columns).astype(np.float32)
+
+    rasters = {}
+    cell = base_cell
+    for resolution in range(resolutions):
+        if resolution:
+            rows, columns = math.ceil(rows / factor), math.ceil(columns / factor)
+            padded = np.zeros((class_count, rows * factor, columns * factor), dtype=np.float32)
+            padded[:, :counts.shape[1], :counts.shape[2]] = counts
+            counts = padded.reshape(class_count, rows, factor, columns, factor).sum(axis=(2, 4))
+            cell *= factor
+        rasters[cell] = ndimage.gaussian_filter(counts, sigma=(0, SMOOTHING_CELLS, SMOOTHING_CELLS))
+    return rasters
+
+
+def raster_scales(raster):
+    """Density at the top of the colour map for each class and for all classes together (last entry)."""
+    scales = []
+    for values in list(raster) + [raster.sum(axis=0)]:
+        positive = values[values > 1e-3]
+        scales.append(float(np.percentile(positive, SCALE_PERCENTILE)) if positive.size else 1.0)
+    return scales
+
+
+def build_density(dataset, shape, read_window, slide_width, slide_height, out_dir,
+                  class_map=None, instance_classes=None, centroids=None, areas=None, class_names=None):
+    """Write per-class density rasters for a label mask to `out_dir`.
+
+    A generator (so it can run as a preemptible batch job): yields progress
+    dicts and returns the metadata written to meta.json. Centroids come from
+    the `centroids` array when given, otherwise from a pass over the mask.
+    Each resolution is stored as a .npy file that the server memory-maps, next
+    to a grid index of the instances for aggregate queries (see instance_index).
+    """
+    seg_height, seg_width = shape
+    scale_x, scale_y = slide_width / seg_width, slide_height / seg_height
+    if centroids is not None:
+        xs, ys = centroids[:, 0], centroids[:, 1]
+        classes = (instance_classes if instance_classes is not None and len(instance_classes) == len(centroids)
+                   else np.zeros(len(centroids), dtype=np.int64))
+        if areas is None or len(areas) != len(centroids):
+            areas = np.full(len(centroids), np.nan)
+        yield {'stage': 'centroids', 'instances': len(centroids)}
+    else:
+        xs, ys, classes, areas = yield from label_centroids(dataset, shape, read_window, class_map, instance_classes)
+    classes = np.asarray(classes, dtype=np.int64)
+
+    class_count = max(int(classes.max()) + 1 if classes.size else 1, len(class_names or []))
+    if class_names is None or len(class_names) < class_count:
+        class_names = ['nuclei'] if class_count == 1 else [f'class_{i}' for i in range(class_count)]
+    rasters = density_rasters(xs * scale_x, ys * scale_y, classes, class_count, slide_width, slide_height)
+    yield {'stage': 'rasters', 'instances': int(len(xs))}
+
+    os.makedirs(out_dir, exist_ok=True)
+    for cell, raster in rasters.items():
+        path = os.path.join(out_dir, f'density_{cell}.npy')
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, raster)
+        os.replace(path + '.tmp', path)
+    instance_grid = write_instance_index(out_dir, xs * scale_x, ys * scale_y, classes, areas * scale_x * scale_y,
+                                         slide_width, slide_height)
+    meta = {
+        'version': 2,
+        'builtAt': time.time(),
+        'slide': {'width': slide_width, 'height': slide_height},
+        'classes': class_names[:class_count],
+        'instances': int(len(xs)),
+        'instancesPerClass': np.bincount(classes, minlength=class_count).tolist(),
+        'cells': sorted(rasters),
+        'scales': {str(cell): raster_scales(raster) for cell, raster in rasters.items()},
+        'instanceGrid': instance_grid,
+    }
+    # meta.json last: readers only pick up a build once it is complete
+    with open(os.path.join(out_dir, META_FILE + '.tmp'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(os.path.join(out_dir, META_FILE + '.tmp'), os.path.join(out_dir, META_FILE))
+    return meta
+
+
+class DensityMaps:
+    """Density rasters of one slide, memory-mapped from a directory written by `build_density`."""
+
+    def __init__(self, directory) -> None:
+        with open(os.path.join(directory, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.classes = self.meta['classes']
+        self.cells = sorted(self.meta['cells'])
+        self.scales = {int(cell): scales for cell, scales in self.meta['scales'].items()}
+        self.arrays = {cell: np.load(os.path.join(directory, f'density_{cell}.npy'), mmap_mode='r')
+                       for cell in self.cells}
+        self.version = self.meta['builtAt']
+
+    def class_index(self, name):
+        """Index of a class given by name or number, or None for all classes; raises KeyError if unknown."""
+        if name in (None, '', 'all'):
+            return None
+        if name in self.classes:
+            return self.classes.index(name)
+        if str(name).isdigit() and int(name) < len(self.classes):
+            return int(name)
+        raise KeyError(name)
+
+    def render(self, class_index, x, y, size, out_size):
+        """RGBA overlay (out_size x out_size uint8 array) for the level 0 square at (x, y) with side `size`."""
+        from PIL import Image
+        fitting = [cell for cell in self.cells if size / cell >= MIN_CELLS_PER_TILE]
+        cell = max(fitting) if fitting else self.cells[0]
+        raster = self.arrays[cell]
+        rows, columns = raster.shape[1:]
+
+        # Cells under the tile plus one on each side, so bilinear sampling has neighbours at the edges;
+        # zero beyond the raster
+        left, top, right, bottom = x / cell, y / cell, (x + size) / cell, (y + size) / cell
+        column0, row0 = math.floor(left) - 1, math.floor(top) - 1
+        column1, row1 = math.ceil(right) + 1, math.ceil(bottom) + 1
+        if max(0, column0) >= min(columns, column1) or max(0, row0) >= min(rows, row1):
+            return np.zeros((out_size, out_size, 4), dtype=np.uint8)
+        window = np.zeros((row1 - row0, column1 - column0), dtype=np.float32)
+        part = raster[:, max(0, row0):min(rows, row1), max(0, column0):min(columns, column1)]
+        window[max(0, row0) - row0:min(rows, row1) - row0, max(0, column0) - column0:min(columns, column1) - column0] = (
+            part[class_index] if class_index is not None else part.sum(axis=0))
+
+        image = Image.fromarray(window).resize(
+            (out_size, out_size), Image.BILINEAR, box=(left - column0, top - row0, right - column0, bottom - row0))
+        scale = self.scales[cell][-1 if class_index is None else class_index]
+        index = np.clip(np.asarray(image) * (255.0 / scale), 0, 255).astype(np.uint8)
+        overlay = LUT[index]
+
+        # Nothing beyond the slide edge
+        slide = self.meta['slide']
+        visible_width = int(round((slide['width'] - x) / size * out_size))
+        visible_height = int(round((slide['height'] - y) / size * out_size))
+        overlay[:, max(0, visible_width):, 3] = 0
+        overlay[max(0, visible_height):, :, 3] = 0
+        return overlay
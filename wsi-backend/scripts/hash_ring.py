@@ -0,0 +1,70 @@
+import bisect
+import hashlib
+import threading
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class ConsistentHashRing:
+    """Consistent hash ring mapping keys (slide names) to nodes.
+
+    Every node is placed on the ring at `replicas` virtual points, so keys
+    spread evenly and adding or removing a node only moves the keys in the
+    arcs that node gains or loses (about 1/N of them).
+    """
+
+    def __init__(self, nodes=(), replicas=128) -> None:
+        self.replicas = replicas
+        self.lock = threading.Lock()
+        self.points = []  # sorted hashes
+        self.owners = {}  # hash -> node
+        self.nodes = set()
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        with self.lock:
+            if node in self.nodes:
+                return False
+            self.nodes.add(node)
+            for i in range(self.replicas):
+                point = _hash(f"{node}#{i}")
+                self.owners[point] = node
+                bisect.insort(self.points, point)
+            return True
+
+    def remove(self, node):
+        with self.lock:
+            if node not in self.nodes:
+                return False
+            self.nodes.discard(node)
+            for i in range(self.replicas):
+                point = _hash(f"{node}#{i}")
+                if self.owners.get(point) == node:
+                    del self.owners[point]
+                    index = bisect.bisect_left(self.points, point)
+                    if index < len(self.points) and self.points[index] == point:
+                        del self.points[index]
+            return True
+
+    def get_node(self, key):
+        """Return the node owning `key`, or None if the ring is empty."""
+        with self.lock:
+            if not self.points:
+                return None
+            index = bisect.bisect(self.points, _hash(key)) % len(self.points)
+            return self.owners[self.points[index]]
+
+    def members(self):
+        with self.lock:
+            return sorted(self.nodes)
+
+    def __contains__(self, node):
+        with self.lock:
+            return node in self.nodes
+
+    def __len__(self):
+        with self.lock:
+            return len(self.nodes)
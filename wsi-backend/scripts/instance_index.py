@@ -0,0 +1,228 @@
+import hashlib
+import math
+import os
+
+import numpy as np
+
+INDEX_FILE = 'instances.npy'
+GRID_FILE = 'instance_grid.npy'
+GRID_CELL = 256  # Level 0 pixels per side of the grid cells that bucket the instances
+BAND_SPLIT = 8  # Points near a polygon outline are tested against the edges spanning their 1/8 of a grid row
+INSTANCE_DTYPE = np.dtype([('x', '<f4'), ('y', '<f4'), ('class', '<i4'), ('area', '<f4')])
+
+
+def write_instance_index(out_dir, xs, ys, classes, areas, width, height, cell=GRID_CELL):
+    """Write instance centroids (level 0), classes and areas sorted by grid cell, plus where each cell starts.
+
+    Returns the grid description stored in the density meta.json.
+    """
+    # Cover the slide, and any centroid past its edge, so every instance sits in the cell it falls in
+    rows = max(1, math.ceil(height / cell), int(ys.max() // cell) + 1 if len(ys) else 0)
+    columns = max(1, math.ceil(width / cell), int(xs.max() // cell) + 1 if len(xs) else 0)
+    cell_ids = (ys // cell).astype(np.int64) * columns + (xs // cell).astype(np.int64)
+    order = np.argsort(cell_ids, kind='stable')
+    table = np.empty(len(order), dtype=INSTANCE_DTYPE)
+    table['x'], table['y'], table['class'], table['area'] = xs[order], ys[order], classes[order], areas[order]
+    offsets = np.zeros(rows * columns + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(cell_ids, minlength=rows * columns))
+
+    for name, array in ((INDEX_FILE, table), (GRID_FILE, offsets)):
+        path = os.path.join(out_dir, name)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, array)
+        os.replace(path + '.tmp', path)
+    return {'cell': cell, 'rows': rows, 'columns': columns}
+
+
+def polygon_digest(rings):
+    """Hex digest identifying a polygon by its exact coordinates, for caching query results."""
+    digest = hashlib.blake2b(digest_size=16)
+    for ring in rings:
+        digest.update(np.ascontiguousarray(ring, dtype='<f8').tobytes())
+        digest.update(b'|')
+    return digest.hexdigest()
+
+
+def polygon_area(rings):
+    """Area enclosed by the first ring minus the areas of the others (holes), in squared coordinate units."""
+    areas = [abs(float(np.dot(ring[:, 0], np.roll(ring[:, 1], -1)) - np.dot(ring[:, 1], np.roll(ring[:, 0], -1)))) / 2
+             for ring in rings]
+    return max(0.0, areas[0] - sum(areas[1:]))
+
+
+def ranges(starts, counts):
+    """Concatenation of arange(start, start + count) for every pair, without a Python loop."""
+    counts = np.asarray(counts, dtype=np.int64)
+    total = int(counts.sum())
+    if not total:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.cumsum(counts)
+    return np.repeat(np.asarray(starts, dtype=np.int64) - (ends - counts), counts) + np.arange(total)
+
+
+class InstanceIndex:
+    """Instance centroids of one slide bucketed in a grid, for aggregate queries over polygons.
+
+    Loaded from a directory written by `build_density`, given its meta.json.
+    Each grid cell keeps its instance count per class and the sum, sum of
+    squares, minimum and maximum of the instance areas, so cells lying wholly
+    inside a polygon are added up without looking at their instances; only the
+    instances in cells the polygon outline passes through are tested one by one.
+    """
+
+    def __init__(self, directory, meta) -> None:
+        grid = meta['instanceGrid']
+        self.cell, self.rows, self.columns = grid['cell'], grid['rows'], grid['columns']
+        self.classes = meta['classes']
+        self.version = meta['builtAt']
+        table = np.load(os.path.join(directory, INDEX_FILE), mmap_mode='r')
+        self.xs = np.ascontiguousarray(table['x'], dtype=np.float64)
+        self.ys = np.ascontiguousarray(table['y'], dtype=np.float64)
+        self.instance_classes = np.ascontiguousarray(table['class'], dtype=np.int64)
+        self.areas = np.ascontiguousarray(table['area'], dtype=np.float64)
+        self.offsets = np.load(os.path.join(directory, GRID_FILE))
+
+        cells = self.rows * self.columns
+        counts = np.diff(self.offsets)
+        cell_of = np.repeat(np.arange(cells), counts)
+        known = ~np.isnan(self.areas)
+        areas = np.where(known, self.areas, 0.0)
+        # Per cell: count of each class, then count, sum and sum of squares of the known areas
+        stats = np.zeros((len(self.classes) + 3, cells))
+        stats[:len(self.classes)] = np.bincount(cell_of * len(self.classes) + self.instance_classes,
+                                                minlength=cells * len(self.classes)).reshape(cells, -1).T
+        stats[-3] = np.bincount(cell_of, weights=known, minlength=cells)
+        stats[-2] = np.bincount(cell_of, weights=areas, minlength=cells)
+        stats[-1] = np.bincount(cell_of, weights=areas * areas, minlength=cells)
+        # Summed along each grid row, so a run of cells inside a polygon costs two lookups
+        self.cell_prefix = np.zeros((len(stats), self.rows, self.columns + 1))
+        np.cumsum(stats.reshape(len(stats), self.rows, self.columns), axis=2, out=self.cell_prefix[:, :, 1:])
+        self.cell_area_min = np.full(cells, np.inf)
+        self.cell_area_max = np.full(cells, -np.inf)
+        occupied = counts > 0
+        if occupied.any():
+            starts = self.offsets[:-1][occupied]
+            self.cell_area_min[occupied] = np.minimum.reduceat(np.where(known, self.areas, np.inf), starts)
+            self.cell_area_max[occupied] = np.maximum.reduceat(np.where(known, self.areas, -np.inf), starts)
+        self.cell_area_min = self.cell_area_min.reshape(self.rows, self.columns)
+        self.cell_area_max = self.cell_area_max.reshape(self.rows, self.columns)
+
+    def aggregate(self, rings):
+        """Instance count, class histogram and area statistics for the centroids inside a polygon.
+
+        `rings` is a list of (N, 2) arrays of level 0 (x, y) vertices; inside
+        follows the even-odd rule, so rings within the first one are holes.
+        """
+        edges = np.concatenate([np.hstack([ring, np.roll(ring, -1, axis=0)]) for ring in rings])
+        edges = edges[edges[:, 1] != edges[:, 3]]  # Horizontal edges never cross a horizontal ray
+        points = np.concatenate(rings)
+        column0 = max(0, int(points[:, 0].min() // self.cell))
+        row0 = max(0, int(points[:, 1].min() // self.cell))
+        column1 = min(self.columns - 1, int(points[:, 0].max() // self.cell))
+        row1 = min(self.rows - 1, int(points[:, 1].max() // self.cell))
+        if not len(edges) or column0 > column1 or row0 > row1:
+            return self.summary(np.zeros(len(self.classes), dtype=np.int64), 0, 0.0, 0.0, np.inf, -np.inf)
+        columns, rows = column1 - column0 + 1, row1 - row0 + 1
+
+        # Cells the outline passes through: sample every edge at least twice per cell, so consecutive samples
+        # are in the same or neighbouring cells; a diagonal step may also cross either cell beside it
+        lengths = np.hypot(edges[:, 2] - edges[:, 0], edges[:, 3] - edges[:, 1])
+        steps = np.ceil(lengths / (self.cell / 2)).astype(np.int64) + 1
+        t = ranges(np.zeros(len(edges)), steps) / np.repeat(np.maximum(steps - 1, 1), steps)
+        edge_of = np.repeat(np.arange(len(edges)), steps)
+        sample_x = edges[edge_of, 0] + t * (edges[edge_of, 2] - edges[edge_of, 0])
+        sample_y = edges[edge_of, 1] + t * (edges[edge_of, 3] - edges[edge_of, 1])
+        sample_columns = np.floor(sample_x / self.cell).astype(np.int64) - column0
+        sample_rows = np.floor(sample_y / self.cell).astype(np.int64) - row0
+        diagonal = ((edge_of[1:] == edge_of[:-1]) & (sample_columns[1:] != sample_columns[:-1])
+                    & (sample_rows[1:] != sample_rows[:-1]))
+        touched_rows = np.concatenate([sample_rows, sample_rows[:-1][diagonal], sample_rows[1:][diagonal]])
+        touched_columns = np.concatenate([sample_columns, sample_columns[1:][diagonal], sample_columns[:-1][diagonal]])
+        inside_window = ((touched_columns >= 0) & (touched_columns < columns)
+                         & (touched_rows >= 0) & (touched_rows < rows))
+        boundary = np.zeros((rows, columns), dtype=bool)
+        boundary[touched_rows[inside_window], touched_columns[inside_window]] = True
+
+        # The other cells are wholly inside or outside: count the outline crossings right of each cell centre
+        centre_y = (np.arange(row0, row1 + 1) + 0.5) * self.cell
+        y0, y1 = edges[:, 1][None, :], edges[:, 3][None, :]
+        crossing = (y0 > centre_y[:, None]) != (y1 > centre_y[:, None])
+        row_of, edge_index = np.nonzero(crossing)
+        x0, x1 = edges[edge_index, 0], edges[edge_index, 2]
+        cross_x = x0 + (centre_y[row_of] - edges[edge_index, 1]) * (x1 - x0) / (edges[edge_index, 3] - edges[edge_index, 1])
+        # Crossing at cross_x counts for the cells whose centre is left of it
+        left_of = np.clip(np.ceil((cross_x - (column0 + 0.5) * self.cell) / self.cell), 0, columns).astype(np.int64)
+        counts = np.zeros((rows, columns + 1), dtype=np.int64)
+        np.add.at(counts, (row_of, left_of), 1)
+        right_crossings = counts[:, ::-1].cumsum(axis=1)[:, ::-1][:, 1:]
+        interior = (right_crossings % 2 == 1) & ~boundary
+
+        # Runs of interior cells along each row of the window
+        edges_of_runs = np.diff(np.pad(interior.astype(np.int8), ((0, 0), (1, 1))), axis=1)
+        run_rows, run_starts = np.nonzero(edges_of_runs == 1)
+        run_ends = np.nonzero(edges_of_runs == -1)[1]
+        totals = (self.cell_prefix[:, row0 + run_rows, column0 + run_ends]
+                  - self.cell_prefix[:, row0 + run_rows, column0 + run_starts]).sum(axis=1)
+        class_counts = np.rint(totals[:len(self.classes)]).astype(np.int64)
+        area_count, area_sum, area_squares = (float(total) for total in totals[-3:])
+        window = np.s_[row0:row1 + 1, column0:column1 + 1]
+        area_min = float(self.cell_area_min[window][interior].min()) if run_rows.size else np.inf
+        area_max = float(self.cell_area_max[window][interior].max()) if run_rows.size else -np.inf
+
+        # Instances in boundary cells: exact even-odd test
+        edge_cells = (np.arange(row0, row1 + 1)[:, None] * self.columns + np.arange(column0, column1 + 1))[boundary]
+        candidates = ranges(self.offsets[edge_cells], self.offsets[edge_cells + 1] - self.offsets[edge_cells])
+        if candidates.size:
+            inside = self.contains(edges, self.xs[candidates], self.ys[candidates], row0, rows)
+            selected = candidates[inside]
+            class_counts = class_counts + np.bincount(self.instance_classes[selected], minlength=len(self.classes))
+            areas = self.areas[selected]
+            areas = areas[~np.isnan(areas)]
+            if areas.size:
+                area_count += areas.size
+                area_sum += float(areas.sum())
+                area_squares += float((areas * areas).sum())
+                area_min = min(area_min, float(areas.min()))
+                area_max = max(area_max, float(areas.max()))
+        return self.summary(class_counts, area_count, area_sum, area_squares, area_min, area_max)
+
+    def contains(self, edges, xs, ys, row0, rows):
+        """Even-odd point-in-polygon test, pairing each point only with the edges that span its band of rows."""
+        band = self.cell / BAND_SPLIT
+        top = row0 * self.cell
+        bands = rows * BAND_SPLIT
+        edge_first = np.clip(np.floor((np.minimum(edges[:, 1], edges[:, 3]) - top) / band).astype(np.int64), 0, bands)
+        edge_last = np.clip(np.floor((np.maximum(edges[:, 1], edges[:, 3]) - top) / band).astype(np.int64), -1, bands - 1)
+        spans = np.maximum(edge_last - edge_first + 1, 0)
+        # Edges listed per band, as (band, edge) pairs sorted by band
+        pair_bands = ranges(edge_first, spans)
+        pair_edges = np.repeat(np.arange(len(edges)), spans)
+        order = np.argsort(pair_bands, kind='stable')
+        pair_edges = pair_edges[order]
+        band_starts = np.searchsorted(pair_bands[order], np.arange(bands + 1))
+
+        point_bands = np.clip(np.floor((ys - top) / band).astype(np.int64), 0, bands - 1)
+        per_point = band_starts[point_bands + 1] - band_starts[point_bands]
+        point_of = np.repeat(np.arange(len(xs)), per_point)
+        edge = edges[pair_edges[ranges(band_starts[point_bands], per_point)]]
+        px, py = xs[point_of], ys[point_of]
+        crosses = ((edge[:, 1] > py) != (edge[:, 3] > py)) & (
+            px < edge[:, 0] + (py - edge[:, 1]) * (edge[:, 2] - edge[:, 0]) / (edge[:, 3] - edge[:, 1]))
+        return np.bincount(point_of, weights=crosses, minlength=len(xs)) % 2 == 1
+
+    def summary(self, class_counts, area_count, area_sum, area_squares, area_min, area_max):
+        area = None
+        if area_count:
+            mean = area_sum / area_count
+            area = {
+                'total': area_sum,
+                'mean': mean,
+                'std': math.sqrt(max(0.0, area_squares / area_count - mean * mean)),
+                'min': area_min,
+                'max': area_max,
+            }
+        return {
+            'count': int(class_counts.sum()),
+            'classes': {name: int(count) for name, count in zip(self.classes, class_counts)},
+            'area': area,
+        }
@@ -0,0 +1,509 @@
+import itertools
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from scripts.scheduler import CancelledError
+
+PROTOCOL_VERSION = 1
+# Every frame starts with: body length, request ID, frame kind, metadata length.
+# The body is the JSON metadata followed by the binary payload.
+FRAME_HEADER = struct.Struct('<IIB3xI')
+MAX_FRAME_BYTES = 1 << 30
+
+# Frame kinds
+REQUEST = 1   # client -> server: {"method", "params"}
+RESPONSE = 2  # server -> client: {"result", "arrays", "shm"?} + payload
+ERROR = 3     # server -> client: {"code", "message"}
+CANCEL = 4    # client -> server: cancel the request with this ID
+RELEASE = 5   # client -> server: {"name"}, the client is done with a shared memory segment
+
+SHM_THRESHOLD = 64 * 1024  # Payloads at least this large go through shared memory when the peer supports it
+SHM_POOL_BYTES = 256 * 1024 * 1024  # Shared memory handed out and not yet released, per connection
+SHM_FREE_PER_SIZE = 4  # Released segments kept for reuse per size class; the rest are unlinked
+SHM_CLIENT_SEGMENTS = 32  # Segments a client keeps mapped for reuse
+ARRAY_ALIGNMENT = 64
+
+
+class IPCError(Exception):
+    """An error reported by (or for) the other end of an IPC connection."""
+
+    def __init__(self, code, message) -> None:
+        super().__init__(message)
+        self.code = code
+
+
+def _read_exact(stream, size):
+    data = bytearray(size)
+    view = memoryview(data)
+    read = 0
+    while read < size:
+        count = stream.readinto(view[read:])
+        if not count:
+            return None
+        read += count
+    return data
+
+
+def read_frame(stream):
+    """Read one frame; returns (kind, request_id, meta, payload) or None at end of stream."""
+    header = _read_exact(stream, FRAME_HEADER.size)
+    if header is None:
+        return None
+    body_length, request_id, kind, meta_length = FRAME_HEADER.unpack(header)
+    if body_length > MAX_FRAME_BYTES or meta_length > body_length:
+        raise IPCError('protocol', f"Invalid frame header (body {body_length}, metadata {meta_length})")
+    body = _read_exact(stream, body_length)
+    if body is None:
+        return None
+    meta = json.loads(bytes(body[:meta_length])) if meta_length else {}
+    return kind, request_id, meta, memoryview(body)[meta_length:]
+
+
+def write_frame(stream, lock, kind, request_id, meta=None, payload=b''):
+    """Write one frame; `lock` serializes writers sharing the stream."""
+    meta_bytes = json.dumps(meta, separators=(',', ':')).encode('utf-8') if meta else b''
+    header = FRAME_HEADER.pack(len(meta_bytes) + len(payload), request_id, kind, len(meta_bytes))
+    with lock:
+        stream.write(header)
+        stream.write(meta_bytes)
+        if len(payload):
+            stream.write(payload)
+        stream.flush()
+
+
+def layout_arrays(arrays):
+    """Place named arrays back to back in one buffer; returns (specs, total size)."""
+    specs = []
+    offset = 0
+    for name, array in arrays.items():
+        offset = -(-offset // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+        specs.append({'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset})
+        offset += array.nbytes
+    return specs, offset
+
+
+def pack_arrays(buffer, arrays, specs):
+    for spec, array in zip(specs, arrays.values()):
+        target = np.ndarray(array.shape, dtype=array.dtype, buffer=buffer, offset=spec['offset'])
+        target[...] = array
+
+
+def unpack_arrays(buffer, specs):
+    """Zero-copy views of the arrays described by `specs` in `buffer`."""
+    return {
+        spec['name']: np.ndarray(tuple(spec['shape']), dtype=np.dtype(spec['dtype']), buffer=buffer, offset=spec['offset'])
+        for spec in specs
+    }
+
+
+def _unlink(segment):
+    segment.close()
+    try:
+        segment.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class SegmentPool:
+    """Shared memory segments for large replies, reused once the client releases them.
+
+    Segments are sized in powers of two so a released segment can serve later
+    replies of similar size without creating a new one. At most
+    `free_per_size` released segments are kept per size, so a burst of large
+    replies does not leave its segments allocated.
+    """
+
+    def __init__(self, max_bytes=SHM_POOL_BYTES, min_size=SHM_THRESHOLD, free_per_size=SHM_FREE_PER_SIZE) -> None:
+        self.max_bytes = max_bytes
+        self.min_size = min_size
+        self.free_per_size = free_per_size
+        self.lock = threading.Lock()
+        self.free = {}  # size -> [segment]
+        self.in_use = {}  # name -> segment
+        self.in_use_bytes = 0
+        self.created = 0
+        self.reused = 0
+        self.trimmed = 0
+
+    def acquire(self, size):
+        """Return a segment of at least `size` bytes, or None if too much is handed out already."""
+        size = max(self.min_size, 1 << (size - 1).bit_length())
+        with self.lock:
+            if self.in_use_bytes + size > self.max_bytes:
+                return None
+            free = self.free.get(size)
+            if free:
+                segment = free.pop()
+                self.reused += 1
+            else:
+                segment = shared_memory.SharedMemory(create=True, size=size)
+                self.created += 1
+            self.in_use[segment.name] = segment
+            self.in_use_bytes += size
+            return segment
+
+    def release(self, name):
+        with self.lock:
+            segment = self.in_use.pop(name, None)
+            if segment is None:
+                return False
+            size = segment.size
+            self.in_use_bytes -= size
+            free = self.free.setdefault(size, [])
+            if len(free) < self.free_per_size:
+                free.append(segment)
+                return True
+            self.trimmed += 1
+        _unlink(segment)
+        return True
+
+    def close(self):
+        with self.lock:
+            segments = list(self.in_use.values()) + [s for free in self.free.values() for s in free]
+            self.in_use.clear()
+            self.free.clear()
+            self.in_use_bytes = 0
+        for segment in segments:
+            _unlink(segment)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'inUse': len(self.in_use),
+                'inUseBytes': self.in_use_bytes,
+                'free': sum(len(free) for free in self.free.values()),
+                'created': self.created,
+                'reused': self.reused,
+                'trimmed': self.trimmed,
+            }
+
+
+class Call:
+    """One in-flight request on the server side."""
+
+    def __init__(self, connection, request_id) -> None:
+        self.request_id = request_id
+        # Unique across connections; handlers use it as the scheduler request ID
+        self.key = f"ipc-{connection.id}-{request_id}"
+        self.session_id = f"ipc-{connection.id}"
+        self.cancelled = threading.Event()
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise CancelledError(f"Request {self.key} was cancelled")
+
+
+class IPCConnection:
+    """Serve framed requests from one client over a pair of binary streams.
+
+    `handlers` maps a method name to fn(params, call) returning
+    (result, arrays): a JSON-serializable result and an optional dict of
+    numpy arrays sent as the binary payload. Requests run concurrently on
+    `executor`; a CANCEL frame sets the call's cancelled flag and passes its
+    key to `on_cancel` (e.g. the work scheduler's `cancel`).
+    """
+
+    ids = itertools.count(1)
+
+    def __init__(self, reader, writer, handlers, executor, on_cancel=None, pool_bytes=SHM_POOL_BYTES) -> None:
+        self.id = next(self.ids)
+        self.reader = reader
+        self.writer = writer
+        self.write_lock = threading.Lock()
+        self.handlers = handlers
+        self.executor = executor
+        self.on_cancel = on_cancel
+        self.pool = SegmentPool(pool_bytes)
+        self.shared_memory = False  # Enabled by the client's hello
+        self.calls = {}  # request_id -> Call
+        self.calls_lock = threading.Lock()
+
+    def serve(self):
+        """Handle frames until the client disconnects, then cancel its unfinished requests."""
+        try:
+            while True:
+                frame = read_frame(self.reader)
+                if frame is None:
+                    break
+                kind, request_id, meta, _ = frame
+                if kind == REQUEST:
+                    self._accept(request_id, meta.get('method'), meta.get('params') or {})
+                elif kind == CANCEL:
+                    self.cancel(request_id)
+                elif kind == RELEASE:
+                    self.pool.release(meta.get('name'))
+        except (OSError, ValueError, IPCError) as e:
+            print(f"IPC connection {self.id} closed: {e}")
+        finally:
+            with self.calls_lock:
+                request_ids = list(self.calls)
+            for request_id in request_ids:
+                self.cancel(request_id)
+            self.pool.close()
+
+    def _accept(self, request_id, method, params):
+        if method == 'hello':
+            # Shared memory needs both ends on this machine and a client that can map the segments
+            self.shared_memory = bool(params.get('sharedMemory'))
+            self._send(RESPONSE, request_id, {'result': {
+                'version': PROTOCOL_VERSION, 'sharedMemory': self.shared_memory, 'shmThreshold': SHM_THRESHOLD,
+                'methods': sorted(self.handlers),
+            }})
+            return
+        call = Call(self, request_id)
+        with self.calls_lock:
+            self.calls[request_id] = call
+        self.executor.submit(self._dispatch, call, method, params)
+
+    def cancel(self, request_id):
+        with self.calls_lock:
+            call = self.calls.get(request_id)
+        if call is None:
+            return False
+        call.cancelled.set()
+        if self.on_cancel is not None:
+            self.on_cancel(call.key)
+        return True
+
+    def _dispatch(self, call, method, params):
+        try:
+            handler = self.handlers.get(method)
+            if handler is None:
+                raise IPCError('unknown_method', f"Unknown method: {method}")
+            call.check()
+            result, arrays = handler(params, call)
+            call.check()
+            self._respond(call.request_id, result, arrays)
+        except CancelledError as e:
+            self._send(ERROR, call.request_id, {'code': 'cancelled', 'message': str(e)})
+        except IPCError as e:
+            self._send(ERROR, call.request_id, {'code': e.code, 'message': str(e)})
+        except Exception as e:
+            print(f"Error in IPC method {method}: {e}")
+            self._send(ERROR, call.request_id, {'code': 'error', 'message': str(e)})
+        finally:
+            with self.calls_lock:
+                self.calls.pop(call.request_id, None)
+
+    def _respond(self, request_id, result, arrays):
+        meta = {'result': result}
+        if not arrays:
+            self._send(RESPONSE, request_id, meta)
+            return
+        specs, size = layout_arrays(arrays)
+        meta['arrays'] = specs
+        segment = self.pool.acquire(size) if self.shared_memory and size >= SHM_THRESHOLD else None
+        if segment is not None:
+            pack_arrays(segment.buf, arrays, specs)
+            meta['shm'] = {'name': segment.name, 'size': segment.size}
+            self._send(RESPONSE, request_id, meta)
+            return
+        payload = bytearray(size)
+        pack_arrays(payload, arrays, specs)
+        self._send(RESPONSE, request_id, meta, payload)
+
+    def _send(self, kind, request_id, meta, payload=b''):
+        try:
+            write_frame(self.writer, self.write_lock, kind, request_id, meta, payload)
+        except (OSError, ValueError) as e:
+            # The client went away; `serve` notices on its next read
+            print(f"IPC connection {self.id}: could not send reply {request_id}: {e}")
+
+
+def serve_socket(path, handlers, executor, on_cancel=None):
+    """Accept clients on a Unix domain socket, one thread per connection."""
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+    try:
+        while True:
+            client, _ = server.accept()
+            connection = IPCConnection(client.makefile('rb'), client.makefile('wb'), handlers, executor, on_cancel)
+            threading.Thread(target=_serve_and_close, args=(connection, client), name=f'ipc-{connection.id}',
+                             daemon=True).start()
+    finally:
+        server.close()
+        os.remove(path)
+
+
+def _serve_and_close(connection, client):
+    try:
+        connection.serve()
+    finally:
+        client.close()
+
+
+def _attach_segment(name):
+    """Map a segment created by the server without letting this process's resource tracker unlink it."""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13
+        segment = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
+
+
+class Reply:
+    """A successful response: `result` plus the named payload `arrays`.
+
+    Arrays in shared memory are views into the server's segment; call
+    `release` (or use the reply as a context manager) when done with them so
+    the server can reuse the segment. They must not be used afterwards.
+    """
+
+    def __init__(self, client, result, arrays, segment_name=None) -> None:
+        self.client = client
+        self.result = result
+        self.arrays = arrays
+        self.segment_name = segment_name
+
+    def release(self):
+        self.arrays = None
+        if self.segment_name is not None:
+            self.client._release(self.segment_name)
+            self.segment_name = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class IPCClient:
+    """Client side of the framed protocol with concurrent calls and cancellation."""
+
+    def __init__(self, reader, writer, process=None, shared_memory=True) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.process = process
+        self.write_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        self.pending = {}  # request_id -> Future
+        self.pending_lock = threading.Lock()
+        self.segments = OrderedDict()  # name -> attached SharedMemory, kept mapped for reuse, oldest first
+        self.closed = False
+        threading.Thread(target=self._read_loop, name='ipc-client', daemon=True).start()
+        self.server_info = self.call('hello', version=PROTOCOL_VERSION, sharedMemory=shared_memory).result
+
+    @classmethod
+    def spawn(cls, script, args=(), env=None, stderr=None, **kwargs):
+        """Start `script` (e.g. ipc_server.py) and talk to it over its stdin and stdout."""
+        process = subprocess.Popen(
+            [sys.executable, script, *args], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr,
+            env=env, cwd=os.path.dirname(os.path.abspath(script))
+        )
+        return cls(process.stdout, process.stdin, process=process, **kwargs)
+
+    @classmethod
+    def connect(cls, path, **kwargs):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        return cls(sock.makefile('rb'), sock.makefile('wb'), **kwargs)
+
+    def call_async(self, method, **params):
+        """Send a request and return a Future for its Reply; `future.request_id` identifies it for `cancel`."""
+        request_id = next(self.request_ids)
+        future = Future()
+        future.request_id = request_id
+        with self.pending_lock:
+            if self.closed:
+                raise IPCError('closed', "Connection is closed")
+            self.pending[request_id] = future
+        write_frame(self.writer, self.write_lock, REQUEST, request_id, {'method': method, 'params': params})
+        return future
+
+    def call(self, method, timeout=None, **params):
+        return self.call_async(method, **params).result(timeout)
+
+    def cancel(self, future):
+        """Ask the server to cancel a pending call; the future then fails with IPCError('cancelled')."""
+        write_frame(self.writer, self.write_lock, CANCEL, future.request_id)
+
+    def _release(self, name):
+        if not self.closed:
+            write_frame(self.writer, self.write_lock, RELEASE, 0, {'name': name})
+
+    def _read_loop(self):
+        error = IPCError('closed', "Connection closed")
+        try:
+            while True:
+                frame = read_frame(self.reader)
+                if frame is None:
+                    break
+                kind, request_id, meta, payload = frame
+                with self.pending_lock:
+                    future = self.pending.pop(request_id, None)
+                if future is None:
+                    continue
+                if kind == ERROR:
+                    future.set_exception(IPCError(meta.get('code'), meta.get('message')))
+                    continue
+                segment_name = None
+                arrays = {}
+                if meta.get('arrays'):
+                    buffer = payload
+                    if 'shm' in meta:
+                        segment_name = meta['shm']['name']
+                        segment = self.segments.get(segment_name)
+                        if segment is None:
+                            segment = self.segments[segment_name] = _attach_segment(segment_name)
+                            self._trim_segments()
+                        self.segments.move_to_end(segment_name)
+                        buffer = segment.buf
+                    arrays = unpack_arrays(buffer, meta['arrays'])
+                future.set_result(Reply(self, meta.get('result'), arrays, segment_name))
+        except (OSError, ValueError, IPCError) as e:
+            error = IPCError('closed', f"Connection closed: {e}")
+        finally:
+            with self.pending_lock:
+                self.closed = True
+                pending, self.pending = self.pending, {}
+            for future in pending.values():
+                future.set_exception(error)
+
+    def _trim_segments(self):
+        """Unmap the least recently used segments; the server may have unlinked them, and maps again if not."""
+        for name in list(self.segments)[:-SHM_CLIENT_SEGMENTS]:
+            try:
+                self.segments[name].close()
+            except BufferError:
+                # Arrays of an unreleased reply still point into it
+                continue
+            del self.segments[name]
+
+    def close(self):
+        try:
+            self.writer.close()
+        except OSError:
+            pass
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        for segment in self.segments.values():
+            try:
+                segment.close()
+            except BufferError:
+                # Arrays of an unreleased reply still point into it
+                pass
+        self.segments.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,186 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from scripts.scheduler import PREFETCH
+
+
+def idle_cpu_fraction():
+    """Fraction of CPU capacity currently idle (0..1), from the 1 minute load average."""
+    try:
+        load = os.getloadavg()[0]
+    except (AttributeError, OSError):
+        # getloadavg is not available on Windows; assume a half-busy machine
+        return 0.5
+    cpus = os.cpu_count() or 1
+    return max(0.0, min(1.0, 1.0 - load / cpus))
+
+
+class TilePrefetcher:
+    """Predict the tiles a viewer session will ask for next and render them ahead of time.
+
+    Every served tile is reported through `record`. The recent requests of a
+    session at the current level approximate its viewport; from that the
+    prefetcher predicts the next ring of tiles around the viewport (biased in
+    the direction of panning) and the child tiles one level down (zoom in),
+    and renders them into the tile cache as PREFETCH work on the shared
+    scheduler, so they never compete with interactive requests. Predictions
+    of an earlier request that are still predicted keep their place in the
+    queue; only those that dropped out are cancelled. How many tiles are
+    predicted scales with idle CPU.
+    """
+
+    def __init__(self, render_tile, cache, get_levels, scheduler, tile_size=254, max_depth=2,
+                 viewport_window=2.0, history_size=64, max_sessions=256, max_tracked=4096) -> None:
+        self.render_tile = render_tile  # (slide_name, level, x, y, tile_format) -> (data, mimetype) or None
+        self.cache = cache
+        self.get_levels = get_levels  # slide_name -> (level_dimensions, level_downsamples) or None
+        self.scheduler = scheduler
+        self.tile_size = tile_size
+        self.max_depth = max_depth
+        self.viewport_window = viewport_window  # seconds of history treated as one viewport
+        self.history_size = history_size
+        self.max_sessions = max_sessions
+        self.max_tracked = max_tracked
+
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()  # (session_id, slide_name) -> deque of (time, level, x, y)
+        self.pending = {}  # (session_id, slide_name) -> {tile_key: Task} of scheduled predictions
+        self.prefetched = OrderedDict()  # rendered by us and not yet requested
+        self.depth = max_depth
+
+        self.requests = 0
+        self.predicted = 0
+        self.rendered = 0
+        self.hits = 0
+        self.stale = 0
+
+    def record(self, session_id, slide_name, level, x, y, cache_hit, tile_format='jpeg'):
+        """Register a served tile request and schedule predictions for the session, in the same tile format."""
+        levels = self.get_levels(slide_name)
+        tile_key = (slide_name, level, x, y, tile_format)
+        session_key = (session_id, slide_name)
+        with self.lock:
+            self.requests += 1
+            if self.prefetched.pop(tile_key, None) is not None:
+                if cache_hit:
+                    self.hits += 1
+
+            history = self.sessions.pop(session_key, None) or deque(maxlen=self.history_size)
+            history.append((time.monotonic(), level, x, y))
+            self.sessions[session_key] = history
+            while len(self.sessions) > self.max_sessions:
+                old_key, _ = self.sessions.popitem(last=False)
+                self.pending.pop(old_key, None)
+                self.stale += self.scheduler.cancel_group(('prefetch',) + old_key)
+
+            self.depth = int(round(self.max_depth * idle_cpu_fraction()))
+            predictions = []
+            if levels is not None and self.depth > 0:
+                predictions = self.predict(history, levels[0], levels[1], self.depth)
+            wanted = {(slide_name,) + key + (tile_format,) for key in predictions}
+
+            # The session has moved on: keep the predictions that are still wanted, cancel the rest
+            scheduled = self.pending.get(session_key, {})
+            pending = {}
+            dropped = []
+            for candidate, task in scheduled.items():
+                if task.done.is_set():
+                    continue
+                if candidate in wanted:
+                    pending[candidate] = task
+                else:
+                    dropped.append(task)
+            if dropped:
+                self.stale += self.scheduler.cancel_tasks(dropped)
+            group = ('prefetch',) + session_key
+            for key in predictions:
+                candidate = (slide_name,) + key + (tile_format,)
+                if candidate not in pending and candidate not in self.cache:
+                    pending[candidate] = self.scheduler.submit(PREFETCH, self._prefetch, candidate, group=group)
+            if pending:
+                self.pending[session_key] = pending
+            else:
+                self.pending.pop(session_key, None)
+            self.predicted += len(predictions)
+
+    def predict(self, history, level_dimensions, level_downsamples, depth):
+        """Return (level, x, y) keys likely to be requested next, most likely first."""
+        now, level, last_x, last_y = history[-1]
+        recent = [(x, y) for t, lvl, x, y in history if lvl == level and now - t <= self.viewport_window]
+        xs = [p[0] for p in recent]
+        ys = [p[1] for p in recent]
+        x0, x1, y0, y1 = min(xs), max(xs), min(ys), max(ys)
+        center_x, center_y = (x0 + x1) / 2.0, (y0 + y1) / 2.0
+
+        # Panning direction: newest requests relative to the viewport centre
+        newest = recent[-4:]
+        dir_x = sum(p[0] for p in newest) / len(newest) - center_x
+        dir_y = sum(p[1] for p in newest) / len(newest) - center_y
+        norm = math.hypot(dir_x, dir_y)
+        if norm < 0.5:
+            dir_x = dir_y = 0.0
+        else:
+            dir_x, dir_y = dir_x / norm, dir_y / norm
+
+        def in_bounds(lvl, x, y):
+            width, height = level_dimensions[lvl]
+            return 0 <= x <= width // self.tile_size and 0 <= y <= height // self.tile_size
+
+        predictions = []
+        for ring in range(1, depth + 1):
+            ring_tiles = []
+            for x in range(x0 - ring, x1 + ring + 1):
+                for y in range(y0 - ring, y1 + ring + 1):
+                    if x0 - ring < x < x1 + ring and y0 - ring < y < y1 + ring:
+                        continue  # Interior, already covered by an inner ring or the viewport
+                    score = (x - center_x) * dir_x + (y - center_y) * dir_y
+                    if (dir_x or dir_y) and score <= 0:
+                        continue  # Behind the panning direction
+                    if in_bounds(level, x, y):
+                        ring_tiles.append((-score, (level, x, y)))
+            predictions.extend(key for _, key in sorted(ring_tiles))
+
+            if ring == 1 and level > 0:
+                # Zoom in: children one level down, nearest to the latest tile first
+                ratio = level_downsamples[level] / level_downsamples[level - 1]
+                focus_x, focus_y = (last_x + 0.5) * ratio, (last_y + 0.5) * ratio
+                children = []
+                for x in range(int(x0 * ratio), int(math.ceil((x1 + 1) * ratio))):
+                    for y in range(int(y0 * ratio), int(math.ceil((y1 + 1) * ratio))):
+                        if in_bounds(level - 1, x, y):
+                            distance = math.hypot(x + 0.5 - focus_x, y + 0.5 - focus_y)
+                            children.append((distance, (level - 1, x, y)))
+                budget = 4 * depth * depth
+                predictions.extend(key for _, key in sorted(children)[:budget])
+        return predictions
+
+    def _prefetch(self, tile_key):
+        if tile_key in self.cache:
+            return
+        rendered = self.render_tile(*tile_key)
+        if rendered is None:
+            return
+        self.cache.put(tile_key, *rendered)
+        with self.lock:
+            self.rendered += 1
+            self.prefetched[tile_key] = True
+            while len(self.prefetched) > self.max_tracked:
+                self.prefetched.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'predicted': self.predicted,
+                'rendered': self.rendered,
+                'hits': self.hits,
+                'stale': self.stale,
+                'accuracy': self.hits / self.rendered if self.rendered else 0.0,
+                'coverage': self.hits / self.requests if self.requests else 0.0,
+                'depth': self.depth,
+                'maxDepth': self.max_depth,
+                'sessions': len(self.sessions),
+            }
@@ -0,0 +1,207 @@
+import math
+import os
+import struct
+import tempfile
+import zlib
+from io import BytesIO
+
+import numpy as np
+
+EXPORT_TILE = 512  # Output tile edge used when reading the source
+TIFF_TILE = 256
+BAND_BUDGET_BYTES = 4 * EXPORT_TILE * EXPORT_TILE * 3  # Rows kept in memory while streaming PNG
+MAX_JPEG_PIXELS = 64 * 1024 * 1024  # JPEG cannot be streamed, so the whole output is held in memory
+DEFAULT_OBJECTIVE_POWER = 40.0
+
+
+def objective_power(slide):
+    """Scanning magnification of the slide, falling back to 40x when the file does not say."""
+    properties = slide.properties
+    for key in ('openslide.objective-power', 'tiffslide.objective-power', 'aperio.AppMag'):
+        value = properties.get(key)
+        if value not in (None, ''):
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                continue
+    return DEFAULT_OBJECTIVE_POWER
+
+
+def slide_mpp(slide):
+    """Level 0 microns per pixel, or None if unknown."""
+    for key in ('openslide.mpp-x', 'tiffslide.mpp-x'):
+        value = slide.properties.get(key)
+        if value not in (None, ''):
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                continue
+    return None
+
+
+def read_output_region(slide, x0, y0, downsample, out_width, out_height, overlay=None):
+    """Read the level 0 area starting at (x0, y0) that maps to `out_width` x `out_height` output pixels.
+
+    Reads from the best native level for `downsample` and resizes the result,
+    so memory stays proportional to the output size of this one piece.
+    """
+    import cv2
+    level = slide.get_best_level_for_downsample(downsample)
+    level_downsample = slide.level_downsamples[level]
+    src_width = max(1, int(math.ceil(out_width * downsample / level_downsample)))
+    src_height = max(1, int(math.ceil(out_height * downsample / level_downsample)))
+    region = np.asarray(slide.read_region((int(x0), int(y0)), level, (src_width, src_height)).convert('RGB'))
+    if (src_width, src_height) != (out_width, out_height):
+        region = cv2.resize(region, (out_width, out_height), interpolation=cv2.INTER_AREA)
+    if overlay is not None:
+        read_labels, color_for_label = overlay
+        labels = read_labels(x0, y0, out_width * downsample, out_height * downsample, out_width, out_height)
+        if labels is not None:
+            region = burn_overlay(np.array(region), labels, color_for_label)
+    return region
+
+
+def burn_overlay(region, labels, color_for_label):
+    """Draw the outline of every labelled instance onto an RGB region in place."""
+    padded = np.pad(labels, 1, mode='edge')
+    boundary = (labels > 0) & (
+        (padded[1:-1, :-2] != labels) | (padded[1:-1, 2:] != labels) |
+        (padded[:-2, 1:-1] != labels) | (padded[2:, 1:-1] != labels)
+    )
+    if not boundary.any():
+        return region
+    unique_labels, inverse = np.unique(labels[boundary], return_inverse=True)
+    palette = np.array([
+        [int(color_for_label(label)[i:i + 2], 16) for i in (1, 3, 5)] for label in unique_labels
+    ], dtype=np.uint8)
+    region[boundary] = palette[inverse]
+    return region
+
+
+def iter_bands(slide, x, y, downsample, out_width, out_height, overlay=None, checkpoint=None):
+    """Yield the output image as horizontal bands of at most BAND_BUDGET_BYTES.
+
+    `checkpoint` is called before every source read; it may raise to abort the export.
+    """
+    band_height = max(16, min(EXPORT_TILE, BAND_BUDGET_BYTES // (out_width * 3)))
+    for band_y in range(0, out_height, band_height):
+        rows = min(band_height, out_height - band_y)
+        band = np.empty((rows, out_width, 3), dtype=np.uint8)
+        for band_x in range(0, out_width, EXPORT_TILE):
+            if checkpoint is not None:
+                checkpoint()
+            columns = min(EXPORT_TILE, out_width - band_x)
+            band[:, band_x:band_x + columns] = read_output_region(
+                slide, x + band_x * downsample, y + band_y * downsample, downsample, columns, rows, overlay)
+        yield band
+
+
+def _png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def stream_png(width, height, bands, compress_level=6):
+    """Encode RGB bands as a PNG, yielding bytes as each band is compressed."""
+    yield b'\x89PNG\r\n\x1a\n'
+    yield _png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+    compressor = zlib.compressobj(compress_level)
+    for band in bands:
+        rows = band.reshape(band.shape[0], -1)
+        # PNG "Sub" filter: each byte minus the same channel of the pixel to its left
+        filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = 1
+        filtered[:, 1:4] = rows[:, :3]
+        filtered[:, 4:] = rows[:, 3:] - rows[:, :-3]
+        data = compressor.compress(filtered.tobytes())
+        if data:
+            yield _png_chunk(b'IDAT', data)
+    yield _png_chunk(b'IDAT', compressor.flush())
+    yield _png_chunk(b'IEND', b'')
+
+
+def encode_jpeg(width, height, bands, quality=90):
+    """Assemble the bands and encode them as one JPEG."""
+    from PIL import Image
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    row = 0
+    for band in bands:
+        image[row:row + band.shape[0]] = band
+        row += band.shape[0]
+    output = BytesIO()
+    Image.fromarray(image).save(output, format='JPEG', quality=quality)
+    return output.getvalue()
+
+
+def write_pyramidal_tiff(path, slide, x, y, downsample, out_width, out_height, overlay=None, checkpoint=None):
+    """Write the region as a tiled pyramidal TIFF, one tile at a time.
+
+    Every pyramid level halves the previous one and is read from the slide's
+    best native level for that resolution rather than from the level above,
+    so only one tile is ever held in memory.
+    """
+    import tifffile
+    try:
+        import imagecodecs  # noqa: F401
+        compression = 'jpeg'
+    except ImportError:
+        compression = 'zlib'
+
+    levels = [1]
+    while max(out_width, out_height) // (levels[-1] * 2) >= TIFF_TILE:
+        levels.append(levels[-1] * 2)
+
+    def tiles(factor, level_width, level_height):
+        level_downsample = downsample * factor
+        for tile_y in range(0, level_height, TIFF_TILE):
+            for tile_x in range(0, level_width, TIFF_TILE):
+                if checkpoint is not None:
+                    checkpoint()
+                tile = np.zeros((TIFF_TILE, TIFF_TILE, 3), dtype=np.uint8)
+                columns = min(TIFF_TILE, level_width - tile_x)
+                rows = min(TIFF_TILE, level_height - tile_y)
+                tile[:rows, :columns] = read_output_region(
+                    slide, x + tile_x * level_downsample, y + tile_y * level_downsample,
+                    level_downsample, columns, rows, overlay)
+                yield tile
+
+    mpp = slide_mpp(slide)
+    with tifffile.TiffWriter(path, bigtiff=True) as tif:
+        for i, factor in enumerate(levels):
+            level_width = max(1, out_width // factor)
+            level_height = max(1, out_height // factor)
+            options = {}
+            if mpp:
+                options['resolution'] = (1e4 / (mpp * downsample * factor),) * 2
+                options['resolutionunit'] = 'CENTIMETER'
+            tif.write(
+                tiles(factor, level_width, level_height),
+                shape=(level_height, level_width, 3),
+                dtype=np.uint8,
+                tile=(TIFF_TILE, TIFF_TILE),
+                photometric='rgb',
+                compression=compression,
+                subifds=len(levels) - 1 if i == 0 else None,
+                subfiletype=1 if i > 0 else 0,
+                metadata=None,
+                **options
+            )
+
+
+def stream_file(path, chunk_size=1024 * 1024, remove=True):
+    """Yield a file in chunks, deleting it afterwards (also if the client goes away)."""
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        if remove:
+            os.remove(path)
+
+
+def temporary_tiff_path():
+    handle, path = tempfile.mkstemp(suffix='.tiff', prefix='wsi-export-')
+    os.close(handle)
+    return path
@@ -0,0 +1,356 @@
+import heapq
+import inspect
+import itertools
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Priority classes, most urgent first
+INTERACTIVE = 0
+PREFETCH = 1
+BATCH = 2
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', PREFETCH: 'prefetch', BATCH: 'batch'}
+DEFAULT_LIMITS = {INTERACTIVE: 8, PREFETCH: 2, BATCH: 1}
+
+
+class CancelledError(Exception):
+    """Raised when work is cancelled before or while it runs."""
+
+
+class DuplicateRequestError(Exception):
+    """Raised when a request ID is submitted while another request with that ID is queued or running."""
+
+
+class Task:
+    """One unit of scheduled work, identified by a client-visible request ID."""
+
+    def __init__(self, priority, fn, args, kwargs, request_id, group, in_caller) -> None:
+        self.priority = priority
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.request_id = request_id or uuid.uuid4().hex
+        self.group = group
+        self.in_caller = in_caller  # Runs in the submitting thread rather than on a worker
+        self.status = 'queued'
+        self.progress = None
+        self.result = None
+        self.error = None
+        self.generator = None
+        self.preemptions = 0
+        self.seq = None
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+
+    def check(self):
+        """Raise CancelledError if the task has been cancelled; call this between work chunks."""
+        if self.cancelled.is_set():
+            raise CancelledError(f"Request {self.request_id} was cancelled")
+
+    def wait(self, timeout=None):
+        """Block until the task finishes and return its result."""
+        if not self.done.wait(timeout):
+            raise TimeoutError(f"Request {self.request_id} did not finish in {timeout}s")
+        if self.status == 'cancelled':
+            raise CancelledError(f"Request {self.request_id} was cancelled")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def info(self):
+        return {
+            'requestId': self.request_id,
+            'priority': PRIORITY_NAMES[self.priority],
+            'status': self.status,
+            'progress': self.progress,
+            'preemptions': self.preemptions,
+            'error': str(self.error) if self.error is not None else None,
+        }
+
+
+class WorkScheduler:
+    """Shared work scheduler with strict priority classes.
+
+    Interactive requests run in the calling request thread once they get a
+    slot (`slot`); prefetch and batch work run on the scheduler's workers
+    (`submit`). A task only starts when no higher-priority work is queued or
+    running and its class is under its concurrency limit. Batch work written
+    as a generator yields at tile-batch boundaries; at each yield it is
+    requeued if higher-priority work is waiting or running, and it stops there
+    when cancelled. Queued work can be cancelled by request ID or by group
+    (for example the viewport or session the request belongs to).
+    """
+
+    def __init__(self, limits=None, history_size=256) -> None:
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(limits or {})
+        self.cond = threading.Condition()
+        self.queue = []  # heap of (priority, seq, task); cancelled tasks stay until popped
+        self.dead = 0  # cancelled entries still in the heap
+        self.seq = itertools.count()
+        self.running = {priority: 0 for priority in self.limits}
+        self.queued = {priority: 0 for priority in self.limits}
+        self.tasks = {}  # request_id -> queued or running task
+        self.groups = {}  # group -> set of request IDs
+        self.history = OrderedDict()  # request_id -> finished task
+        self.history_size = history_size
+        self.completed = {priority: 0 for priority in self.limits}
+        self.cancelled = {priority: 0 for priority in self.limits}
+        self.workers = []
+        # Interactive work runs in the caller's thread, so only prefetch and batch work needs workers
+        for i in range(sum(limit for priority, limit in self.limits.items() if priority != INTERACTIVE)):
+            worker = threading.Thread(target=self._worker, name=f'scheduler-{i}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def _enqueue(self, task):
+        if task.seq is None:
+            task.seq = next(self.seq)
+        # A preempted task keeps its original sequence number and so resumes ahead of newer work
+        heapq.heappush(self.queue, (task.priority, task.seq, task))
+        self.queued[task.priority] += 1
+        self.cond.notify_all()
+
+    def _cancel_tasks(self, tasks):
+        """Flag tasks as cancelled; queued ones are finished right away.
+
+        Their heap entries are left in place and dropped when they reach the
+        top (or when dead entries outnumber live ones), so cancelling does not
+        rebuild the heap.
+        """
+        cancelled = 0
+        for task in tasks:
+            if task.done.is_set():
+                continue
+            cancelled += 1
+            task.cancelled.set()
+            if task.status == 'queued':
+                self.queued[task.priority] -= 1
+                self.dead += 1
+                self._finish(task, 'cancelled')
+        if self.dead > len(self.queue) // 2:
+            self.queue = [entry for entry in self.queue if entry[2].status == 'queued']
+            heapq.heapify(self.queue)
+            self.dead = 0
+        self.cond.notify_all()
+        return cancelled
+
+    def _register(self, task):
+        # Request IDs name a task for `cancel` and `get_task`, so two live tasks may not share one
+        if task.request_id in self.tasks:
+            raise DuplicateRequestError(f"Request {task.request_id} is already queued or running")
+        self.tasks[task.request_id] = task
+        if task.group is not None:
+            self.groups.setdefault(task.group, set()).add(task.request_id)
+
+    def _can_start(self, priority):
+        if self.running[priority] >= self.limits[priority]:
+            return False
+        return not any(self.running[p] or self.queued[p] for p in self.limits if p < priority)
+
+    def _head(self):
+        while self.queue and self.queue[0][2].status != 'queued':
+            heapq.heappop(self.queue)
+            self.dead -= 1
+        return self.queue[0][2] if self.queue else None
+
+    def _start(self, task):
+        heapq.heappop(self.queue)
+        self.queued[task.priority] -= 1
+        self.running[task.priority] += 1
+        task.status = 'running'
+        if task.started_at is None:
+            task.started_at = time.monotonic()
+        # Waiters only look at the queue head when notified: wake the next head in case it can start too
+        self.cond.notify_all()
+
+    def _finish(self, task, status):
+        task.status = status
+        task.finished_at = time.monotonic()
+        if status == 'cancelled':
+            self.cancelled[task.priority] += 1
+        else:
+            self.completed[task.priority] += 1
+        self.tasks.pop(task.request_id, None)
+        if task.group is not None:
+            members = self.groups.get(task.group)
+            if members is not None:
+                members.discard(task.request_id)
+                if not members:
+                    del self.groups[task.group]
+        self.history[task.request_id] = task
+        while len(self.history) > self.history_size:
+            self.history.popitem(last=False)
+        task.done.set()
+        self.cond.notify_all()
+
+    def submit(self, priority, fn, *args, request_id=None, group=None, **kwargs):
+        """Queue `fn(*args, **kwargs)` to run on a worker and return its Task.
+
+        If `fn` returns a generator, every `yield` marks a preemption point and
+        the yielded value is published as the task's progress.
+        """
+        task = Task(priority, fn, args, kwargs, request_id, group, in_caller=False)
+        with self.cond:
+            self._register(task)
+            self._enqueue(task)
+        return task
+
+    def run(self, priority, fn, *args, request_id=None, group=None, timeout=None, **kwargs):
+        """Submit `fn` and wait for its result."""
+        return self.submit(priority, fn, *args, request_id=request_id, group=group, **kwargs).wait(timeout)
+
+    @contextmanager
+    def slot(self, priority=INTERACTIVE, request_id=None, group=None):
+        """Run the body of the `with` block in the calling thread once the scheduler admits it.
+
+        Yields the Task so the body can call `task.check()` (or `checkpoint(task)`
+        for long work that should also step aside for higher-priority work)
+        between chunks of work. Raises CancelledError if the request is
+        cancelled while it waits.
+        """
+        task = Task(priority, None, (), {}, request_id, group, in_caller=True)
+        with self.cond:
+            self._register(task)
+            self._enqueue(task)
+            self._wait_for_start(task)
+        status = 'done'
+        try:
+            yield task
+        except (CancelledError, GeneratorExit):
+            # GeneratorExit: a streaming response whose client went away
+            status = 'cancelled'
+            raise
+        except BaseException as e:
+            task.error = e
+            status = 'failed'
+            raise
+        finally:
+            with self.cond:
+                # A task cancelled while requeued by `checkpoint` has already been finished
+                if task.status == 'running':
+                    self.running[priority] -= 1
+                    self._finish(task, status)
+
+    def _wait_for_start(self, task):
+        """Block (holding `cond`) until an in-caller task may run."""
+        while True:
+            if task.cancelled.is_set():
+                raise CancelledError(f"Request {task.request_id} was cancelled")
+            if self._head() is task and self._can_start(task.priority):
+                self._start(task)
+                return
+            self.cond.wait()
+
+    def checkpoint(self, task):
+        """Preemption point for work running inside `slot`.
+
+        Raises CancelledError if the task was cancelled. If higher-priority
+        work is queued or running, gives up the slot and waits to be admitted
+        again before returning.
+        """
+        task.check()
+        with self.cond:
+            if not self._higher_priority_pending(task.priority):
+                return
+            self.running[task.priority] -= 1
+            task.status = 'queued'
+            task.preemptions += 1
+            self._enqueue(task)
+            self._wait_for_start(task)
+
+    def cancel(self, request_id):
+        """Cancel a queued or running request; returns True if it was known."""
+        with self.cond:
+            task = self.tasks.get(request_id)
+            if task is None:
+                return False
+            self._cancel_tasks([task])
+            return True
+
+    def cancel_tasks(self, tasks):
+        """Cancel the given Tasks (as returned by `submit`); returns how many had not finished yet."""
+        with self.cond:
+            return self._cancel_tasks(tasks)
+
+    def cancel_group(self, group):
+        """Cancel every queued or running request of a group; returns how many were cancelled."""
+        with self.cond:
+            tasks = [self.tasks[request_id] for request_id in self.groups.get(group, ())]
+            return self._cancel_tasks(tasks)
+
+    def get_task(self, request_id):
+        with self.cond:
+            return self.tasks.get(request_id) or self.history.get(request_id)
+
+    def _higher_priority_pending(self, priority):
+        return any(self.running[p] or self.queued[p] for p in self.limits if p < priority)
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while True:
+                    task = self._head()
+                    if task is not None and not task.in_caller and self._can_start(task.priority):
+                        self._start(task)
+                        break
+                    self.cond.wait()
+            status = self._step(task)
+            with self.cond:
+                self.running[task.priority] -= 1
+                if status == 'preempted':
+                    task.status = 'queued'
+                    task.preemptions += 1
+                    self._enqueue(task)
+                else:
+                    self._finish(task, status)
+
+    def _step(self, task):
+        """Run a worker task until it finishes, fails, is cancelled or must yield."""
+        try:
+            if task.generator is None:
+                task.check()
+                result = task.fn(*task.args, **task.kwargs)
+                if not inspect.isgenerator(result):
+                    task.result = result
+                    return 'done'
+                task.generator = result
+            while True:
+                task.check()
+                try:
+                    task.progress = next(task.generator)
+                except StopIteration as stop:
+                    task.result = stop.value
+                    return 'done'
+                if task.cancelled.is_set():
+                    task.generator.close()
+                    return 'cancelled'
+                with self.cond:
+                    if self._higher_priority_pending(task.priority):
+                        return 'preempted'
+        except CancelledError:
+            if task.generator is not None:
+                task.generator.close()
+            return 'cancelled'
+        except Exception as e:
+            print(f"Error in {PRIORITY_NAMES[task.priority]} task {task.request_id}: {e}")
+            task.error = e
+            return 'failed'
+
+    def stats(self):
+        with self.cond:
+            return {
+                PRIORITY_NAMES[priority]: {
+                    'limit': self.limits[priority],
+                    'running': self.running[priority],
+                    'queued': self.queued[priority],
+                    'completed': self.completed[priority],
+                    'cancelled': self.cancelled[priority],
+                }
+                for priority in self.limits
+            }
@@ -0,0 +1,415 @@
+import hashlib
+import os
+import pickle
+import struct
+import tempfile
+import threading
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+MAGIC = b'WSICACHE'
+LAYOUT_VERSION = 1
+# magic, layout version, ways per bucket, bucket count, arena offset, arena size,
+# head, tail (logical arena positions), inserts, evictions, reinserted
+HEADER = struct.Struct('<8sIIQQQQQQQQ')
+HEADER_BYTES = 128
+HEAD_OFFSET = 40  # Offsets of head and tail within the header
+TAIL_OFFSET = 48
+COUNTERS_OFFSET = 56
+
+MAX_WORKERS = 64  # One bit each in an entry's reader mask
+WORKER = struct.Struct('<QQQ')  # pid, hits, misses
+WORKERS_OFFSET = HEADER_BYTES
+
+WAYS = 8
+# seq (odd while the entry is being changed), reference bit, payload size, reader mask, record position, key digest
+ENTRY = struct.Struct('<IB3xI4xQQ16s')
+ENTRY_DTYPE = np.dtype([('seq', '<u4'), ('ref', 'u1'), ('_pad', 'V3'), ('size', '<u4'), ('_pad2', 'V4'),
+                        ('readers', '<u8'), ('offset', '<u8'), ('digest', '<u8', (2,))])
+SEQ = struct.Struct('<I')
+READERS_OFFSET = 16
+EMPTY_DIGEST = bytes(16)
+
+# key digest, record length (8 byte aligned), payload length, mimetype length
+RECORD = struct.Struct('<16sIIH6x')
+AVERAGE_ENTRY_BYTES = 8 * 1024  # Sizes the index: one entry per 8 KB of arena
+
+
+def key_digest(key):
+    """Digest of a cache key; keys are tuples of str and numbers, whose repr is the same in every process."""
+    return hashlib.blake2b(repr(key).encode('utf-8'), digest_size=16).digest()
+
+
+def _segment(name, create=False, size=0):
+    """Open (or create) a segment that outlives this process: no resource tracker unlinks it on exit."""
+    try:
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    except TypeError:  # Python < 3.13
+        segment = shared_memory.SharedMemory(name=name, create=create, size=size)
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
+
+
+def lock_path(name):
+    return os.path.join(tempfile.gettempdir(), f'{name}.lock')
+
+
+def remove(name):
+    """Unlink a shared cache segment (and its lock file); processes still attached keep their mapping."""
+    try:
+        segment = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return False
+    segment.close()
+    segment.unlink()
+    try:
+        os.remove(lock_path(name))
+    except OSError:
+        pass
+    return True
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedTileCache:
+    """Cache of encoded tiles (or pickled query results) in a named shared memory segment.
+
+    Every process that opens a cache with the same `name` sees the same
+    entries, so worker processes of one server hold each tile once instead of
+    once per process. The segment holds a bucketed hash index (`WAYS` entries
+    per bucket, keyed by a digest of the key) and a ring-shaped arena of
+    records. Writers append at the tail under a cross-process file lock and
+    make room by advancing the head with CLOCK (second chance) eviction: a
+    record that was read since the head last passed it is copied to the tail
+    instead of dropped. Reads take no lock; each index entry carries a
+    sequence number that writers make odd while they change or overwrite it,
+    and a read that sees it change is a miss.
+
+    Same interface as TileCache (`get`, `put`, `in`, `stats`). The segment
+    outlives the processes that use it; `remove(name)` unlinks it.
+    """
+
+    def __init__(self, name, max_bytes=256 * 1024 * 1024, pickled=False) -> None:
+        if fcntl is None:
+            raise RuntimeError("The shared tile cache needs fcntl, which is not available on this platform")
+        self.name = name
+        self.pickled = pickled
+        self.pid = None
+        self._open_lock()
+        with self._write_lock():
+            try:
+                self.segment = _segment(name)
+            except FileNotFoundError:
+                self.segment = self._create(name, max_bytes)
+        self.buf = self.segment.buf
+        magic, version, ways, self.bucket_count, self.arena_offset, self.arena_size = \
+            HEADER.unpack_from(self.buf, 0)[:6]
+        if magic != MAGIC or version != LAYOUT_VERSION or ways != WAYS:
+            raise RuntimeError(f"Shared memory segment {name!r} is not a tile cache of this version; remove it first")
+        self.index_offset = WORKERS_OFFSET + MAX_WORKERS * WORKER.size
+        self.reinsert = []
+        self._register_worker()
+
+    @staticmethod
+    def _create(name, max_bytes):
+        arena_size = max(1024 * 1024, max_bytes) // 8 * 8
+        bucket_count = 1 << max(3, (arena_size // (AVERAGE_ENTRY_BYTES * WAYS)).bit_length())
+        index_offset = WORKERS_OFFSET + MAX_WORKERS * WORKER.size
+        arena_offset = (index_offset + bucket_count * WAYS * ENTRY.size + 4095) // 4096 * 4096
+        segment = _segment(name, create=True, size=arena_offset + arena_size)
+        HEADER.pack_into(segment.buf, 0, MAGIC, LAYOUT_VERSION, WAYS, bucket_count, arena_offset, arena_size,
+                         0, 0, 0, 0, 0)
+        return segment
+
+    def _open_lock(self):
+        self.thread_lock = threading.Lock()
+        self.lock_file = open(lock_path(self.name), 'a+b')
+
+    @contextmanager
+    def _write_lock(self):
+        """Exclusive across threads (thread lock) and processes (flock on the lock file)."""
+        with self.thread_lock:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _register_worker(self):
+        """Claim a worker slot (and its reader bit); slots of processes that exited are reused."""
+        if self.pid is not None:
+            # Forked from a process that had the cache open: the flock and thread lock must not be shared
+            self.lock_file.close()
+            self._open_lock()
+        self.pid = os.getpid()
+        self.bit = 0
+        self.hits = 0
+        self.misses = 0
+        with self._write_lock():
+            free = None
+            for slot in range(MAX_WORKERS):
+                pid = WORKER.unpack_from(self.buf, WORKERS_OFFSET + slot * WORKER.size)[0]
+                if pid == self.pid or (free is None and (pid == 0 or not _pid_alive(pid))):
+                    free = slot
+                    if pid == self.pid:
+                        break
+            if free is None:
+                self.slot = None  # More processes than reader bits: still works, without per-worker stats
+                return
+            self.slot = free
+            self.bit = 1 << free
+            WORKER.pack_into(self.buf, WORKERS_OFFSET + free * WORKER.size, self.pid, 0, 0)
+            entries = self._entries()
+            entries['readers'] &= np.uint64(~self.bit & 0xFFFFFFFFFFFFFFFF)
+            del entries
+
+    def _entries(self):
+        return np.frombuffer(self.buf, dtype=ENTRY_DTYPE, count=self.bucket_count * WAYS, offset=self.index_offset)
+
+    def _count(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if self.slot is not None:
+            WORKER.pack_into(self.buf, WORKERS_OFFSET + self.slot * WORKER.size, self.pid, self.hits, self.misses)
+
+    def _bucket(self, digest):
+        bucket = int.from_bytes(digest[:8], 'little') & (self.bucket_count - 1)
+        return self.index_offset + bucket * WAYS * ENTRY.size
+
+    def _find(self, digest):
+        """Offset of the index entry holding `digest`, or None."""
+        base = self._bucket(digest)
+        for way in range(WAYS):
+            entry = base + way * ENTRY.size
+            if self.buf[entry + 32:entry + 48] == digest:
+                return entry
+        return None
+
+    def get(self, key):
+        """Return the cached (data, mimetype) tuple for `key`, or None."""
+        if os.getpid() != self.pid:
+            self._register_worker()
+        digest = key_digest(key)
+        entry = self._find(digest)
+        found = None
+        if entry is not None:
+            seq, _, size, readers, position, entry_digest = ENTRY.unpack_from(self.buf, entry)
+            if not seq & 1 and entry_digest == digest:
+                found = self._read(position, digest)
+                # A writer changed the entry (or reused the record's space) while we were copying
+                if found is not None and SEQ.unpack_from(self.buf, entry)[0] != seq:
+                    found = None
+            if found is not None:
+                found = self._decode(*found)
+            if found is not None:
+                self.buf[entry + 4] = 1
+                if self.bit and not readers & self.bit:
+                    # Racy, but only feeds the memory-saved statistics
+                    struct.pack_into('<Q', self.buf, entry + READERS_OFFSET, readers | self.bit)
+        self._count(found is not None)
+        return found
+
+    def _decode(self, data, mime):
+        """(value, mimetype) from a record's copied bytes, or None if they do not decode.
+
+        Only called once the copy is known to be consistent, but a torn or
+        foreign record must still be a miss rather than an exception.
+        """
+        try:
+            return (pickle.loads(data) if self.pickled else data), mime.decode('utf-8') or None
+        except Exception:
+            return None
+
+    def _read(self, position, digest):
+        """Raw (data, mimetype) bytes of the record at `position`, or None; the caller checks they are still valid."""
+        physical = position % self.arena_size
+        if physical + RECORD.size > self.arena_size:
+            return None
+        start = self.arena_offset + physical
+        record_digest, length, data_length, mime_length = RECORD.unpack_from(self.buf, start)
+        if record_digest != digest or physical + length > self.arena_size \
+                or RECORD.size + mime_length + data_length > length:
+            return None
+        start += RECORD.size
+        mime = bytes(self.buf[start:start + mime_length])
+        start += mime_length
+        return bytes(self.buf[start:start + data_length]), mime
+
+    def __contains__(self, key):
+        entry = self._find(key_digest(key))
+        return entry is not None and not SEQ.unpack_from(self.buf, entry)[0] & 1
+
+    def put(self, key, data, mimetype, size=None):
+        """Cache `data` under `key`; `size` is ignored, the cache counts the bytes it stores."""
+        if os.getpid() != self.pid:
+            self._register_worker()
+        if self.pickled:
+            data = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        mime = (mimetype or '').encode('utf-8')
+        digest = key_digest(key)
+        length = (RECORD.size + len(mime) + len(data) + 7) // 8 * 8
+        if length > self.arena_size // 4:
+            return
+        record = bytearray(length)
+        RECORD.pack_into(record, 0, digest, length, len(data), len(mime))
+        record[RECORD.size:RECORD.size + len(mime)] = mime
+        record[RECORD.size + len(mime):RECORD.size + len(mime) + len(data)] = data
+
+        with self._write_lock():
+            existing = self._find(digest)
+            if existing is not None:
+                # The old record is dead from now on; the head drops it when it gets there
+                self._clear_entry(existing)
+            position = self._append(record)
+            entry = self._claim_entry(digest)
+            if entry is not None:
+                self._set_entry(entry, digest, position, len(data), self.bit)
+                self._add_counter(0)
+            # Records the head passed while they were still being read go back in at the tail
+            while self.reinsert:
+                entry, kept = self.reinsert.pop(0)
+                seq, _, kept_size, readers, _, kept_digest = ENTRY.unpack_from(self.buf, entry)
+                self._set_entry(entry, kept_digest, self._append(kept), kept_size, readers, ref=0)
+                self._add_counter(2)
+
+    def _append(self, record):
+        """Write `record` at the tail, advancing the head until it fits; returns its position."""
+        length = len(record)
+        while True:
+            head, tail = self._position(HEAD_OFFSET), self._position(TAIL_OFFSET)
+            physical = tail % self.arena_size
+            wrap = self.arena_size - physical if physical + length > self.arena_size else 0
+            if self.arena_size - (tail - head) >= wrap + length:
+                break
+            self._advance_head(head)
+        if wrap:
+            if wrap >= RECORD.size:
+                RECORD.pack_into(self.buf, self.arena_offset + physical, EMPTY_DIGEST, wrap, 0, 0)
+            tail += wrap
+        start = self.arena_offset + tail % self.arena_size
+        self.buf[start:start + length] = record
+        struct.pack_into('<Q', self.buf, TAIL_OFFSET, tail + length)
+        return tail
+
+    def _advance_head(self, head):
+        """Free the record at the head: drop it, or keep it for reinsertion if it was read since the last pass."""
+        physical = head % self.arena_size
+        if self.arena_size - physical < RECORD.size:
+            struct.pack_into('<Q', self.buf, HEAD_OFFSET, head + self.arena_size - physical)
+            return
+        start = self.arena_offset + physical
+        digest, length = RECORD.unpack_from(self.buf, start)[:2]
+        if digest != EMPTY_DIGEST:
+            entry = self._find(digest)
+            if entry is not None:
+                seq, ref, _, _, position, _ = ENTRY.unpack_from(self.buf, entry)
+                if position == head and not seq & 1:
+                    if ref:
+                        # Second chance: hide the entry until the record is written again at the tail
+                        SEQ.pack_into(self.buf, entry, seq + 1)
+                        self.reinsert.append((entry, bytes(self.buf[start:start + length])))
+                    else:
+                        self._clear_entry(entry)
+                        self._add_counter(1)
+        struct.pack_into('<Q', self.buf, HEAD_OFFSET, head + length)
+
+    def _claim_entry(self, digest):
+        """Free index entry in the bucket of `digest`, evicting the bucket's CLOCK victim if it is full."""
+        base = self._bucket(digest)
+        victim = None
+        for way in range(WAYS):
+            entry = base + way * ENTRY.size
+            seq, ref, _, _, _, entry_digest = ENTRY.unpack_from(self.buf, entry)
+            if seq & 1:
+                continue
+            if entry_digest == EMPTY_DIGEST:
+                return entry
+            if victim is None and not ref:
+                victim = entry
+        if victim is None:
+            for way in range(WAYS):
+                entry = base + way * ENTRY.size
+                if not SEQ.unpack_from(self.buf, entry)[0] & 1:
+                    self.buf[entry + 4] = 0
+                    victim = victim or entry
+        if victim is not None:
+            self._clear_entry(victim)
+            self._add_counter(1)
+        return victim
+
+    def _set_entry(self, entry, digest, position, size, readers, ref=0):
+        seq = SEQ.unpack_from(self.buf, entry)[0] | 1
+        SEQ.pack_into(self.buf, entry, seq)
+        ENTRY.pack_into(self.buf, entry, seq, ref, size, readers, position, digest)
+        SEQ.pack_into(self.buf, entry, seq + 1)
+
+    def _clear_entry(self, entry):
+        self._set_entry(entry, EMPTY_DIGEST, 0, 0, 0)
+
+    def _position(self, offset):
+        return struct.unpack_from('<Q', self.buf, offset)[0]
+
+    def _add_counter(self, index):
+        offset = COUNTERS_OFFSET + 8 * index
+        struct.pack_into('<Q', self.buf, offset, self._position(offset) + 1)
+
+    def stats(self):
+        workers = []
+        live_mask = 0
+        for slot in range(MAX_WORKERS):
+            pid, hits, misses = WORKER.unpack_from(self.buf, WORKERS_OFFSET + slot * WORKER.size)
+            if pid and _pid_alive(pid):
+                workers.append({'pid': pid, 'hits': hits, 'misses': misses})
+                live_mask |= 1 << slot
+        entries = self._entries()
+        live = entries[(entries['digest'] != 0).any(axis=1) & (entries['seq'] & 1 == 0)]
+        shared_bytes = int(live['size'].sum(dtype=np.uint64))
+        # What per-process caches would hold: every worker that read an entry keeps its own copy
+        masks = (live['readers'] & np.uint64(live_mask)).astype('<u8')
+        copies = np.unpackbits(masks.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1).astype(np.uint64)
+        per_process_bytes = int((live['size'].astype(np.uint64) * np.maximum(copies, 1)).sum())
+        count = len(live)
+        del entries, live, copies
+        head, tail = self._position(HEAD_OFFSET), self._position(TAIL_OFFSET)
+        inserts, evictions, reinserted = struct.unpack_from('<QQQ', self.buf, COUNTERS_OFFSET)
+        hits = sum(worker['hits'] for worker in workers)
+        misses = sum(worker['misses'] for worker in workers)
+        return {
+            'shared': True,
+            'name': self.name,
+            'entries': count,
+            'bytes': shared_bytes,
+            'arenaBytes': tail - head,
+            'maxBytes': self.arena_size,
+            'hits': hits,
+            'misses': misses,
+            'hitRate': hits / (hits + misses) if hits + misses else 0.0,
+            'inserts': inserts,
+            'evictions': evictions,
+            'reinserted': reinserted,
+            'workers': workers,
+            'perProcessBytes': per_process_bytes,
+            'savedBytes': per_process_bytes - shared_bytes,
+        }
+
+    def close(self):
+        self.buf = None
+        self.segment.close()
+        self.lock_file.close()
@@ -0,0 +1,58 @@
+import threading
+from collections import OrderedDict
+
+
+class TileCache:
+    """Thread-safe LRU cache of encoded tiles, bounded by total payload bytes."""
+
+    def __init__(self, max_bytes=256 * 1024 * 1024) -> None:
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the cached (data, mimetype) tuple for `key`, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def put(self, key, data, mimetype, size=None):
+        """Cache `data` under `key`; `size` is its cost in bytes, `len(data)` by default."""
+        size = len(data) if size is None else size
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+                self.current_bytes -= self.sizes.pop(key)
+            self.entries[key] = (data, mimetype)
+            self.sizes[key] = size
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                evicted, _ = self.entries.popitem(last=False)
+                self.current_bytes -= self.sizes.pop(evicted)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'maxBytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': self.hits / total if total else 0.0,
+            }
@@ -1,33 +1,54 @@
-from flask import Flask, send_file, abort, request, jsonify
+from flask import Flask, Response, send_file, abort, request, jsonify
 import os
 import sys
+import math
+import threading
+import importlib.util
+from contextlib import contextmanager
 from io import BytesIO
 from flask_cors import CORS
 import logging
 import numpy as np
 import json
 import time
-from scripts.tile_post_process import PostProcess
-from PIL import Image
-import h5py
-import cv2
-from scipy import ndimage
-
-# Try to import openslide first (more widely used), fall back to tiffslide
-try:
-    import openslide
-    from openslide import OpenSlide as WSISlide
-    print("Using OpenSlide for WSI handling")
-except ImportError:
-    try:
-        import tiffslide
-        from tiffslide import TiffSlide as WSISlide
-        print("Using TiffSlide for WSI handling")
-    except ImportError:
-        print("ERROR: Neither OpenSlide nor TiffSlide is installed. Please install one of them.")
-        print("You can install OpenSlide with: pip install openslide-python")
-        print("Or TiffSlide with: pip install tiffslide")
-        sys.exit(1)
+from scripts.tile_cache import TileCache
+from scripts.density import DensityMaps, DENSITY_SUFFIX, META_FILE, build_density, find_class_source
+from scripts.instance_index import InstanceIndex, polygon_area, polygon_digest
+from scripts.shared_cache import SharedTileCache
+from scripts.tile_encoder import TileEncoder, TILE_FORMATS, FALLBACK_FORMAT, encode_placeholder, format_supported
+from scripts.prefetch import TilePrefetcher
+from scripts.scheduler import WorkScheduler, CancelledError, DuplicateRequestError, INTERACTIVE, PREFETCH, BATCH
+from scripts.region_export import (
+    MAX_JPEG_PIXELS, objective_power, iter_bands, stream_png, encode_jpeg,
+    write_pyramidal_tiff, stream_file, temporary_tiff_path
+)
+
+# The slide reader (OpenSlide or TiffSlide), h5py, OpenCV and PIL are imported on first use,
+# so the server answers /api/health right away; /api/ready reports when the slide reader is loaded
+SLIDE_BACKENDS = [('openslide', 'OpenSlide'), ('tiffslide', 'TiffSlide')]
+WSISlide = None
+slide_backend_lock = threading.Lock()
+
+def load_slide_backend():
+    """Import OpenSlide if available, otherwise TiffSlide, and return its slide class"""
+    global WSISlide
+    with slide_backend_lock:
+        if WSISlide is None:
+            for module_name, class_name in SLIDE_BACKENDS:
+                try:
+                    module = importlib.import_module(module_name)
+                except ImportError:
+                    continue
+                print(f"Using {class_name} for WSI handling")
+                WSISlide = getattr(module, class_name)
+                break
+            else:
+                raise RuntimeError("Neither OpenSlide nor TiffSlide is installed")
+    return WSISlide
+
+def open_wsi(file_path):
+    """Open a slide file with the slide reader, loading the reader on first use"""
+    return (WSISlide or load_slide_backend())(file_path)
 
 # Create Flask app
 app = Flask(__name__)
@@ -37,9 +58,39 @@ log = logging.getLogger('werkzeug')
 log.setLevel(logging.INFO)
 
 # Configuration
-SLIDE_DIR = os.path.dirname(os.path.abspath(__file__))
+SLIDE_DIR = os.environ.get('WSI_SLIDE_DIR', os.path.dirname(os.path.abspath(__file__)))
 ALLOWED_EXTENSIONS = {'svs', 'tif', 'tiff', 'ndpi', 'mrxs'}
-PORT = 5050  # Different from the default 5000 used by the other sample
+PORT = int(os.environ.get('WSI_BACKEND_PORT', 5050))  # Different from the default 5000 used by the other sample
+DEBUG = os.environ.get('WSI_BACKEND_DEBUG', '1') != '0'
+TILE_SIZE = 254
+TILE_CACHE_MB = int(os.environ.get('WSI_TILE_CACHE_MB', 256))
+# Tile formats offered to clients that accept them, most preferred first; JPEG is the fallback for everyone else
+TILE_FORMAT_PREFERENCE = [name.strip() for name in os.environ.get('WSI_TILE_FORMATS', 'webp,jpeg').split(',') if name.strip()]
+# Per-level encoder quality, e.g. WSI_TILE_QUALITY_JPEG=90,85,80 (level 0, 1, 2 and above)
+TILE_QUALITY = {
+    name: [int(q) for q in os.environ[f'WSI_TILE_QUALITY_{name.upper()}'].split(',')]
+    for name in TILE_FORMATS if os.environ.get(f'WSI_TILE_QUALITY_{name.upper()}')
+}
+TILE_ENCODER_WORKERS = int(os.environ.get('WSI_TILE_ENCODER_WORKERS', 0)) or None  # Default: one per CPU
+PREFETCH_DEPTH = int(os.environ.get('WSI_PREFETCH_DEPTH', 2))  # 0 disables tile prefetching
+CONTOUR_BATCH_CELL = 256  # Side of the mask cells that make up one streamed contour batch
+CONTOUR_TILE = 512  # Side of the mask tiles whose traced contours are cached for delta queries
+CONTOUR_TILE_MARGIN = 64  # Border read around a tile so instances reaching over its edge are traced whole
+GEOMETRY_CACHE_MB = int(os.environ.get('WSI_GEOMETRY_CACHE_MB', 128))
+AGGREGATE_CACHE_MB = int(os.environ.get('WSI_AGGREGATE_CACHE_MB', 16))
+MAX_POLYGON_VERTICES = 100000  # Per aggregate request, over all polygons
+MAX_MASK_SHAPES = 1024  # Label mask shapes remembered for delta contour queries
+# Name of shared memory caches used by every worker process started with the same name; unset: per-process caches
+SHARED_CACHE = os.environ.get('WSI_SHARED_CACHE')
+# Peers (e.g. router.py) whose X-Forwarded-For header names the real client, comma-separated addresses
+TRUSTED_PROXIES = {addr.strip() for addr in os.environ.get('WSI_TRUSTED_PROXIES', '').split(',') if addr.strip()}
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# Concurrency limits per scheduler priority class
+SCHEDULER_LIMITS = {
+    INTERACTIVE: int(os.environ.get('WSI_INTERACTIVE_CONCURRENCY', 8)),
+    PREFETCH: int(os.environ.get('WSI_PREFETCH_CONCURRENCY', 2)),
+    BATCH: int(os.environ.get('WSI_BATCH_CONCURRENCY', 1)),
+}
 
 # Global slide cache
 slides = {}
@@ -47,11 +98,180 @@ slides = {}
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def get_cached_slide(slide_name):
+    """Return the open slide for `slide_name`, loading it on first use, or None."""
+    if slide_name not in slides:
+        file_path = os.path.join(SLIDE_DIR, slide_name)
+        if not os.path.exists(file_path) or not allowed_file(slide_name):
+            return None
+        try:
+            slides[slide_name] = open_wsi(file_path)
+        except Exception as e:
+            print(f"Error loading slide: {e}")
+            return None
+    return slides[slide_name]
+
+def slide_levels(slide_name):
+    """Return (level_dimensions, level_downsamples) for a slide, or None."""
+    slide = get_cached_slide(slide_name)
+    if slide is None:
+        return None
+    return slide.level_dimensions, slide.level_downsamples
+
+def tile_in_bounds(slide, level, x, y):
+    if level >= len(slide.level_dimensions) or level < 0:
+        return False
+    level_width, level_height = slide.level_dimensions[level]
+    return 0 <= x <= level_width // TILE_SIZE and 0 <= y <= level_height // TILE_SIZE
+
+def read_tile_image(slide, level, x, y):
+    """Read one tile from the slide as an RGB image."""
+    downsample = slide.level_downsamples[level]
+    
+    # Calculate base coordinates in level 0
+    x_base = int(x * TILE_SIZE * downsample)
+    y_base = int(y * TILE_SIZE * downsample)
+    
+    # Read the actual image data and convert to RGB for consistent output
+    tile = slide.read_region((x_base, y_base), level, (TILE_SIZE, TILE_SIZE))
+    return tile.convert('RGB')
+
+def read_tile_bytes(slide, level, x, y, tile_format=FALLBACK_FORMAT):
+    """Read one tile from the slide and encode it at the quality for its level; returns (data, mimetype)."""
+    return tile_encoder.encode(read_tile_image(slide, level, x, y), tile_format, level)
+
+def render_tile(slide_name, level, x, y, tile_format=FALLBACK_FORMAT):
+    """Render a tile for the prefetcher; returns (data, mimetype) or None if there is nothing to render."""
+    slide = get_cached_slide(slide_name)
+    if slide is None or not tile_in_bounds(slide, level, x, y):
+        return None
+    return read_tile_bytes(slide, level, x, y, tile_format)
+
+def default_tile_format():
+    """Most preferred tile format this Pillow build can encode"""
+    return next((name for name in TILE_FORMAT_PREFERENCE if name in TILE_FORMATS and format_supported(name)),
+                FALLBACK_FORMAT)
+
+def get_tile_format():
+    """Tile format for the current request: `format` query parameter, else negotiated from the Accept header."""
+    return tile_encoder.negotiate(request.headers.get('Accept'), request.args.get('format'))
+
+def get_client_address():
+    """Address of the client: the peer, or the address a trusted proxy says it forwarded for."""
+    forwarded = request.headers.get('X-Forwarded-For')
+    if forwarded and request.remote_addr in TRUSTED_PROXIES:
+        # The right-most entry is the one the trusted proxy added itself
+        return forwarded.split(',')[-1].strip()
+    return request.remote_addr
+
+def get_session_id():
+    """Identify the viewer session a request belongs to."""
+    return request.headers.get('X-Session-ID') or request.args.get('session') or get_client_address()
+
+def get_request_id():
+    """Client-chosen ID under which a request can be cancelled, if any."""
+    return request.headers.get('X-Request-ID') or request.args.get('requestId')
+
+def get_viewport_id():
+    """Client-chosen viewport ID; cancelling it cancels all of its requests."""
+    viewport_id = request.headers.get('X-Viewport-ID') or request.args.get('viewport')
+    return ('viewport', get_session_id(), viewport_id) if viewport_id else None
+
+def cancelled_response(e):
+    # 499 (client closed request): nobody is waiting for this response any more
+    return jsonify({'error': str(e)}), 499
+
+def duplicate_response(e):
+    # Another request with the same X-Request-ID is still queued or running
+    return jsonify({'error': str(e)}), 409
+
+# Shared work scheduler: interactive requests first, then prefetch, then batch jobs
+scheduler = WorkScheduler(SCHEDULER_LIMITS)
+
+def make_cache(kind, max_mb, pickled=False):
+    """Cache for encoded tiles or query results; shared between worker processes when WSI_SHARED_CACHE is set"""
+    if SHARED_CACHE:
+        try:
+            return SharedTileCache(f'{SHARED_CACHE}-{kind}', max_bytes=max_mb * 1024 * 1024, pickled=pickled)
+        except (RuntimeError, OSError) as e:
+            print(f"Shared {kind} cache unavailable, using a per-process cache: {e}")
+    return TileCache(max_bytes=max_mb * 1024 * 1024)
+
+# Encoded tiles, shared by interactive requests, the prefetcher and batch jobs
+tile_cache = make_cache('tiles', TILE_CACHE_MB)
+tile_encoder = TileEncoder(TILE_FORMAT_PREFERENCE, TILE_QUALITY, workers=TILE_ENCODER_WORKERS)
+prefetcher = TilePrefetcher(render_tile, tile_cache, slide_levels, scheduler, tile_size=TILE_SIZE, max_depth=PREFETCH_DEPTH)
+
+# Traced contours per mask tile, for delta contour queries
+geometry_cache = make_cache('geometry', GEOMETRY_CACHE_MB, pickled=True)
+# (h5 path, mtime) -> (height, width) of the label mask; each entry costs 1, so this keeps the last MAX_MASK_SHAPES
+mask_shapes = TileCache(max_bytes=MAX_MASK_SHAPES)
+# Memory-mapped density rasters per slide: slide_name -> (meta.json mtime, DensityMaps)
+density_maps = {}
+# Instance grid index per slide, for polygon aggregates: slide_name -> (meta.json mtime, InstanceIndex)
+instance_indexes = {}
+# Aggregate query results per (slide, index version, polygon digest)
+aggregate_cache = make_cache('aggregates', AGGREGATE_CACHE_MB, pickled=True)
+
+# Startup state reported by /api/ready
+startup = {'startedAt': time.time(), 'readyAt': None, 'error': None}
+warm_up_lock = threading.Lock()
+warm_up_thread = None
+
+def warm_up():
+    """Load the slide reader and scan the slide directory; the server is ready when this is done"""
+    try:
+        load_slide_backend()
+        # Placeholders are served from memory; encode them before the first out-of-bounds tile is asked for
+        encode_placeholder(TILE_SIZE, (0, 0, 0, 0))
+        encode_placeholder(TILE_SIZE, (255, 0, 0, 128))
+        unsupported = [name for name in TILE_FORMAT_PREFERENCE if name not in TILE_FORMATS or not format_supported(name)]
+        if unsupported:
+            print(f"Tile formats not available with this Pillow build: {', '.join(unsupported)}")
+        slide_files = [f for f in os.listdir(SLIDE_DIR) if allowed_file(f)]
+        print(f"Found {len(slide_files)} slide files:")
+        for slide_file in slide_files:
+            print(f" - {slide_file}")
+        startup['readyAt'] = time.time()
+    except Exception as e:
+        print(f"Startup failed: {e}")
+        startup['error'] = str(e)
+
+def start_warm_up():
+    """Run `warm_up` once in the background"""
+    global warm_up_thread
+    with warm_up_lock:
+        if warm_up_thread is None:
+            warm_up_thread = threading.Thread(target=warm_up, name='warm-up', daemon=True)
+            warm_up_thread.start()
+
 # Routes
 @app.route('/api/health', methods=['GET'])
 def health_check():
+    # Liveness: the process is up and serving requests
     return jsonify({'status': 'ok'}), 200
 
+def readiness():
+    """(status dict, ready) for /api/ready; starts the warm-up if nothing has yet"""
+    start_warm_up()
+    # Which of the lazily imported libraries have been needed so far
+    loaded = {name: name in sys.modules for name in ('openslide', 'tiffslide', 'PIL.Image', 'h5py', 'cv2', 'skimage')}
+    if startup['error']:
+        return {'status': 'failed', 'error': startup['error'], 'loaded': loaded}, False
+    if startup['readyAt'] is None:
+        return {'status': 'starting', 'loaded': loaded}, False
+    return {
+        'status': 'ready',
+        'warmUpSeconds': round(startup['readyAt'] - startup['startedAt'], 3),
+        'loaded': loaded
+    }, True
+
+@app.route('/api/ready', methods=['GET'])
+def readiness_check():
+    """Readiness: 200 once the slide reader is loaded, 503 while starting or if startup failed"""
+    status, ready = readiness()
+    return jsonify(status), 200 if ready else 503
+
 @app.route('/api/slides', methods=['GET'])
 def list_slides():
     slide_files = []
@@ -77,7 +297,7 @@ def upload_slide():
             file.save(file_path)
             
             # Load slide to verify it works
-            slide = WSISlide(file_path)
+            slide = open_wsi(file_path)
             dimensions = slide.dimensions
             
             return jsonify({
@@ -104,7 +324,7 @@ def get_slide_info(slide_name):
         # Load slide if not in cache
         if slide_name not in slides:
             try:
-                slides[slide_name] = WSISlide(file_path)
+                slides[slide_name] = open_wsi(file_path)
             except Exception as e:
                 return jsonify({'error': f'Error loading slide: {str(e)}'}), 500
         
@@ -152,7 +372,7 @@ def get_tile(slide_name, level, x, y):
         # Load slide if not in cache
         if slide_name not in slides:
             try:
-                slides[slide_name] = WSISlide(file_path)
+                slides[slide_name] = open_wsi(file_path)
                 print(f"Loaded slide: {slide_name}")
             except Exception as e:
                 print(f"Error loading slide: {e}")
@@ -167,50 +387,44 @@ def get_tile(slide_name, level, x, y):
             print(f"Invalid level requested: {level}, max level is {level_count - 1}")
             return create_placeholder_tile(254, (0, 0, 0, 0)), 200
         
-        # Get tile dimensions
-        tile_size = 254
-        
-        # Get slide dimensions at this level
-        level_width, level_height = slide.level_dimensions[level]
-        downsample = slide.level_downsamples[level]
-        
-        print(f"Reading tile at level={level}, x={x}, y={y}, dimensions={level_width}x{level_height}, downsample={downsample}")
-        
-        # Calculate base coordinates in level 0
-        x_base = int(x * tile_size * downsample)
-        y_base = int(y * tile_size * downsample)
+        tile_size = TILE_SIZE
         
         # Check if we're requesting beyond the edge of the slide
-        max_x = level_width // tile_size
-        max_y = level_height // tile_size
-        
-        if x > max_x or y > max_y:
+        if not tile_in_bounds(slide, level, x, y):
             # Return a transparent tile for out-of-bounds requests
-            print(f"Out of bounds tile requested: level={level}, x={x}, y={y}, max_x={max_x}, max_y={max_y}")
+            print(f"Out of bounds tile requested: level={level}, x={x}, y={y}")
             return create_placeholder_tile(tile_size, (0, 0, 0, 0)), 200
         
-        # Read the region and handle any errors
-        try:
-            # Read the actual image data - simple and direct approach
-            tile = slide.read_region((x_base, y_base), level, (tile_size, tile_size))
-            
-            # Convert to RGB for consistent output
-            tile = tile.convert('RGB')
-            
-            # Return the image with good quality
-            output = BytesIO()
-            tile.save(output, format='JPEG', quality=90)
-            output.seek(0)
-            
-            # Set proper content type and caching headers
-            response = send_file(output, mimetype='image/jpeg')
-            response.headers['Content-Type'] = 'image/jpeg'
-            response.headers['Cache-Control'] = 'public, max-age=86400'  # Cache for 24 hours
-            return response
+        tile_format = get_tile_format()
+        tile_key = (slide_name, level, x, y, tile_format)
+        cached = tile_cache.get(tile_key)
+        if cached is not None:
+            data, mimetype = cached
+        else:
+            print(f"Reading tile at level={level}, x={x}, y={y}, downsample={slide.level_downsamples[level]}")
             
-        except Exception as e:
-            print(f"Error reading tile at level={level}, x={x}, y={y}: {e}")
-            return create_placeholder_tile(tile_size, (255, 0, 0, 128)), 200
+            # Read the region and handle any errors
+            try:
+                with scheduler.slot(INTERACTIVE, request_id=get_request_id(), group=get_viewport_id()):
+                    data, mimetype = read_tile_bytes(slide, level, x, y, tile_format)
+            except CancelledError as e:
+                return cancelled_response(e)
+            except DuplicateRequestError as e:
+                return duplicate_response(e)
+            except Exception as e:
+                print(f"Error reading tile at level={level}, x={x}, y={y}: {e}")
+                return create_placeholder_tile(tile_size, (255, 0, 0, 128)), 200
+            tile_cache.put(tile_key, data, mimetype)
+        
+        if PREFETCH_DEPTH > 0:
+            prefetcher.record(get_session_id(), slide_name, level, x, y, cached is not None, tile_format)
+        
+        # Set proper content type and caching headers
+        response = send_file(BytesIO(data), mimetype=mimetype)
+        response.headers['Content-Type'] = mimetype
+        response.headers['Cache-Control'] = 'public, max-age=86400'  # Cache for 24 hours
+        response.headers['Vary'] = 'Accept'  # The format depends on what the client accepts
+        return response
             
     except Exception as e:
         print(f"Error processing tile request: {e}")
@@ -219,11 +433,206 @@ def get_tile(slide_name, level, x, y):
 # Helper function to create placeholder tile images
 def create_placeholder_tile(size, color):
     """Create a placeholder tile with the given size and color."""
-    img = Image.new('RGBA', (size, size), color)
-    output = BytesIO()
-    img.save(output, format='PNG')
-    output.seek(0)
-    return send_file(output, mimetype='image/png')
+    return send_file(BytesIO(encode_placeholder(size, tuple(color))), mimetype='image/png')
+
+@app.route('/api/prefetch/stats', methods=['GET'])
+def get_prefetch_stats():
+    """Return prefetch accuracy and tile cache statistics"""
+    return jsonify({'prefetch': prefetcher.stats(), 'tileCache': tile_cache.stats()}), 200
+
+@app.route('/api/encoding/stats', methods=['GET'])
+def get_encoding_stats():
+    """Return the tile format preferences, quality profiles and bytes and encode time per format"""
+    return jsonify({'encoder': tile_encoder.stats()}), 200
+
+@app.route('/api/segmentation/cache/stats', methods=['GET'])
+def get_geometry_cache_stats():
+    """Return statistics of the traced contour cache used by delta contour queries"""
+    return jsonify({'geometryCache': geometry_cache.stats(), 'aggregateCache': aggregate_cache.stats()}), 200
+
+@app.route('/api/scheduler/stats', methods=['GET'])
+def get_scheduler_stats():
+    """Return running, queued and completed work per priority class"""
+    return jsonify({'data': scheduler.stats()}), 200
+
+@app.route('/api/requests/cancel', methods=['POST'])
+def cancel_requests():
+    """Cancel requests by request ID and/or every request of the given viewports"""
+    try:
+        data = request.json or {}
+        request_ids = data.get('requestIds', [])
+        viewport_ids = data.get('viewportIds', [])
+        
+        cancelled = sum(1 for request_id in request_ids if scheduler.cancel(request_id))
+        session_id = get_session_id()
+        for viewport_id in viewport_ids:
+            cancelled += scheduler.cancel_group(('viewport', session_id, viewport_id))
+        
+        return jsonify({'cancelled': cancelled}), 200
+    except Exception as e:
+        return jsonify({'error': f'Error cancelling requests: {str(e)}'}), 500
+
+def pretile_slide(slide_name, levels, tile_format):
+    """Batch job rendering every tile of the given levels into the tile cache, one tile row at a time"""
+    slide = get_cached_slide(slide_name)
+    total = sum((slide.level_dimensions[level][1] // TILE_SIZE + 1) * (slide.level_dimensions[level][0] // TILE_SIZE + 1)
+                for level in levels)
+    done = 0
+    for level in levels:
+        level_width, level_height = slide.level_dimensions[level]
+        for y in range(level_height // TILE_SIZE + 1):
+            for x in range(level_width // TILE_SIZE + 1):
+                tile_key = (slide_name, level, x, y, tile_format)
+                if tile_key not in tile_cache:
+                    tile_cache.put(tile_key, *read_tile_bytes(slide, level, x, y, tile_format))
+            done += level_width // TILE_SIZE + 1
+            # Tile batch boundary: interactive requests may preempt the job here
+            yield {'level': level, 'row': y, 'tiles': done, 'total': total}
+    return {'tiles': total}
+
+@app.route('/api/slides/<slide_name>/pretile', methods=['POST'])
+def start_pretile(slide_name):
+    """Start a background batch job that renders whole pyramid levels into the tile cache"""
+    try:
+        slide = get_cached_slide(slide_name)
+        if slide is None:
+            return jsonify({'error': 'Slide not found'}), 404
+        
+        data = request.get_json(silent=True) or {}
+        levels = data.get('levels', list(range(len(slide.level_dimensions))))
+        if any(level < 0 or level >= len(slide.level_dimensions) for level in levels):
+            return jsonify({'error': 'Invalid level'}), 400
+        tile_format = data.get('format', default_tile_format())
+        if tile_format not in TILE_FORMATS or not format_supported(tile_format):
+            return jsonify({'error': f'Unsupported tile format: {tile_format}'}), 400
+        
+        # Coarse levels first, they are the cheapest and the first a viewer needs
+        task = scheduler.submit(BATCH, pretile_slide, slide_name, sorted(levels, reverse=True), tile_format,
+                                request_id=get_request_id())
+        return jsonify({'message': 'Pre-tiling started', 'job': task.info()}), 202
+    except DuplicateRequestError as e:
+        return duplicate_response(e)
+    except Exception as e:
+        return jsonify({'error': f'Error starting pre-tiling: {str(e)}'}), 500
+
+@app.route('/api/jobs/<request_id>', methods=['GET'])
+def get_job(request_id):
+    """Return the status and progress of scheduled work"""
+    task = scheduler.get_task(request_id)
+    if task is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify({'data': task.info()}), 200
+
+def density_dir(slide_name):
+    """Directory holding the slide's density rasters (built by `build_density.py` or the density build job)"""
+    return os.path.join(SLIDE_DIR, slide_name + DENSITY_SUFFIX)
+
+def get_density_maps(slide_name):
+    """The slide's density rasters, or None if they have not been built; reloaded after a rebuild"""
+    meta_path = os.path.join(density_dir(slide_name), META_FILE)
+    try:
+        mtime = os.path.getmtime(meta_path)
+    except OSError:
+        return None
+    cached = density_maps.get(slide_name)
+    if cached is None or cached[0] != mtime:
+        cached = density_maps[slide_name] = (mtime, DensityMaps(density_dir(slide_name)))
+    return cached[1]
+
+def get_instance_index(slide_name):
+    """The slide's instance grid index, or None if its density maps have not been built (or predate the index)"""
+    density = get_density_maps(slide_name)
+    if density is None or 'instanceGrid' not in density.meta:
+        return None
+    mtime = density_maps[slide_name][0]
+    cached = instance_indexes.get(slide_name)
+    if cached is None or cached[0] != mtime:
+        cached = instance_indexes[slide_name] = (mtime, InstanceIndex(density_dir(slide_name), density.meta))
+    return cached[1]
+
+def build_slide_density(slide_name):
+    """Batch job writing per-class density rasters for a slide from its segmentation, one mask strip at a time"""
+    import h5py
+    slide = get_cached_slide(slide_name)
+    h5_path = find_segmentation_h5(slide_name)
+    if slide is None or h5_path is None:
+        raise ValueError(f"No slide or segmentation for {slide_name}")
+    with h5py.File(h5_path, 'r') as f:
+        dataset = find_segmentation_dataset(f)
+        if dataset is None:
+            raise ValueError(f"No usable dataset in {h5_path}")
+        class_map, instance_classes, centroids, areas, class_names = find_class_source(f, dataset)
+        width, height = slide.dimensions
+        meta = yield from build_density(
+            dataset, segmentation_shape(dataset), read_segmentation_window, width, height, density_dir(slide_name),
+            class_map=class_map, instance_classes=instance_classes, centroids=centroids, areas=areas,
+            class_names=class_names)
+    print(f"Density maps for {slide_name}: {meta['instances']} instances, classes {meta['classes']}")
+    return {'classes': meta['classes'], 'instances': meta['instances'], 'cells': meta['cells']}
+
+@app.route('/api/slides/<slide_name>/density', methods=['GET'])
+def get_density_info(slide_name):
+    """Classes, resolutions and instance counts of the slide's density maps"""
+    density = get_density_maps(slide_name)
+    if density is None:
+        return jsonify({'error': 'Density maps not built', 'build': f'/api/slides/{slide_name}/density/build'}), 404
+    return jsonify(density.meta), 200
+
+@app.route('/api/slides/<slide_name>/density/build', methods=['POST'])
+def start_density_build(slide_name):
+    """Start a background batch job that builds the slide's density maps from its segmentation"""
+    try:
+        if get_cached_slide(slide_name) is None:
+            return jsonify({'error': 'Slide not found'}), 404
+        if find_segmentation_h5(slide_name) is None:
+            return jsonify({'error': 'Segmentation not found'}), 404
+        task = scheduler.submit(BATCH, build_slide_density, slide_name, request_id=get_request_id())
+        return jsonify({'message': 'Density build started', 'job': task.info()}), 202
+    except DuplicateRequestError as e:
+        return duplicate_response(e)
+    except Exception as e:
+        return jsonify({'error': f'Error starting density build: {str(e)}'}), 500
+
+@app.route('/api/slides/<slide_name>/density/tile/<int:level>/<int:x>/<int:y>', methods=['GET'])
+def get_density_tile(slide_name, level, x, y):
+    """Colour-mapped cell density overlay for one tile of the `get_tile` grid; `class` selects a class (default all)"""
+    try:
+        slide = get_cached_slide(slide_name)
+        if slide is None:
+            return jsonify({'error': 'Slide not found'}), 404
+        density = get_density_maps(slide_name)
+        if density is None:
+            return jsonify({'error': 'Density maps not built', 'build': f'/api/slides/{slide_name}/density/build'}), 404
+        try:
+            class_index = density.class_index(request.args.get('class'))
+        except KeyError:
+            return jsonify({'error': f"Unknown class: {request.args.get('class')}", 'classes': density.classes}), 400
+        if not tile_in_bounds(slide, level, x, y):
+            return create_placeholder_tile(TILE_SIZE, (0, 0, 0, 0)), 200
+        
+        # The overlay needs transparency, which JPEG lacks
+        tile_format = get_tile_format()
+        if tile_format == 'jpeg':
+            tile_format = 'png'
+        tile_key = ('density', slide_name, density.version, class_index, level, x, y, tile_format)
+        cached = tile_cache.get(tile_key)
+        if cached is not None:
+            data, mimetype = cached
+        else:
+            from PIL import Image
+            downsample = slide.level_downsamples[level]
+            overlay = density.render(class_index, x * TILE_SIZE * downsample, y * TILE_SIZE * downsample,
+                                     TILE_SIZE * downsample, TILE_SIZE)
+            data, mimetype = tile_encoder.encode(Image.fromarray(overlay), tile_format, level)
+            tile_cache.put(tile_key, data, mimetype)
+        
+        response = send_file(BytesIO(data), mimetype=mimetype)
+        response.headers['Cache-Control'] = 'public, max-age=3600'  # Rebuilding the maps changes the tiles
+        response.headers['Vary'] = 'Accept'
+        return response
+    except Exception as e:
+        print(f"Error rendering density tile: {e}")
+        return jsonify({'error': f'Error rendering density tile: {str(e)}'}), 500
 
 @app.route('/api/slides/<slide_name>/segmentation/centroids', methods=['GET'])
 def get_segmentation_centroids(slide_name):
@@ -252,6 +661,458 @@ def get_segmentation_centroids(slide_name):
     except Exception as e:
         return jsonify({'error': f'Error getting segmentation centroids: {str(e)}'}), 500
 
+# Dataset names commonly used for label masks in segmentation H5 files
+SEGMENTATION_KEYS = ['masks', 'segmentation', 'data', 'label', 'labels', 'prediction', 'predictions']
+
+def find_segmentation_h5(slide_name):
+    """Return the path of the slide's `.seg.h5` file, or None if there is none"""
+    h5_filename = f"{slide_name}.seg.h5"
+    
+    # Check both in the SLIDE_DIR and one level up
+    h5_paths = [
+        os.path.join(SLIDE_DIR, h5_filename),  # In slide dir
+        os.path.join(os.path.dirname(SLIDE_DIR), h5_filename),  # One level up
+        os.path.join(SLIDE_DIR, "..", h5_filename),  # Alternate syntax for one level up
+    ]
+    
+    for path in h5_paths:
+        if os.path.exists(path):
+            print(f"Found H5 file at {path}")
+            return path
+    
+    print(f"H5 segmentation file not found. Searched paths:")
+    for path in h5_paths:
+        print(f"  - {path}")
+    return None
+
+def find_segmentation_dataset(f):
+    """Find the label mask dataset in an open H5 file, or None"""
+    import h5py
+    # First try to find direct datasets
+    for key in SEGMENTATION_KEYS:
+        if key in f:
+            print(f"Found key '{key}' in H5 file")
+            return f[key]
+    
+    # If not found, try to find datasets in nested groups
+    for key in f.keys():
+        if isinstance(f[key], h5py.Group):
+            print(f"Examining group '{key}'")
+            for subkey in SEGMENTATION_KEYS:
+                if subkey in f[key]:
+                    print(f"Found dataset '{subkey}' in group '{key}'")
+                    return f[key][subkey]
+    
+    # If we still can't find standard keys, try to find any dataset
+    print("Looking for any dataset...")
+    for key in f.keys():
+        try:
+            if isinstance(f[key], h5py.Dataset):
+                print(f"Using dataset '{key}' from H5 file")
+                return f[key]
+            elif isinstance(f[key], h5py.Group):
+                # Look in the first level of groups
+                for subkey in f[key].keys():
+                    if isinstance(f[key][subkey], h5py.Dataset):
+                        print(f"Using dataset '{key}/{subkey}' from H5 file")
+                        return f[key][subkey]
+        except Exception as e:
+            print(f"Error examining key {key}: {e}")
+    return None
+
+def segmentation_shape(dataset):
+    """(height, width) of a label mask dataset once reduced to 2D"""
+    shape = dataset.shape
+    if len(shape) in (3, 4) and shape[0] == 1:
+        return shape[1], shape[2]
+    return shape[0], shape[1]
+
+def read_segmentation_window(dataset, y0, y1, x0, x1, row_step=1, column_step=1):
+    """Read rows y0:y1 and columns x0:x1 of a label mask dataset without loading the rest
+    
+    With steps above 1 only every row_step-th row and column_step-th column is read.
+    """
+    rows, columns = slice(y0, y1, row_step), slice(x0, x1, column_step)
+    shape = dataset.shape
+    if len(shape) == 3 and shape[0] == 1:
+        return dataset[0, rows, columns]
+    elif len(shape) == 3 and shape[2] == 1:
+        return dataset[rows, columns, 0]
+    elif len(shape) == 3:
+        return np.max(dataset[rows, columns, :], axis=2)
+    elif len(shape) == 4 and shape[0] == 1:
+        return np.max(dataset[0, rows, columns, :], axis=2)
+    return dataset[rows, columns]
+
+def open_label_reader(slide_name, slide):
+    """Open a slide's segmentation for windowed reads.
+    
+    Returns (h5 file, read_labels) where read_labels(x, y, width, height, out_width, out_height)
+    gives the labels of a level 0 rectangle resampled (nearest) to the output size,
+    or (None, None) if the slide has no usable segmentation.
+    """
+    import h5py
+    h5_path = find_segmentation_h5(slide_name)
+    if not h5_path:
+        return None, None
+    f = h5py.File(h5_path, 'r')
+    dataset = find_segmentation_dataset(f)
+    if dataset is None:
+        f.close()
+        return None, None
+    
+    seg_height, seg_width = segmentation_shape(dataset)
+    scale_x = slide.dimensions[0] / seg_width
+    scale_y = slide.dimensions[1] / seg_height
+    
+    def read_labels(x0, y0, width, height, out_width, out_height):
+        seg_x0 = int(max(0, x0 / scale_x))
+        seg_y0 = int(max(0, y0 / scale_y))
+        seg_x1 = int(min(seg_width, math.ceil((x0 + width) / scale_x)))
+        seg_y1 = int(min(seg_height, math.ceil((y0 + height) / scale_y)))
+        if seg_x1 <= seg_x0 or seg_y1 <= seg_y0:
+            return None
+        # Read one mask pixel per output pixel rather than the full-resolution window, so memory
+        # stays proportional to the output piece at any downsample
+        column_step = max(1, int(width / out_width / scale_x))
+        row_step = max(1, int(height / out_height / scale_y))
+        window = read_segmentation_window(dataset, seg_y0, seg_y1, seg_x0, seg_x1, row_step, column_step)
+        columns = ((x0 + (np.arange(out_width) + 0.5) * width / out_width) / scale_x - seg_x0).astype(int) // column_step
+        rows = ((y0 + (np.arange(out_height) + 0.5) * height / out_height) / scale_y - seg_y0).astype(int) // row_step
+        columns = np.clip(columns, 0, window.shape[1] - 1)
+        rows = np.clip(rows, 0, window.shape[0] - 1)
+        return window[rows[:, None], columns[None, :]]
+    
+    return f, read_labels
+
+def label_color(label):
+    """Vibrant, consistent colour for a label as a hex string"""
+    # Use HSV to ensure vibrant colors, then convert to RGB
+    hue = (label * 137.5) % 360  # Use golden ratio to spread colors
+    saturation = 0.75 + (label % 25) / 100  # High saturation with small variations
+    value = 0.9 + (label % 10) / 100  # High brightness with small variations
+    
+    # Convert to RGB
+    h = hue / 60
+    i = int(h)
+    f = h - i
+    p = value * (1 - saturation)
+    q = value * (1 - saturation * f)
+    t = value * (1 - saturation * (1 - f))
+    
+    if i == 0:
+        r, g, b = value, t, p
+    elif i == 1:
+        r, g, b = q, value, p
+    elif i == 2:
+        r, g, b = p, value, t
+    elif i == 3:
+        r, g, b = p, q, value
+    elif i == 4:
+        r, g, b = t, p, value
+    else:
+        r, g, b = value, p, q
+    
+    r = int(r * 255)
+    g = int(g * 255)
+    b = int(b * 255)
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+def label_boxes(region):
+    """Bounding box (row slice, column slice) of every label in a region, as (label, box) pairs in label order"""
+    from scipy import ndimage
+    if region.dtype.kind not in 'iu':
+        region = region.astype(np.int64)
+    region = np.maximum(region, 0)
+    if region.size and region.max() > max(1 << 20, 4 * region.size):
+        # Very large label IDs: relabel densely so find_objects does not allocate one entry per ID
+        labels, dense = np.unique(region, return_inverse=True)
+        dense = dense.reshape(region.shape)
+        if labels[0] != 0:
+            labels = np.concatenate([[0], labels])
+            dense = dense + 1
+        return [(int(labels[i + 1]), box) for i, box in enumerate(ndimage.find_objects(dense)) if box is not None]
+    return [(i + 1, box) for i, box in enumerate(ndimage.find_objects(region)) if box is not None]
+
+def trace_label(region, label, box, seg_x, seg_y, scale_x, scale_y):
+    """Contours of one label, traced within its bounding box and mapped to slide coordinates"""
+    import cv2
+    rows, columns = box
+    
+    # Create binary mask for this label
+    mask = (region[rows, columns] == label).astype(np.uint8) * 255
+    
+    # Find contours using OpenCV
+    opencv_contours, _ = cv2.findContours(
+        mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(columns.start, rows.start)
+    )
+    
+    # Generate vibrant color based on label (consistent coloring)
+    color = label_color(label)
+    
+    contours = []
+    for contour in opencv_contours:
+        if cv2.contourArea(contour) < 10:  # Skip tiny regions
+            continue
+        
+        # Simplify contour to reduce point count for performance
+        epsilon = 0.002 * cv2.arcLength(contour, True)
+        approx_contour = cv2.approxPolyDP(contour, epsilon, True)
+        
+        # Convert contour to list of points and scale to slide coordinates
+        points = []
+        for point in approx_contour.reshape(-1, 2):
+            # Map back to slide coordinates
+            slide_x = (point[0] + seg_x) * scale_x
+            slide_y = (point[1] + seg_y) * scale_y
+            points.append({"x": float(slide_x), "y": float(slide_y)})
+        
+        contours.append({
+            "points": points,
+            "color": color,
+            "label": int(label)
+        })
+    return contours
+
+def extract_contours(region, seg_x, seg_y, scale_x, scale_y, task=None):
+    """Trace the outline of every label in a segmentation region, in slide coordinates"""
+    boxes = label_boxes(region)
+    print(f"Found {len(boxes)} unique labels in region")
+    
+    contours = []
+    for label, box in boxes:
+        # Stop early if the client cancelled the request
+        if task is not None:
+            task.check()
+        contours.extend(trace_label(region, label, box, seg_x, seg_y, scale_x, scale_y))
+    return contours
+
+def contour_batches(region, seg_x, seg_y, scale_x, scale_y, center, task=None, cell_size=CONTOUR_BATCH_CELL):
+    """Yield the contours of a segmentation region in spatial batches, nearest to `center` first
+    
+    The region is divided into cells of `cell_size` mask pixels and every label is assigned to the
+    cell holding the centre of its bounding box; each non-empty cell is one batch. `center` is the
+    viewport centre in slide coordinates.
+    """
+    center_x = center[0] / scale_x - seg_x
+    center_y = center[1] / scale_y - seg_y
+    cells = {}
+    for label, (rows, columns) in label_boxes(region):
+        cell = ((rows.start + rows.stop) // 2 // cell_size, (columns.start + columns.stop) // 2 // cell_size)
+        cells.setdefault(cell, []).append((label, (rows, columns)))
+    
+    def distance(cell):
+        return math.hypot((cell[1] + 0.5) * cell_size - center_x, (cell[0] + 0.5) * cell_size - center_y)
+    
+    print(f"Streaming {sum(len(labels) for labels in cells.values())} labels in {len(cells)} batches")
+    for cell in sorted(cells, key=distance):
+        batch = []
+        for label, box in cells[cell]:
+            if task is not None:
+                task.check()
+            batch.extend(trace_label(region, label, box, seg_x, seg_y, scale_x, scale_y))
+        if batch:
+            yield batch
+
+def read_viewport_labels(h5_path, slide_width, slide_height, x, y, width, height):
+    """Read the window of the label mask under a level 0 viewport
+    
+    Returns (region, seg_x, seg_y, scale_x, scale_y), or None if the H5 file has no usable
+    dataset or the viewport misses the mask.
+    """
+    import h5py
+    with h5py.File(h5_path, 'r') as f:
+        dataset = find_segmentation_dataset(f)
+        if dataset is None:
+            print("Could not find any usable dataset in H5 file")
+            return None
+        
+        # Determine scale factor between segmentation and slide
+        seg_height, seg_width = segmentation_shape(dataset)
+        scale_x = slide_width / seg_width
+        scale_y = slide_height / seg_height
+        
+        # Convert viewport coordinates to segmentation coordinates
+        seg_x = int(max(0, x / scale_x))
+        seg_y = int(max(0, y / scale_y))
+        seg_width = int(min(seg_width - seg_x, width / scale_x))
+        seg_height = int(min(seg_height - seg_y, height / scale_y))
+        
+        # Sanity check
+        if seg_width <= 0 or seg_height <= 0:
+            print("Invalid segmentation region requested")
+            return None
+        
+        # Extract region of interest from segmentation
+        print(f"Extracting region: ({seg_x}, {seg_y}, {seg_width}, {seg_height})")
+        region = read_segmentation_window(dataset, seg_y, seg_y + seg_height, seg_x, seg_x + seg_width)
+    return region, seg_x, seg_y, scale_x, scale_y
+
+def viewport_contours(h5_path, slide_width, slide_height, x, y, width, height, task=None):
+    """Contours of the labels inside a level 0 viewport, reading only that window of the mask
+    
+    Returns None if the H5 file has no usable dataset or the viewport misses the mask.
+    """
+    window = read_viewport_labels(h5_path, slide_width, slide_height, x, y, width, height)
+    if window is None:
+        return None
+    return extract_contours(*window, task=task)
+
+def geometry_tile(dataset, column, row, scale_x, scale_y):
+    """Trace the instances owned by one mask tile
+    
+    An instance belongs to the tile holding the centre of its bounding box. The tile is read with a
+    CONTOUR_TILE_MARGIN border, so instances up to twice the margin across are traced whole even
+    where they reach over the tile edge. Returns a list of (label, bounding box as (x0, y0, x1, y1)
+    in slide coordinates, contours).
+    """
+    seg_height, seg_width = segmentation_shape(dataset)
+    tile_x0 = column * CONTOUR_TILE
+    tile_y0 = row * CONTOUR_TILE
+    x0 = max(0, tile_x0 - CONTOUR_TILE_MARGIN)
+    y0 = max(0, tile_y0 - CONTOUR_TILE_MARGIN)
+    x1 = min(seg_width, tile_x0 + CONTOUR_TILE + CONTOUR_TILE_MARGIN)
+    y1 = min(seg_height, tile_y0 + CONTOUR_TILE + CONTOUR_TILE_MARGIN)
+    region = read_segmentation_window(dataset, y0, y1, x0, x1)
+    
+    instances = []
+    for label, (rows, columns) in label_boxes(region):
+        center_x = x0 + (columns.start + columns.stop) // 2
+        center_y = y0 + (rows.start + rows.stop) // 2
+        if not (tile_x0 <= center_x < tile_x0 + CONTOUR_TILE and tile_y0 <= center_y < tile_y0 + CONTOUR_TILE):
+            continue
+        contours = trace_label(region, label, (rows, columns), x0, y0, scale_x, scale_y)
+        if contours:
+            bbox = ((x0 + columns.start) * scale_x, (y0 + rows.start) * scale_y,
+                    (x0 + columns.stop) * scale_x, (y0 + rows.stop) * scale_y)
+            instances.append((label, bbox, contours))
+    return instances
+
+def geometry_tile_size(instances):
+    """Approximate memory held by a traced tile (Python dicts, ~240 bytes per point), for the cache budget"""
+    return sum(300 + sum(300 + 240 * len(contour['points']) for contour in contours) for _, _, contours in instances)
+
+def instances_in_viewports(h5_path, slide_width, slide_height, viewports, task=None):
+    """Instances whose bounding box intersects each level 0 viewport (x, y, width, height)
+    
+    Uses the tile-keyed geometry cache, so only tiles not traced before are read from the mask.
+    Returns one {label: contours} dict per viewport, or None if the H5 file has no usable dataset.
+    """
+    import h5py
+    shape_key = (h5_path, os.path.getmtime(h5_path))
+    f = None
+    dataset = None
+    try:
+        cached_shape = mask_shapes.get(shape_key)
+        if cached_shape is None:
+            f = h5py.File(h5_path, 'r')
+            dataset = find_segmentation_dataset(f)
+            if dataset is None:
+                return None
+            seg_height, seg_width = segmentation_shape(dataset)
+            mask_shapes.put(shape_key, (seg_height, seg_width), None, size=1)
+        else:
+            seg_height, seg_width = cached_shape[0]
+        scale_x = slide_width / seg_width
+        scale_y = slide_height / seg_height
+        
+        results = []
+        for x, y, width, height in viewports:
+            # Instances reach at most CONTOUR_TILE_MARGIN past the tile that owns them
+            first_column = max(0, int((x / scale_x - CONTOUR_TILE_MARGIN) // CONTOUR_TILE))
+            first_row = max(0, int((y / scale_y - CONTOUR_TILE_MARGIN) // CONTOUR_TILE))
+            last_column = min((seg_width - 1) // CONTOUR_TILE, int(((x + width) / scale_x + CONTOUR_TILE_MARGIN) // CONTOUR_TILE))
+            last_row = min((seg_height - 1) // CONTOUR_TILE, int(((y + height) / scale_y + CONTOUR_TILE_MARGIN) // CONTOUR_TILE))
+            
+            instances = {}
+            for row in range(first_row, last_row + 1):
+                for column in range(first_column, last_column + 1):
+                    tile_key = shape_key + (column, row)
+                    cached = geometry_cache.get(tile_key)
+                    if cached is not None:
+                        tile = cached[0]
+                    else:
+                        if task is not None:
+                            task.check()
+                        if dataset is None:
+                            f = h5py.File(h5_path, 'r')
+                            dataset = find_segmentation_dataset(f)
+                        tile = geometry_tile(dataset, column, row, scale_x, scale_y)
+                        geometry_cache.put(tile_key, tile, None, size=geometry_tile_size(tile))
+                    for label, (x0, y0, x1, y1), contours in tile:
+                        if x0 < x + width and x1 > x and y0 < y + height and y1 > y:
+                            instances[label] = contours
+            results.append(instances)
+        return results
+    finally:
+        if f is not None:
+            f.close()
+
+def parse_bounds(value):
+    """Viewport (x, y, width, height) from 'x,y,width,height' or a dict with those keys, or None"""
+    if not value:
+        return None
+    if isinstance(value, str):
+        parts = [float(part) for part in value.split(',')]
+        if len(parts) != 4:
+            raise ValueError(f"Expected x,y,width,height, got {value!r}")
+        return tuple(parts)
+    return tuple(float(value[key]) for key in ('x', 'y', 'width', 'height'))
+
+def parse_polygon(value):
+    """Rings of a polygon as (N, 2) float arrays of level 0 coordinates
+    
+    Accepts a list of [x, y] points, a list of such rings (the first is the outline, the others holes),
+    {"rings": [...]} or a GeoJSON Polygon {"type": "Polygon", "coordinates": [...]}.
+    """
+    if isinstance(value, dict):
+        value = value['coordinates'] if 'coordinates' in value else value['rings']
+    rings = value if np.ndim(value[0]) == 2 else [value]
+    rings = [np.asarray(ring, dtype=np.float64) for ring in rings]
+    for ring in rings:
+        if ring.ndim != 2 or ring.shape[1] != 2 or len(ring) < 3 or not np.isfinite(ring).all():
+            raise ValueError('A ring needs at least 3 finite [x, y] points')
+    return rings
+
+def wants_stream():
+    """Whether the client asked for contours as NDJSON batches (?stream=1 or Accept: application/x-ndjson)"""
+    if request.args.get('stream', '').lower() in ('1', 'true', 'yes', 'ndjson'):
+        return True
+    return NDJSON_MIMETYPE in request.headers.get('Accept', '')
+
+def ndjson_batches(batches):
+    """Encode contour batches as NDJSON lines: one {"type": "batch"} line per batch, then {"type": "done"}"""
+    count = 0
+    for index, batch in enumerate(batches):
+        count += len(batch)
+        yield json.dumps({'type': 'batch', 'index': index, 'data': batch}) + '\n'
+    yield json.dumps({'type': 'done', 'count': count}) + '\n'
+
+def contours_response(contours, stream=False):
+    if stream:
+        return Response(ndjson_batches([contours]), mimetype=NDJSON_MIMETYPE), 200
+    return jsonify({'data': contours}), 200
+
+def stream_viewport_contours(h5_path, slide_width, slide_height, x, y, width, height, request_id=None, group=None):
+    """NDJSON body of a streamed contour request
+    
+    Runs while the response is sent, so at most one batch of contours is held at a time. A client
+    that disconnects closes the generator at its next batch, which ends the work.
+    """
+    try:
+        with scheduler.slot(INTERACTIVE, request_id=request_id, group=group) as task:
+            window = read_viewport_labels(h5_path, slide_width, slide_height, x, y, width, height)
+            if window is None:
+                batches = [mock_contours(x, y, width, height)]
+            else:
+                batches = contour_batches(*window, center=(x + width / 2, y + height / 2), task=task)
+            yield from ndjson_batches(batches)
+    except CancelledError as e:
+        print(f"Contour stream cancelled: {e}")
+    except Exception as e:
+        print(f"Error streaming contours: {str(e)}")
+        yield json.dumps({'type': 'error', 'error': str(e)}) + '\n'
+
 @app.route('/api/slides/<slide_name>/segmentation/contours', methods=['GET'])
 def get_segmentation_contours(slide_name):
     """Return segmentation contours from H5 file"""
@@ -262,6 +1123,8 @@ def get_segmentation_contours(slide_name):
         width = float(request.args.get('width', 1000))
         height = float(request.args.get('height', 1000))
         
+        stream = wants_stream()
+        
         print(f"Segmentation contours requested for: {slide_name}, bounds: {x},{y},{width},{height}")
         
         # If we're just requesting a small view for the UI overview, return empty or minimal data
@@ -290,30 +1153,12 @@ def get_segmentation_contours(slide_name):
                     'color': f'#{np.random.randint(0, 256):02x}{np.random.randint(0, 256):02x}{np.random.randint(0, 256):02x}'
                 })
             
-            return jsonify({'data': contours}), 200
+            return contours_response(contours, stream)
             
         # Check for H5 segmentation file
-        h5_filename = f"{slide_name}.seg.h5"
-        
-        # Check both in the SLIDE_DIR and one level up
-        h5_paths = [
-            os.path.join(SLIDE_DIR, h5_filename),  # In slide dir
-            os.path.join(os.path.dirname(SLIDE_DIR), h5_filename),  # One level up
-            os.path.join(SLIDE_DIR, "..", h5_filename),  # Alternate syntax for one level up
-        ]
-        
-        h5_path = None
-        for path in h5_paths:
-            if os.path.exists(path):
-                h5_path = path
-                print(f"Found H5 file at {h5_path}")
-                break
-                
+        h5_path = find_segmentation_h5(slide_name)
         if not h5_path:
-            print(f"H5 segmentation file not found. Searched paths:")
-            for path in h5_paths:
-                print(f"  - {path}")
-            return generate_mock_contours(x, y, width, height)
+            return generate_mock_contours(x, y, width, height, stream)
             
         # Get slide info to determine scaling
         slide_info = get_slide_info_dict(slide_name)
@@ -326,179 +1171,25 @@ def get_segmentation_contours(slide_name):
         
         print(f"Slide dimensions: {slide_width}x{slide_height}")
         
+        if stream:
+            return Response(stream_viewport_contours(
+                h5_path, slide_width, slide_height, x, y, width, height, get_request_id(), get_viewport_id()
+            ), mimetype=NDJSON_MIMETYPE)
+        
         # Read segmentation from H5 file
         try:
-            with h5py.File(h5_path, 'r') as f:
-                print(f"H5 file opened successfully. Keys: {list(f.keys())}")
-                
-                # Extract segmentation data - structure depends on the H5 file format
-                # Commonly used keys might be 'masks', 'segmentation', 'data', etc.
-                seg_data = None
-                possible_keys = ['masks', 'segmentation', 'data', 'label', 'labels', 'prediction', 'predictions']
-                
-                # First try to find direct datasets
-                for key in possible_keys:
-                    if key in f:
-                        print(f"Found key '{key}' in H5 file")
-                        seg_data = f[key][:]
-                        break
-                        
-                # If not found, try to find datasets in nested groups
-                if seg_data is None:
-                    for key in f.keys():
-                        if isinstance(f[key], h5py.Group):
-                            print(f"Examining group '{key}'")
-                            for subkey in possible_keys:
-                                if subkey in f[key]:
-                                    print(f"Found dataset '{subkey}' in group '{key}'")
-                                    seg_data = f[key][subkey][:]
-                                    break
-                            if seg_data is not None:
-                                break
-                
-                # If we still can't find standard keys, try to find any dataset
-                if seg_data is None:
-                    print("Looking for any dataset...")
-                    for key in f.keys():
-                        try:
-                            if isinstance(f[key], h5py.Dataset):
-                                print(f"Using dataset '{key}' from H5 file")
-                                seg_data = f[key][:]
-                                break
-                            elif isinstance(f[key], h5py.Group):
-                                # Look in the first level of groups
-                                for subkey in f[key].keys():
-                                    if isinstance(f[key][subkey], h5py.Dataset):
-                                        print(f"Using dataset '{key}/{subkey}' from H5 file")
-                                        seg_data = f[key][subkey][:]
-                                        break
-                        except Exception as e:
-                            print(f"Error examining key {key}: {e}")
-                        
-                        if seg_data is not None:
-                            break
-                
-                if seg_data is None:
-                    print("Could not find any usable dataset in H5 file")
-                    return generate_mock_contours(x, y, width, height)
-                
-                print(f"Segmentation data shape: {seg_data.shape}")
-                
-                # Handle different dimensionality
-                if len(seg_data.shape) > 2:
-                    print(f"Reducing dimensions from {len(seg_data.shape)} to 2")
-                    # Try to reduce to 2D - depends on data organization
-                    if len(seg_data.shape) == 3 and seg_data.shape[0] == 1:
-                        seg_data = seg_data[0]  # First channel/slice
-                    elif len(seg_data.shape) == 3 and seg_data.shape[2] == 1:
-                        seg_data = seg_data[:,:,0]  # First channel
-                    elif len(seg_data.shape) == 3:
-                        # Use maximum value across channels or first channel
-                        seg_data = np.max(seg_data, axis=2)
-                    elif len(seg_data.shape) == 4 and seg_data.shape[0] == 1:
-                        # Batch of 1, use first image and max across channels
-                        seg_data = np.max(seg_data[0], axis=2)
-                
-                print(f"Final segmentation data shape: {seg_data.shape}")
-                
-                # Determine scale factor between segmentation and slide
-                seg_height, seg_width = seg_data.shape
-                scale_x = slide_width / seg_width
-                scale_y = slide_height / seg_height
-                
-                print(f"Scale factors: x={scale_x}, y={scale_y}")
-                
-                # Convert viewport coordinates to segmentation coordinates
-                seg_x = int(max(0, x / scale_x))
-                seg_y = int(max(0, y / scale_y))
-                seg_width = int(min(seg_width - seg_x, width / scale_x))
-                seg_height = int(min(seg_height - seg_y, height / scale_y))
-                
-                # Sanity check
-                if seg_width <= 0 or seg_height <= 0:
-                    print("Invalid segmentation region requested")
-                    return generate_mock_contours(x, y, width, height)
-                
-                # Extract region of interest from segmentation
-                print(f"Extracting region: ({seg_x}, {seg_y}, {seg_width}, {seg_height})")
-                region = seg_data[seg_y:seg_y+seg_height, seg_x:seg_x+seg_width]
-                
-                # Find contours
-                contours = []
-                
-                # Get unique labels (excluding background 0)
-                unique_labels = np.unique(region)
-                unique_labels = unique_labels[unique_labels > 0]
-                
-                print(f"Found {len(unique_labels)} unique labels in region")
-                
-                # For each label, find its contours
-                for label in unique_labels:
-                    # Create binary mask for this label
-                    mask = (region == label).astype(np.uint8) * 255
-                    
-                    # Find contours using OpenCV
-                    opencv_contours, _ = cv2.findContours(
-                        mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
-                    )
-                    
-                    # Generate vibrant color based on label (consistent coloring)
-                    # Use HSV to ensure vibrant colors, then convert to RGB
-                    hue = (label * 137.5) % 360  # Use golden ratio to spread colors
-                    saturation = 0.75 + (label % 25) / 100  # High saturation with small variations
-                    value = 0.9 + (label % 10) / 100  # High brightness with small variations
-                    
-                    # Convert to RGB
-                    h = hue / 60
-                    i = int(h)
-                    f = h - i
-                    p = value * (1 - saturation)
-                    q = value * (1 - saturation * f)
-                    t = value * (1 - saturation * (1 - f))
-                    
-                    if i == 0:
-                        r, g, b = value, t, p
-                    elif i == 1:
-                        r, g, b = q, value, p
-                    elif i == 2:
-                        r, g, b = p, value, t
-                    elif i == 3:
-                        r, g, b = p, q, value
-                    elif i == 4:
-                        r, g, b = t, p, value
-                    else:
-                        r, g, b = value, p, q
-                    
-                    r = int(r * 255)
-                    g = int(g * 255)
-                    b = int(b * 255)
-                    color = f"#{r:02x}{g:02x}{b:02x}"
-                    
-                    for contour in opencv_contours:
-                        if cv2.contourArea(contour) < 10:  # Skip tiny regions
-                            continue
-                        
-                        # Simplify contour to reduce point count for performance
-                        epsilon = 0.002 * cv2.arcLength(contour, True)
-                        approx_contour = cv2.approxPolyDP(contour, epsilon, True)
-                        
-                        # Convert contour to list of points and scale to slide coordinates
-                        points = []
-                        for point in approx_contour.reshape(-1, 2):
-                            # Map back to slide coordinates
-                            slide_x = (point[0] + seg_x) * scale_x
-                            slide_y = (point[1] + seg_y) * scale_y
-                            points.append({"x": float(slide_x), "y": float(slide_y)})
-                        
-                        contours.append({
-                            "points": points,
-                            "color": color,
-                            "label": int(label)
-                        })
-                
-                print(f"Returning {len(contours)} contours")
-                return jsonify({'data': contours}), 200
+            with scheduler.slot(INTERACTIVE, request_id=get_request_id(), group=get_viewport_id()) as task:
+                contours = viewport_contours(h5_path, slide_width, slide_height, x, y, width, height, task)
+            if contours is None:
+                return generate_mock_contours(x, y, width, height)
+            
+            print(f"Returning {len(contours)} contours")
+            return jsonify({'data': contours}), 200
         
+        except CancelledError as e:
+            return cancelled_response(e)
+        except DuplicateRequestError as e:
+            return duplicate_response(e)
         except Exception as e:
             print(f"Error processing H5 file: {str(e)}")
             import traceback
@@ -511,9 +1202,207 @@ def get_segmentation_contours(slide_name):
         traceback.print_exc()
         return jsonify({'error': f'Error getting segmentation contours: {str(e)}'}), 500
 
+@app.route('/api/slides/<slide_name>/segmentation/contours/delta', methods=['GET', 'POST'])
+def get_segmentation_contours_delta(slide_name):
+    """Contours of the instances entering a viewport, and the labels of those that left it
+    
+    The client describes what it already holds with `previous` (its last viewport, as
+    'x,y,width,height' or an object) and/or `known` (label IDs); with neither, every instance in
+    the viewport is returned. Instances are returned whole, also where they cross the viewport edge.
+    """
+    try:
+        if request.method == 'POST':
+            params = request.get_json(silent=True) or {}
+        else:
+            params = request.args
+        viewport = parse_bounds({key: params.get(key, default) for key, default in
+                                 (('x', 0), ('y', 0), ('width', 1000), ('height', 1000))})
+        previous = parse_bounds(params.get('previous'))
+        known = params.get('known')
+        if isinstance(known, str):
+            known = [label for label in known.split(',') if label]
+        known = {int(label) for label in known} if known else None
+    except (TypeError, ValueError, KeyError) as e:
+        return jsonify({'error': f'Invalid viewport: {str(e)}'}), 400
+    
+    h5_path = find_segmentation_h5(slide_name)
+    slide_info = get_slide_info_dict(slide_name) if h5_path else None
+    if not slide_info:
+        return jsonify({'error': 'Segmentation not found'}), 404
+    
+    try:
+        with scheduler.slot(INTERACTIVE, request_id=get_request_id(), group=get_viewport_id()) as task:
+            viewports = [viewport] if previous is None else [viewport, previous]
+            found = instances_in_viewports(
+                h5_path, slide_info['dimensions']['width'], slide_info['dimensions']['height'], viewports, task)
+        if found is None:
+            return jsonify({'error': 'No usable dataset in segmentation file'}), 404
+    except CancelledError as e:
+        return cancelled_response(e)
+    except DuplicateRequestError as e:
+        return duplicate_response(e)
+    except Exception as e:
+        print(f"Error getting contour delta: {str(e)}")
+        return jsonify({'error': f'Error getting contour delta: {str(e)}'}), 500
+    
+    current = found[0]
+    held = set(known or ())
+    if previous is not None:
+        held |= set(found[1])
+    added = [contour for label, contours in current.items() if label not in held for contour in contours]
+    removed = sorted(int(label) for label in held if label not in current)
+    print(f"Contour delta: {len(added)} added, {len(removed)} removed, {len(current)} in view")
+    return jsonify({'added': added, 'removed': removed, 'count': len(current)}), 200
+
+@app.route('/api/slides/<slide_name>/segmentation/aggregate', methods=['POST'])
+def get_segmentation_aggregate(slide_name):
+    """Instance counts, class histograms and area statistics inside one or more polygons
+    
+    Takes {"polygons": [polygon, ...]} (or a single "polygon") in level 0 coordinates; an instance is
+    inside when its centroid is. Answers from the instance grid index built with the density maps, and
+    caches each polygon's result by a hash of its coordinates.
+    """
+    try:
+        params = request.get_json(silent=True) or {}
+        polygons = params['polygons'] if 'polygons' in params else [params['polygon']]
+        polygons = [parse_polygon(polygon) for polygon in polygons]
+        if sum(len(ring) for rings in polygons for ring in rings) > MAX_POLYGON_VERTICES:
+            return jsonify({'error': f'More than {MAX_POLYGON_VERTICES} polygon vertices'}), 400
+    except (TypeError, ValueError, KeyError, IndexError) as e:
+        return jsonify({'error': f'Invalid polygons: {str(e)}'}), 400
+    
+    try:
+        index = get_instance_index(slide_name)
+        if index is None:
+            return jsonify({'error': 'Instance index not built', 'build': f'/api/slides/{slide_name}/density/build'}), 404
+        
+        results = []
+        with scheduler.slot(INTERACTIVE, request_id=get_request_id()):
+            for rings in polygons:
+                digest = polygon_digest(rings)
+                key = ('aggregate', slide_name, index.version, digest)
+                cached = aggregate_cache.get(key)
+                if cached is not None:
+                    result = cached[0]
+                else:
+                    result = index.aggregate(rings)
+                    result['hash'] = digest
+                    result['polygonArea'] = polygon_area(rings)
+                    aggregate_cache.put(key, result, None, size=1024 + 64 * len(result['classes']))
+                results.append(result)
+        return jsonify({'results': results, 'classes': index.classes}), 200
+    except CancelledError as e:
+        return cancelled_response(e)
+    except DuplicateRequestError as e:
+        return duplicate_response(e)
+    except Exception as e:
+        print(f"Error aggregating polygons: {str(e)}")
+        return jsonify({'error': f'Error aggregating polygons: {str(e)}'}), 500
+
+@app.route('/api/slides/<slide_name>/export', methods=['GET'])
+def export_region(slide_name):
+    """Export a level 0 rectangle at a target magnification as a pyramidal TIFF, PNG or JPEG"""
+    try:
+        slide = get_cached_slide(slide_name)
+        if slide is None:
+            return jsonify({'error': 'Slide not found'}), 404
+        
+        # Parse the level 0 rectangle and the target resolution, as a magnification (e.g. 10 for 10x)
+        # or directly as a downsample
+        base_magnification = objective_power(slide)
+        try:
+            x = int(float(request.args.get('x', 0)))
+            y = int(float(request.args.get('y', 0)))
+            width = int(float(request.args.get('width', slide.dimensions[0] - x)))
+            height = int(float(request.args.get('height', slide.dimensions[1] - y)))
+            if 'downsample' in request.args:
+                downsample = float(request.args['downsample'])
+            else:
+                magnification = float(request.args.get('magnification', base_magnification))
+                downsample = base_magnification / magnification if magnification > 0 else 0.0
+        except (TypeError, ValueError, OverflowError) as e:
+            return jsonify({'error': f'Invalid region parameters: {str(e)}'}), 400
+        if width <= 0 or height <= 0:
+            return jsonify({'error': 'Width and height must be positive'}), 400
+        if x >= slide.dimensions[0] or y >= slide.dimensions[1] or x + width <= 0 or y + height <= 0:
+            return jsonify({'error': 'Region does not intersect the slide'}), 400
+        if not (math.isfinite(downsample) and downsample > 0):
+            return jsonify({'error': 'Magnification and downsample must be positive numbers'}), 400
+        if downsample < 1:
+            return jsonify({'error': f'Magnification cannot exceed the scan magnification ({base_magnification}x)'}), 400
+        
+        export_format = request.args.get('format', 'tiff').lower()
+        if export_format not in ('tiff', 'png', 'jpeg'):
+            return jsonify({'error': 'Format must be one of tiff, png, jpeg'}), 400
+        
+        out_width = max(1, int(round(width / downsample)))
+        out_height = max(1, int(round(height / downsample)))
+        if export_format == 'jpeg' and out_width * out_height > MAX_JPEG_PIXELS:
+            return jsonify({'error': 'Region too large for JPEG export, use format=png or format=tiff'}), 400
+        
+        with_overlay = request.args.get('overlay', 'false').lower() in ('1', 'true', 'yes')
+        request_id = get_request_id()
+        filename = f"{os.path.splitext(slide_name)[0]}_{x}_{y}_{out_width}x{out_height}.{'tif' if export_format == 'tiff' else export_format}"
+        print(f"Exporting {slide_name} region ({x}, {y}, {width}, {height}) at downsample {downsample} "
+              f"as {export_format} {out_width}x{out_height}, overlay={with_overlay}")
+        
+        @contextmanager
+        def export_slot():
+            """Open the segmentation if requested and hold a batch slot; yields (overlay, checkpoint)"""
+            h5_file, read_labels = open_label_reader(slide_name, slide) if with_overlay else (None, None)
+            overlay = (read_labels, label_color) if read_labels is not None else None
+            try:
+                with scheduler.slot(BATCH, request_id=request_id) as task:
+                    yield overlay, lambda: scheduler.checkpoint(task)
+            finally:
+                if h5_file is not None:
+                    h5_file.close()
+        
+        headers = {'Content-Disposition': f'attachment; filename="{filename}"'}
+        
+        if export_format == 'jpeg':
+            with export_slot() as (overlay, checkpoint):
+                bands = iter_bands(slide, x, y, downsample, out_width, out_height, overlay, checkpoint)
+                data = encode_jpeg(out_width, out_height, bands)
+            return Response(data, mimetype='image/jpeg', headers=headers)
+        
+        if export_format == 'png':
+            def generate_png():
+                # Runs while the response streams: one band of rows is read, encoded and sent at a time
+                try:
+                    with export_slot() as (overlay, checkpoint):
+                        bands = iter_bands(slide, x, y, downsample, out_width, out_height, overlay, checkpoint)
+                        yield from stream_png(out_width, out_height, bands)
+                except (CancelledError, DuplicateRequestError) as e:
+                    print(f"Export stopped: {e}")
+            return Response(generate_png(), mimetype='image/png', headers=headers)
+        
+        # TIFF needs random access while writing, so it is written tile by tile to a temporary file first
+        path = temporary_tiff_path()
+        try:
+            with export_slot() as (overlay, checkpoint):
+                write_pyramidal_tiff(path, slide, x, y, downsample, out_width, out_height, overlay, checkpoint)
+        except BaseException:
+            os.remove(path)
+            raise
+        headers['Content-Length'] = str(os.path.getsize(path))
+        return Response(stream_file(path), mimetype='image/tiff', headers=headers)
+    
+    except CancelledError as e:
+        return cancelled_response(e)
+    except DuplicateRequestError as e:
+        return duplicate_response(e)
+    except Exception as e:
+        print(f"Error exporting region: {str(e)}")
+        return jsonify({'error': f'Error exporting region: {str(e)}'}), 500
+
 # Helper function to generate mock contours
-def generate_mock_contours(x, y, width, height):
+def generate_mock_contours(x, y, width, height, stream=False):
     """Generate random contours for testing or when H5 file not available"""
+    return contours_response(mock_contours(x, y, width, height), stream)
+
+def mock_contours(x, y, width, height):
+    """Random polygons within the viewport"""
     print("Generating mock contours")
     # Generate random contours within the viewport
     num_contours = 20
@@ -539,7 +1428,7 @@ def generate_mock_contours(x, y, width, height):
             'color': f'#{np.random.randint(0, 256):02x}{np.random.randint(0, 256):02x}{np.random.randint(0, 256):02x}'
         })
     
-    return jsonify({'data': contours}), 200
+    return contours
 
 # Helper function to get slide info as dict
 def get_slide_info_dict(slide_name):
@@ -551,7 +1440,7 @@ def get_slide_info_dict(slide_name):
             
         if slide_name not in slides:
             try:
-                slides[slide_name] = WSISlide(file_path)
+                slides[slide_name] = open_wsi(file_path)
             except Exception as e:
                 print(f"Error loading slide: {e}")
                 return None
@@ -646,11 +1535,15 @@ if __name__ == '__main__':
     print(f"WSI Backend Server starting on port {PORT}")
     print(f"Looking for slides in: {SLIDE_DIR}")
     
-    # List all slide files in the directory
-    slide_files = [f for f in os.listdir(SLIDE_DIR) if allowed_file(f)]
-    print(f"Found {len(slide_files)} slide files:")
-    for slide_file in slide_files:
-        print(f" - {slide_file}")
+    # Fail early without paying for the import; the reader itself is loaded in the background
+    if not any(importlib.util.find_spec(module_name) for module_name, _ in SLIDE_BACKENDS):
+        print("ERROR: Neither OpenSlide nor TiffSlide is installed. Please install one of them.")
+        print("You can install OpenSlide with: pip install openslide-python")
+        print("Or TiffSlide with: pip install tiffslide")
+        sys.exit(1)
+    
+    # Load the slide reader and list the slide files while the server already answers /api/health
+    start_warm_up()
     
     # Add CORS headers to all responses
     @app.after_request
@@ -658,10 +1551,10 @@ if __name__ == '__main__':
         response.headers.add('Access-Control-Allow-Origin', '*')
         response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,X-Requested-With,Accept')
         response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
-        # Add cache control for images
-        if response.mimetype.startswith('image/'):
+        # Add cache control for images, unless the route chose its own (e.g. the rebuildable density tiles)
+        if response.mimetype.startswith('image/') and 'Cache-Control' not in response.headers:
             response.headers['Cache-Control'] = 'public, max-age=86400'  # 24 hours
         return response
         
     # Start the server
-    app.run(host='0.0.0.0', port=PORT, debug=True) 
\ No newline at end of file
+    app.run(host='0.0.0.0', port=PORT, debug=DEBUG) 
\ No newline at end of file
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+from make_fixtures import make_fixture  # noqa: E402
+
+WIDTH, HEIGHT = 1024, 1024
+
+
+@pytest.fixture(scope='module')
+def h5_path(tmp_path_factory):
+    _, seg_path = make_fixture(str(tmp_path_factory.mktemp('slides')), name='geometry.tiff', width=WIDTH,
+                               height=HEIGHT, density=200, levels=1)
+    return seg_path
+
+
+def test_mask_shapes_stay_bounded(h5_path, monkeypatch):
+    import server
+    from scripts.tile_cache import TileCache
+    monkeypatch.setattr(server, 'mask_shapes', TileCache(max_bytes=2))
+    viewport = [(0, 0, 512, 512)]
+    first = server.instances_in_viewports(h5_path, WIDTH, HEIGHT, viewport)[0]
+    assert first
+    for version in range(1, 5):
+        # A rewritten mask is a new key; the oldest shapes are evicted
+        os.utime(h5_path, (1_000_000 + version, 1_000_000 + version))
+        assert server.instances_in_viewports(h5_path, WIDTH, HEIGHT, viewport)[0].keys() == first.keys()
+    assert server.mask_shapes.stats()['entries'] == 2
+    assert server.mask_shapes.get((h5_path, os.path.getmtime(h5_path))) == ((HEIGHT, WIDTH), None)
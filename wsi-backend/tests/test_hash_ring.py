@@ -0,0 +1,61 @@
+from collections import Counter
+
+from scripts.hash_ring import ConsistentHashRing
+
+NODES = [f'http://10.0.0.{i}:5000' for i in range(1, 5)]
+KEYS = [f'slide-{i:05d}.svs' for i in range(5000)]
+
+
+def assignment(ring):
+    return {key: ring.get_node(key) for key in KEYS}
+
+
+def test_empty_ring():
+    ring = ConsistentHashRing()
+    assert ring.get_node('slide.svs') is None
+    assert len(ring) == 0
+
+
+def test_assignment_is_deterministic():
+    # Independent of insertion order and of the process (no salted hash())
+    assert assignment(ConsistentHashRing(NODES)) == assignment(ConsistentHashRing(reversed(NODES)))
+
+
+def test_keys_spread_over_nodes():
+    counts = Counter(assignment(ConsistentHashRing(NODES)).values())
+    assert set(counts) == set(NODES)
+    assert max(counts.values()) < 2 * len(KEYS) / len(NODES)
+
+
+def test_adding_a_node_only_moves_keys_to_it():
+    ring = ConsistentHashRing(NODES)
+    before = assignment(ring)
+    assert ring.add('http://10.0.0.5:5000')
+    assert not ring.add('http://10.0.0.5:5000')
+    after = assignment(ring)
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert all(after[key] == 'http://10.0.0.5:5000' for key in moved)
+    assert 0.5 / 5 < len(moved) / len(KEYS) < 1.5 / 5
+
+
+def test_removing_a_node_only_moves_its_keys():
+    ring = ConsistentHashRing(NODES)
+    before = assignment(ring)
+    assert ring.remove(NODES[0])
+    assert not ring.remove(NODES[0])
+    after = assignment(ring)
+    for key in KEYS:
+        if before[key] == NODES[0]:
+            assert after[key] != NODES[0]
+        else:
+            assert after[key] == before[key]
+    assert NODES[0] not in ring
+    assert ring.members() == sorted(NODES[1:])
+
+
+def test_remove_then_add_restores_assignment():
+    ring = ConsistentHashRing(NODES)
+    before = assignment(ring)
+    ring.remove(NODES[2])
+    ring.add(NODES[2])
+    assert assignment(ring) == before
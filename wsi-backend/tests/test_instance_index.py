@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from scripts.instance_index import GRID_CELL, InstanceIndex, polygon_area, polygon_digest, write_instance_index
+
+WIDTH, HEIGHT = 5000, 4000
+CLASSES = ['tumor', 'stroma', 'immune']
+
+
+@pytest.fixture(scope='module')
+def index(tmp_path_factory):
+    rng = np.random.default_rng(5)
+    count = 20000
+    xs, ys = rng.uniform(0, WIDTH, count), rng.uniform(0, HEIGHT, count)
+    # Centroids exactly on grid lines, where cell and edge bookkeeping is most likely to slip
+    xs[:1000] = np.round(xs[:1000] / GRID_CELL) * GRID_CELL
+    ys[500:1500] = np.round(ys[500:1500] / GRID_CELL) * GRID_CELL
+    classes = rng.integers(0, len(CLASSES), count)
+    areas = rng.uniform(1, 100, count)
+    areas[::7] = np.nan  # Instances without a known area
+    directory = tmp_path_factory.mktemp('density')
+    grid = write_instance_index(str(directory), xs, ys, classes, areas, WIDTH, HEIGHT)
+    return InstanceIndex(str(directory), {'instanceGrid': grid, 'classes': CLASSES, 'builtAt': 0})
+
+
+def brute_force_inside(xs, ys, rings):
+    """Even-odd rule with a horizontal ray to the right, one point at a time."""
+    inside = np.zeros(len(xs), dtype=bool)
+    for ring in rings:
+        for (x0, y0), (x1, y1) in zip(ring, np.roll(ring, -1, axis=0)):
+            if y0 == y1:
+                continue
+            inside ^= ((y0 > ys) != (y1 > ys)) & (xs < x0 + (ys - y0) * (x1 - x0) / (y1 - y0))
+    return inside
+
+
+def star(rng, center, radius, vertices):
+    angles = np.sort(rng.uniform(0, 2 * np.pi, vertices))
+    scale = radius * rng.uniform(0.2, 1, vertices)
+    return np.stack([center[0] + scale * np.cos(angles), center[1] + scale * np.sin(angles)], axis=1)
+
+
+def polygons():
+    rng = np.random.default_rng(11)
+    for trial in range(40):
+        yield [star(rng, rng.uniform(-500, 5500, 2), rng.uniform(20, 4000), rng.integers(3, 60))]
+        # Rectangle with its sides on grid lines
+        a = rng.integers(-2, 22, 2) * GRID_CELL
+        b = a + rng.integers(1, 10, 2) * GRID_CELL
+        yield [np.array([[a[0], a[1]], [b[0], a[1]], [b[0], b[1]], [a[0], b[1]]], dtype=float)]
+        # Self-intersecting
+        yield [rng.uniform(-200, 5200, (rng.integers(3, 30), 2))]
+        # Grid-snapped outline with a hole
+        center, radius = rng.uniform(1000, 4000, 2), rng.uniform(500, 2000)
+        outer = np.round(star(rng, center, radius, rng.integers(3, 20)) / GRID_CELL) * GRID_CELL
+        yield [outer, star(rng, center, radius / 3, rng.integers(3, 20))]
+
+
+@pytest.mark.parametrize('rings', list(polygons()))
+def test_aggregate_matches_brute_force(index, rings):
+    result = index.aggregate(rings)
+    inside = brute_force_inside(index.xs, index.ys, rings)
+    assert result['count'] == inside.sum()
+    assert list(result['classes'].values()) == np.bincount(index.instance_classes[inside], minlength=3).tolist()
+    areas = index.areas[inside]
+    areas = areas[~np.isnan(areas)]
+    if not areas.size:
+        assert result['area'] is None
+        return
+    assert result['area']['total'] == pytest.approx(areas.sum())
+    assert result['area']['mean'] == pytest.approx(areas.mean())
+    assert result['area']['std'] == pytest.approx(areas.std(), rel=1e-6, abs=1e-6)
+    assert (result['area']['min'], result['area']['max']) == (areas.min(), areas.max())
+
+
+def test_polygon_outside_the_slide(index):
+    ring = np.array([[-900, -900], [-100, -900], [-100, -100], [-900, -100]], dtype=float)
+    result = index.aggregate([ring])
+    assert result['count'] == 0
+    assert result['area'] is None
+    assert set(result['classes']) == set(CLASSES)
+
+
+def test_polygon_area_subtracts_holes():
+    outer = np.array([[0, 0], [10, 0], [10, 10], [0, 10]], dtype=float)
+    hole = np.array([[2, 2], [4, 2], [4, 4], [2, 4]], dtype=float)
+    assert polygon_area([outer]) == 100
+    assert polygon_area([outer[::-1], hole]) == 96
+
+
+def test_polygon_digest_depends_on_coordinates():
+    ring = np.array([[0, 0], [10, 0], [10, 10]], dtype=float)
+    assert polygon_digest([ring]) == polygon_digest([ring.astype(np.float32)])
+    assert polygon_digest([ring]) != polygon_digest([ring + 0.5])
+    assert polygon_digest([ring]) != polygon_digest([ring[:2], ring[2:]])
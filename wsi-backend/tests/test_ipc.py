@@ -0,0 +1,183 @@
+import io
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+from scripts import ipc
+from scripts.ipc import (
+    ARRAY_ALIGNMENT, CANCEL, FRAME_HEADER, REQUEST, RESPONSE, SHM_THRESHOLD, IPCClient, IPCConnection,
+    IPCError, SegmentPool, layout_arrays, pack_arrays, read_frame, unpack_arrays, write_frame,
+)
+
+TIMEOUT = 5
+
+
+def test_frame_round_trip():
+    stream = io.BytesIO()
+    lock = threading.Lock()
+    write_frame(stream, lock, REQUEST, 7, {'method': 'tile', 'params': {'level': 2}})
+    write_frame(stream, lock, RESPONSE, 8, {'result': 'ok'}, b'\x00\x01binary')
+    write_frame(stream, lock, CANCEL, 9)
+    stream.seek(0)
+
+    kind, request_id, meta, payload = read_frame(stream)
+    assert (kind, request_id, meta, bytes(payload)) == (REQUEST, 7, {'method': 'tile', 'params': {'level': 2}}, b'')
+    kind, request_id, meta, payload = read_frame(stream)
+    assert (kind, request_id, meta, bytes(payload)) == (RESPONSE, 8, {'result': 'ok'}, b'\x00\x01binary')
+    kind, request_id, meta, payload = read_frame(stream)
+    assert (kind, request_id, meta, bytes(payload)) == (CANCEL, 9, {}, b'')
+    assert read_frame(stream) is None
+
+
+def test_truncated_frame_is_end_of_stream():
+    stream = io.BytesIO()
+    write_frame(stream, threading.Lock(), RESPONSE, 1, {'result': 1}, b'x' * 100)
+    for size in (FRAME_HEADER.size - 1, FRAME_HEADER.size + 10):
+        assert read_frame(io.BytesIO(stream.getvalue()[:size])) is None
+
+
+def test_invalid_header_is_rejected():
+    with pytest.raises(IPCError):
+        read_frame(io.BytesIO(FRAME_HEADER.pack(10, 1, REQUEST, 11)))
+    with pytest.raises(IPCError):
+        read_frame(io.BytesIO(FRAME_HEADER.pack(ipc.MAX_FRAME_BYTES + 1, 1, REQUEST, 0)))
+
+
+def test_array_round_trip():
+    arrays = {
+        'points': np.arange(30, dtype=np.float32).reshape(-1, 2),
+        'labels': np.array([3, 1, 4], dtype=np.int32),
+        'colors': np.arange(9, dtype=np.uint8).reshape(3, 3),
+        'empty': np.zeros((0, 2), dtype=np.float64),
+        'wide': np.array([2 ** 40, -1], dtype='>i8'),
+    }
+    specs, size = layout_arrays(arrays)
+    assert all(spec['offset'] % ARRAY_ALIGNMENT == 0 for spec in specs)
+    buffer = bytearray(size)
+    pack_arrays(buffer, arrays, specs)
+    unpacked = unpack_arrays(memoryview(buffer), specs)
+    assert list(unpacked) == list(arrays)
+    for name, array in arrays.items():
+        assert unpacked[name].dtype == array.dtype
+        np.testing.assert_array_equal(unpacked[name], array)
+
+
+def segment_exists(name):
+    try:
+        shared_memory.SharedMemory(name=name).close()
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def test_segment_pool_reuses_and_trims_released_segments():
+    pool = SegmentPool(free_per_size=2)
+    try:
+        segments = [pool.acquire(100_000) for _ in range(5)]
+        assert {segment.size for segment in segments} == {128 * 1024}
+        for segment in segments:
+            assert pool.release(segment.name)
+        assert not pool.release(segments[0].name)
+        # Only two are kept for reuse; the rest of the burst is unlinked
+        assert [segment_exists(segment.name) for segment in segments] == [True, True, False, False, False]
+        assert pool.stats() == {'inUse': 0, 'inUseBytes': 0, 'free': 2, 'created': 5, 'reused': 0, 'trimmed': 3}
+        assert pool.acquire(120_000).name in {segments[0].name, segments[1].name}
+        assert pool.stats()['reused'] == 1
+    finally:
+        pool.close()
+    assert not any(segment_exists(segment.name) for segment in segments)
+
+
+def test_segment_pool_budget():
+    pool = SegmentPool(max_bytes=256 * 1024)
+    try:
+        first = pool.acquire(SHM_THRESHOLD * 2)
+        assert pool.acquire(SHM_THRESHOLD * 2) is not None
+        assert pool.acquire(1) is None
+        pool.release(first.name)
+        assert pool.acquire(1) is not None
+    finally:
+        pool.close()
+
+
+@pytest.fixture
+def connect(monkeypatch):
+    """Serve `handlers` on one end of a socket pair and return a client on the other."""
+    # Both ends share this process's resource tracker, which must see the server's unlink of the segment
+    monkeypatch.setattr(ipc, '_attach_segment', lambda name: shared_memory.SharedMemory(name=name))
+    started = []
+
+    def start(handlers, shared_memory=True):
+        server_sock, client_sock = socket.socketpair()
+        executor = ThreadPoolExecutor(4)
+        cancelled = []
+        connection = IPCConnection(server_sock.makefile('rb'), server_sock.makefile('wb'), handlers, executor,
+                                   on_cancel=cancelled.append)
+        thread = threading.Thread(target=connection.serve, daemon=True)
+        thread.start()
+        client = IPCClient(client_sock.makefile('rb'), client_sock.makefile('wb'), shared_memory=shared_memory)
+        started.append((client, client_sock, server_sock, thread, executor))
+        return client, cancelled
+
+    yield start
+    for client, client_sock, server_sock, thread, executor in started:
+        client.close()
+        client_sock.shutdown(socket.SHUT_RDWR)
+        thread.join(TIMEOUT)
+        server_sock.close()
+        client_sock.close()
+        executor.shutdown()
+
+
+def echo(params, call):
+    size = params['size']
+    return {'size': size}, {'data': np.arange(size, dtype=np.uint32), 'tag': np.array([params['tag']])}
+
+
+@pytest.mark.parametrize('shared_memory', [True, False])
+@pytest.mark.parametrize('size', [10, SHM_THRESHOLD])
+def test_call_round_trip(connect, shared_memory, size):
+    client, _ = connect({'echo': echo}, shared_memory=shared_memory)
+    assert client.server_info['sharedMemory'] is shared_memory
+    with client.call('echo', timeout=TIMEOUT, size=size, tag=5) as reply:
+        assert reply.result == {'size': size}
+        np.testing.assert_array_equal(reply.arrays['data'], np.arange(size, dtype=np.uint32))
+        assert reply.arrays['tag'].tolist() == [5]
+        assert (reply.segment_name is not None) == (shared_memory and size * 4 >= SHM_THRESHOLD)
+
+
+def test_errors_are_reported(connect):
+    def fail(params, call):
+        raise IPCError('bad_request', 'nope')
+
+    client, _ = connect({'fail': fail})
+    with pytest.raises(IPCError) as error:
+        client.call('fail', timeout=TIMEOUT)
+    assert (error.value.code, str(error.value)) == ('bad_request', 'nope')
+    with pytest.raises(IPCError) as error:
+        client.call('missing', timeout=TIMEOUT)
+    assert error.value.code == 'unknown_method'
+
+
+def test_cancel_reaches_handler(connect):
+    started = threading.Event()
+
+    def slow(params, call):
+        started.set()
+        while True:
+            call.check()
+            threading.Event().wait(0.01)
+
+    client, cancelled = connect({'slow': slow})
+    future = client.call_async('slow')
+    assert started.wait(TIMEOUT)
+    client.cancel(future)
+    with pytest.raises(IPCError) as error:
+        future.result(TIMEOUT)
+    assert error.value.code == 'cancelled'
+    # The call's scheduler key is passed on so queued or running work can be dropped
+    assert len(cancelled) == 1 and cancelled[0].endswith(f'-{future.request_id}')
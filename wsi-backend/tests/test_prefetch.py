@@ -0,0 +1,64 @@
+import pytest
+
+from scripts import prefetch
+from scripts.prefetch import TilePrefetcher
+from scripts.scheduler import BATCH, INTERACTIVE, PREFETCH, WorkScheduler
+
+LEVELS = ([(25400, 25400), (6350, 6350)], [1.0, 4.0])
+
+
+@pytest.fixture
+def prefetcher(monkeypatch):
+    monkeypatch.setattr(prefetch, 'idle_cpu_fraction', lambda: 1.0)
+    # No prefetch slots: predictions stay queued so the test can inspect them
+    scheduler = WorkScheduler({INTERACTIVE: 1, PREFETCH: 0, BATCH: 1})
+    return TilePrefetcher(lambda *key: (b'tile', 'image/jpeg'), set(), lambda slide_name: LEVELS, scheduler)
+
+
+def pending(prefetcher):
+    return dict(prefetcher.pending[('viewer', 'slide.svs')])
+
+
+def test_keeps_predictions_that_are_still_wanted(prefetcher):
+    prefetcher.record('viewer', 'slide.svs', 1, 10, 10, False)
+    first = pending(prefetcher)
+    assert first
+
+    prefetcher.record('viewer', 'slide.svs', 1, 11, 10, False)
+    second = pending(prefetcher)
+    kept = first.keys() & second.keys()
+    dropped = first.keys() - second.keys()
+    assert kept and dropped
+    # Still-wanted predictions keep their task (and so their place in the queue)
+    assert all(second[key] is first[key] for key in kept)
+    assert all(first[key].status == 'cancelled' for key in dropped)
+    assert all(task.status == 'queued' for task in second.values())
+    assert prefetcher.stats()['stale'] == len(dropped)
+    assert prefetcher.scheduler.stats()['prefetch']['queued'] == len(second)
+
+
+def test_repeated_request_schedules_nothing_new(prefetcher):
+    prefetcher.record('viewer', 'slide.svs', 1, 10, 10, False)
+    first = pending(prefetcher)
+    prefetcher.record('viewer', 'slide.svs', 1, 10, 10, False)
+    assert pending(prefetcher) == first
+    assert prefetcher.stats()['stale'] == 0
+    assert prefetcher.scheduler.stats()['prefetch']['queued'] == len(first)
+
+
+def test_cached_tiles_are_not_scheduled(prefetcher):
+    prefetcher.record('viewer', 'slide.svs', 1, 10, 10, False)
+    keys = list(pending(prefetcher))
+    prefetcher.scheduler.cancel_group(('prefetch', 'viewer', 'slide.svs'))
+    prefetcher.cache.update(keys[:5])
+    prefetcher.record('viewer', 'slide.svs', 1, 10, 10, False)
+    assert set(pending(prefetcher)) == set(keys[5:])
+
+
+def test_cancelled_entries_do_not_pile_up_in_the_queue(prefetcher):
+    for step in range(200):
+        prefetcher.record('viewer', 'slide.svs', 1, 5 + step % 15, 5 + step % 7, False)
+    scheduler = prefetcher.scheduler
+    live = scheduler.stats()['prefetch']['queued']
+    assert live == len(pending(prefetcher))
+    assert len(scheduler.queue) <= 2 * live + 1
@@ -0,0 +1,115 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+from make_fixtures import make_fixture  # noqa: E402
+
+SLIDE = 'export.tiff'
+WIDTH, HEIGHT = 2048, 1536
+
+
+@pytest.fixture(scope='module')
+def slide_dir(tmp_path_factory):
+    out_dir = tmp_path_factory.mktemp('slides')
+    make_fixture(str(out_dir), name=SLIDE, width=WIDTH, height=HEIGHT, density=50, levels=2)
+    return str(out_dir)
+
+
+@pytest.fixture
+def client(slide_dir, monkeypatch):
+    import server
+    monkeypatch.setattr(server, 'SLIDE_DIR', slide_dir)
+    return server.app.test_client()
+
+
+def export(client, **params):
+    return client.get(f'/api/slides/{SLIDE}/export', query_string=params)
+
+
+@pytest.mark.parametrize('params', [
+    {'magnification': 0},
+    {'magnification': -10},
+    {'magnification': 'nan'},
+    {'magnification': 'ten'},
+    {'downsample': 0},
+    {'downsample': -2},
+    {'downsample': 'inf'},
+    {'downsample': 0.5},
+    {'magnification': 80},
+])
+def test_rejects_bad_resolution(client, params):
+    response = export(client, x=0, y=0, width=256, height=256, format='png', **params)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+@pytest.mark.parametrize('rect', [
+    {'x': 0, 'y': 0, 'width': 0, 'height': 256},
+    {'x': 0, 'y': 0, 'width': 256, 'height': -1},
+    {'x': WIDTH, 'y': 0, 'width': 256, 'height': 256},
+    {'x': 0, 'y': HEIGHT + 100, 'width': 256, 'height': 256},
+    {'x': -512, 'y': 0, 'width': 256, 'height': 256},
+    {'x': 0, 'y': -256, 'width': 256, 'height': 256},
+    {'x': 'left', 'y': 0, 'width': 256, 'height': 256},
+])
+def test_rejects_bad_rectangle(client, rect):
+    response = export(client, format='png', downsample=1, **rect)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_rejects_unknown_format(client):
+    assert export(client, x=0, y=0, width=256, height=256, format='bmp').status_code == 400
+
+
+@pytest.mark.parametrize('fmt, signature', [('png', b'\x89PNG'), ('jpeg', b'\xff\xd8'), ('tiff', b'II')])
+def test_exports_region(client, fmt, signature):
+    response = export(client, x=100, y=200, width=1024, height=512, magnification=20, format=fmt)
+    assert response.status_code == 200
+    assert response.get_data()[:len(signature)] == signature
+    assert '_100_200_512x256.' in response.headers['Content-Disposition']
+
+
+def test_accepts_rectangle_overlapping_the_edge(client):
+    response = export(client, x=-100, y=HEIGHT - 100, width=300, height=300, downsample=1, format='png')
+    assert response.status_code == 200
+    assert response.get_data()[:4] == b'\x89PNG'
+
+
+def test_overlay_reads_one_mask_pixel_per_output_pixel(client, monkeypatch):
+    import server
+    reads = []
+    read_window = server.read_segmentation_window
+
+    def recording_read(*args):
+        window = read_window(*args)
+        reads.append(window.shape)
+        return window
+
+    monkeypatch.setattr(server, 'read_segmentation_window', recording_read)
+
+    h5_file, read_labels = server.open_label_reader(SLIDE, server.get_cached_slide(SLIDE))
+    try:
+        full = read_window(server.find_segmentation_dataset(h5_file), 0, HEIGHT, 0, WIDTH)
+        labels = read_labels(0, 0, WIDTH, HEIGHT, WIDTH // 32, HEIGHT // 32)
+    finally:
+        h5_file.close()
+    # Only the sampled pixels are pulled from the dataset, not the 2048 x 1536 full-resolution window
+    assert reads == [(HEIGHT // 32, WIDTH // 32)]
+    assert labels.shape == (HEIGHT // 32, WIDTH // 32)
+    # Every output pixel takes a label from its own 32 x 32 block of the mask
+    blocks = full.reshape(HEIGHT // 32, 32, WIDTH // 32, 32).transpose(0, 2, 1, 3).reshape(*labels.shape, -1)
+    assert (blocks == labels[..., None]).any(axis=2).all()
+
+
+def test_overlay_at_full_resolution_matches_the_mask(client):
+    import server
+    h5_file, read_labels = server.open_label_reader(SLIDE, server.get_cached_slide(SLIDE))
+    try:
+        full = server.read_segmentation_window(server.find_segmentation_dataset(h5_file), 200, 456, 100, 612)
+        labels = read_labels(100, 200, 512, 256, 512, 256)
+    finally:
+        h5_file.close()
+    assert (labels == full).all()
@@ -0,0 +1,235 @@
+import threading
+import time
+
+import pytest
+
+from scripts.scheduler import BATCH, INTERACTIVE, PREFETCH, CancelledError, DuplicateRequestError, WorkScheduler
+
+TIMEOUT = 5
+
+
+def wait_until(predicate, timeout=TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, 'condition not reached in time'
+        time.sleep(0.005)
+
+
+def hold_slot(scheduler, priority, release, **kwargs):
+    """Occupy a caller slot in a background thread until `release` is set; returns (thread, entered)."""
+    entered = threading.Event()
+
+    def body():
+        with scheduler.slot(priority, **kwargs):
+            entered.set()
+            release.wait(TIMEOUT)
+
+    thread = threading.Thread(target=body, daemon=True)
+    thread.start()
+    return thread, entered
+
+
+def test_workers_only_for_worker_classes():
+    scheduler = WorkScheduler({INTERACTIVE: 16, PREFETCH: 3, BATCH: 2})
+    assert len(scheduler.workers) == 5
+
+
+def test_interactive_runs_before_queued_background_work():
+    scheduler = WorkScheduler({INTERACTIVE: 1, PREFETCH: 1, BATCH: 1})
+    order = []
+    release = threading.Event()
+    holder, entered = hold_slot(scheduler, INTERACTIVE, release)
+    assert entered.wait(TIMEOUT)
+
+    batch = scheduler.submit(BATCH, order.append, 'batch')
+    prefetch = scheduler.submit(PREFETCH, order.append, 'prefetch')
+    waiter, _ = hold_slot(scheduler, INTERACTIVE, release)
+    # Nothing in a lower class may start while interactive work is queued or running
+    time.sleep(0.05)
+    assert order == []
+
+    release.set()
+    waiter.join(TIMEOUT)
+    holder.join(TIMEOUT)
+    prefetch.wait(TIMEOUT)
+    batch.wait(TIMEOUT)
+    assert order == ['prefetch', 'batch']
+
+
+def test_interactive_limit():
+    scheduler = WorkScheduler({INTERACTIVE: 2})
+    release = threading.Event()
+    holders = [hold_slot(scheduler, INTERACTIVE, release) for _ in range(3)]
+    counts = lambda: (scheduler.stats()['interactive']['running'], scheduler.stats()['interactive']['queued'])  # noqa: E731
+    wait_until(lambda: counts() == (2, 1))
+    release.set()
+    for thread, entered in holders:
+        thread.join(TIMEOUT)
+        assert entered.is_set()
+    assert scheduler.stats()['interactive']['completed'] == 3
+
+
+def test_generator_batch_is_preempted_and_resumes():
+    scheduler = WorkScheduler({INTERACTIVE: 1, PREFETCH: 1, BATCH: 1})
+    step = threading.Semaphore(0)
+    done_steps = []
+
+    def job(steps):
+        for i in range(steps):
+            step.acquire(timeout=TIMEOUT)
+            done_steps.append(i)
+            yield i
+        return 'finished'
+
+    task = scheduler.submit(BATCH, job, 4, request_id='batch-job')
+    step.release()
+    wait_until(lambda: task.progress == 0)
+
+    # Interactive work arrives: the batch job gives up its slot at its next yield
+    release = threading.Event()
+    holder, entered = hold_slot(scheduler, INTERACTIVE, release)
+    assert entered.wait(TIMEOUT)
+    step.release()
+    wait_until(lambda: task.preemptions == 1 and task.status == 'queued')
+    assert done_steps == [0, 1]
+
+    release.set()
+    holder.join(TIMEOUT)
+    step.release()
+    step.release()
+    assert task.wait(TIMEOUT) == 'finished'
+    assert done_steps == [0, 1, 2, 3]
+    assert scheduler.get_task('batch-job').info()['status'] == 'done'
+
+
+def test_checkpoint_steps_aside_for_interactive_work():
+    scheduler = WorkScheduler({INTERACTIVE: 1, BATCH: 1})
+    with scheduler.slot(BATCH) as task:
+        scheduler.checkpoint(task)
+        assert task.preemptions == 0
+        release = threading.Event()
+        holder, entered = hold_slot(scheduler, INTERACTIVE, release)
+        assert entered.wait(TIMEOUT)
+        threading.Timer(0.05, release.set).start()
+        # Gives up the slot and is admitted again once the interactive request is done
+        scheduler.checkpoint(task)
+        assert task.preemptions == 1
+        assert scheduler.stats()['interactive']['completed'] == 1
+    holder.join(TIMEOUT)
+
+
+def test_cancel_queued_task():
+    scheduler = WorkScheduler({INTERACTIVE: 1, BATCH: 1})
+    release = threading.Event()
+    holder, entered = hold_slot(scheduler, INTERACTIVE, release)
+    assert entered.wait(TIMEOUT)
+    ran = []
+    task = scheduler.submit(BATCH, ran.append, 1, request_id='queued')
+    assert scheduler.cancel('queued')
+    assert task.status == 'cancelled'
+    with pytest.raises(CancelledError):
+        task.wait(TIMEOUT)
+    release.set()
+    holder.join(TIMEOUT)
+    assert ran == []
+    assert scheduler.stats()['batch'] == {'limit': 1, 'running': 0, 'queued': 0, 'completed': 0, 'cancelled': 1}
+    assert not scheduler.cancel('unknown')
+
+
+def test_cancel_running_generator_stops_at_next_yield():
+    scheduler = WorkScheduler({BATCH: 1})
+    started = threading.Event()
+    closed = threading.Event()
+
+    def job():
+        try:
+            while True:
+                started.set()
+                time.sleep(0.01)
+                yield
+        finally:
+            closed.set()
+
+    task = scheduler.submit(BATCH, job, request_id='running')
+    assert started.wait(TIMEOUT)
+    assert scheduler.cancel('running')
+    with pytest.raises(CancelledError):
+        task.wait(TIMEOUT)
+    assert closed.is_set()
+
+
+def test_cancel_group():
+    scheduler = WorkScheduler({INTERACTIVE: 1, PREFETCH: 1})
+    release = threading.Event()
+    holder, entered = hold_slot(scheduler, INTERACTIVE, release)
+    assert entered.wait(TIMEOUT)
+    tasks = [scheduler.submit(PREFETCH, lambda: None, group='viewport') for _ in range(5)]
+    other = scheduler.submit(PREFETCH, lambda: 'kept', group='other')
+    assert scheduler.cancel_group('viewport') == 5
+    assert all(task.status == 'cancelled' for task in tasks)
+    release.set()
+    holder.join(TIMEOUT)
+    assert other.wait(TIMEOUT) == 'kept'
+
+
+def test_waiting_slot_raises_when_cancelled():
+    scheduler = WorkScheduler({INTERACTIVE: 1})
+    release = threading.Event()
+    holder, entered = hold_slot(scheduler, INTERACTIVE, release)
+    assert entered.wait(TIMEOUT)
+    errors = []
+
+    def waiter():
+        try:
+            with scheduler.slot(INTERACTIVE, request_id='waiting'):
+                pass
+        except CancelledError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=waiter, daemon=True)
+    thread.start()
+    wait_until(lambda: scheduler.stats()['interactive']['queued'] == 1)
+    assert scheduler.cancel('waiting')
+    thread.join(TIMEOUT)
+    assert len(errors) == 1
+    release.set()
+    holder.join(TIMEOUT)
+
+
+def test_duplicate_request_id_is_rejected_while_live():
+    scheduler = WorkScheduler({INTERACTIVE: 2})
+    release = threading.Event()
+    holder, entered = hold_slot(scheduler, INTERACTIVE, release, request_id='same')
+    assert entered.wait(TIMEOUT)
+    with pytest.raises(DuplicateRequestError):
+        with scheduler.slot(INTERACTIVE, request_id='same'):
+            pass
+    with pytest.raises(DuplicateRequestError):
+        scheduler.submit(BATCH, lambda: None, request_id='same')
+    # The original request is still the one that `cancel` and `get_task` see
+    assert scheduler.get_task('same').status == 'running'
+    release.set()
+    holder.join(TIMEOUT)
+
+    # Once finished, the ID can be used again
+    assert scheduler.run(BATCH, lambda: 'again', request_id='same', timeout=TIMEOUT) == 'again'
+
+
+def test_simultaneous_releases_start_every_waiting_caller():
+    # Both slots free up before either waiter wakes; starting the first waiter must wake the second
+    for _ in range(20):
+        scheduler = WorkScheduler({INTERACTIVE: 2})
+        release = threading.Event()
+        holders = [hold_slot(scheduler, INTERACTIVE, release) for _ in range(2)]
+        assert all(entered.wait(TIMEOUT) for _, entered in holders)
+        finish = threading.Event()
+        waiters = [hold_slot(scheduler, INTERACTIVE, finish) for _ in range(2)]
+        wait_until(lambda: scheduler.stats()['interactive']['queued'] == 2)
+        with scheduler.cond:
+            # Both holders are released while the lock is held, so their slots free up back to back
+            release.set()
+            time.sleep(0.05)
+        assert all(entered.wait(TIMEOUT) for _, entered in waiters)
+        finish.set()
+        for thread, _ in holders + waiters:
+            thread.join(TIMEOUT)
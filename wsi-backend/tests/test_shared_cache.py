@@ -0,0 +1,122 @@
+import hashlib
+import multiprocessing
+import os
+import uuid
+
+import numpy as np
+import pytest
+
+from scripts import shared_cache
+
+pytestmark = pytest.mark.skipif(shared_cache.fcntl is None, reason='the shared cache needs fcntl')
+
+
+@pytest.fixture
+def cache_name():
+    name = f'wsi-test-{uuid.uuid4().hex[:12]}'
+    yield name
+    shared_cache.remove(name)
+
+
+def payload(tile):
+    """Deterministic payload of a size that varies by key, so a torn read shows up as a mismatch."""
+    seed = hashlib.blake2b(str(tile).encode(), digest_size=8).digest()
+    return seed * (200 + tile * 37 % 4000)
+
+
+def stress_worker(name, pickled, seed, requests, errors, corrupted):
+    try:
+        cache = shared_cache.SharedTileCache(name, max_bytes=2 * 1024 * 1024, pickled=pickled)
+        ranks = np.random.default_rng(seed).zipf(1.2, size=requests * 2)
+        for tile in ranks[ranks <= 2000][:requests]:
+            tile = int(tile)
+            key = ('stress.svs', 0, tile, 0, 'jpeg')
+            expected = payload(tile)
+            cached = cache.get(key)
+            if cached is None:
+                cache.put(key, {'tile': tile, 'data': expected} if pickled else expected, 'image/jpeg')
+                continue
+            value, mimetype = cached
+            data = value['data'] if pickled else value
+            if data != expected or mimetype != 'image/jpeg':
+                corrupted.value += 1
+    except Exception:
+        errors.value += 1
+        raise
+
+
+@pytest.mark.parametrize('pickled', [False, True])
+def test_concurrent_workers_never_see_torn_entries(cache_name, pickled):
+    context = multiprocessing.get_context('fork')
+    errors = context.Value('i', 0)
+    corrupted = context.Value('i', 0)
+    shared_cache.SharedTileCache(cache_name, max_bytes=2 * 1024 * 1024, pickled=pickled).close()
+    workers = [context.Process(target=stress_worker, args=(cache_name, pickled, seed, 4000, errors, corrupted))
+               for seed in range(6)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=120)
+    assert [worker.exitcode for worker in workers] == [0] * len(workers)
+    assert errors.value == 0
+    assert corrupted.value == 0
+
+
+def test_entries_are_visible_across_processes(cache_name):
+    cache = shared_cache.SharedTileCache(cache_name, max_bytes=1024 * 1024)
+    context = multiprocessing.get_context('fork')
+    child = context.Process(target=lambda: shared_cache.SharedTileCache(cache_name).put('key', b'tile', 'image/png'))
+    child.start()
+    child.join(timeout=30)
+    assert cache.get('key') == (b'tile', 'image/png')
+    assert 'key' in cache
+    cache.close()
+
+
+def test_eviction_keeps_within_budget(cache_name):
+    cache = shared_cache.SharedTileCache(cache_name, max_bytes=1024 * 1024)
+    for i in range(400):
+        cache.put(('slide', i), os.urandom(8 * 1024), 'image/jpeg')
+    stats = cache.stats()
+    assert stats['evictions'] > 0
+    assert stats['arenaBytes'] <= stats['maxBytes']
+    assert cache.get(('slide', 0)) is None
+    assert cache.get(('slide', 399)) is not None
+    cache.close()
+
+
+def read_and_wait(name, read, done):
+    shared_cache.SharedTileCache(name).get('key')
+    read.set()
+    done.wait(30)
+
+
+def test_saved_bytes_count_every_live_reader(cache_name):
+    cache = shared_cache.SharedTileCache(cache_name, max_bytes=1024 * 1024)
+    cache.put('key', bytes(10000), 'image/png')
+    context = multiprocessing.get_context('fork')
+    read, done = context.Event(), context.Event()
+    child = context.Process(target=read_and_wait, args=(cache_name, read, done))
+    child.start()
+    try:
+        assert read.wait(30)
+        stats = cache.stats()
+        assert len(stats['workers']) == 2
+        assert stats['perProcessBytes'] == 20000
+        assert stats['savedBytes'] == 10000
+    finally:
+        done.set()
+        child.join(timeout=30)
+    cache.close()
+
+
+def test_undecodable_record_is_a_miss(cache_name):
+    cache = shared_cache.SharedTileCache(cache_name, max_bytes=1024 * 1024, pickled=True)
+    cache.put('key', {'a': 1}, None)
+    # Corrupt the pickled payload in place; the entry itself stays consistent
+    entry = cache._find(shared_cache.key_digest('key'))
+    position = shared_cache.ENTRY.unpack_from(cache.buf, entry)[4]
+    start = cache.arena_offset + position % cache.arena_size + shared_cache.RECORD.size
+    cache.buf[start:start + 4] = b'\xff\xff\xff\xff'
+    assert cache.get('key') is None
+    cache.close()
@@ -2,9 +2,13 @@ const { app, BrowserWindow, ipcMain, dialog } = require('electron');
 const path = require('path');
 const isDev = require('electron-is-dev');
 const fs = require('fs');
+const { PythonIpc } = require('./pythonIpc');
 
 // Keep a global reference of the window object to prevent garbage collection
 let mainWindow;
+// Python backend reached over framed pipes, started on first use
+let pythonIpc = null;
+const pythonCalls = new Map();
 
 // Create the main browser window
 function createWindow() {
@@ -52,6 +56,9 @@ app.whenReady().then(() => {
 
 // Quit the app when all windows are closed (except on macOS)
 app.on('window-all-closed', () => {
+  if (pythonIpc) {
+    pythonIpc.close();
+  }
   if (process.platform !== 'darwin') {
     app.quit();
   }
@@ -81,4 +88,29 @@ ipcMain.handle('check-api', async (event, apiUrl) => {
     console.error('API check failed:', error);
     return false;
   }
-}); 
\ No newline at end of file
+}); 
+
+// Call the Python backend over IPC; callId lets the renderer cancel the call
+ipcMain.handle('python-call', async (event, method, params, callId) => {
+  if (!pythonIpc || pythonIpc.closed) {
+    pythonIpc = new PythonIpc();
+    await pythonIpc.ready;
+  }
+  const controller = new AbortController();
+  if (callId !== undefined) {
+    pythonCalls.set(callId, controller);
+  }
+  try {
+    return await pythonIpc.call(method, params, { signal: controller.signal });
+  } finally {
+    pythonCalls.delete(callId);
+  }
+});
+
+ipcMain.handle('python-cancel', (event, callId) => {
+  const controller = pythonCalls.get(callId);
+  if (controller) {
+    controller.abort();
+  }
+  return Boolean(controller);
+});
@@ -9,4 +9,8 @@ contextBridge.exposeInMainWorld('electron', {
   
   // API health check
   checkApi: (apiUrl) => ipcRenderer.invoke('check-api', apiUrl),
+
+  // Python backend over binary IPC
+  pythonCall: (method, params, callId) => ipcRenderer.invoke('python-call', method, params, callId),
+  pythonCancel: (callId) => ipcRenderer.invoke('python-cancel', callId),
 }); 
\ No newline at end of file
@@ -0,0 +1,177 @@
+// Binary framed IPC with the Python backend (wsi-backend/ipc_server.py)
+//
+// Each frame is a 16 byte little-endian header (body length, request ID,
+// kind, metadata length) followed by JSON metadata and a binary payload.
+// Large replies are left in a shared memory segment that is read from
+// /dev/shm on Linux; elsewhere they come through the pipe.
+const { spawn } = require('child_process');
+const fs = require('fs');
+const path = require('path');
+
+const HEADER_SIZE = 16;
+const REQUEST = 1;
+const RESPONSE = 2;
+const ERROR = 3;
+const CANCEL = 4;
+const RELEASE = 5;
+
+const SHM_DIR = '/dev/shm';
+const SHARED_MEMORY = process.platform === 'linux' && fs.existsSync(SHM_DIR);
+
+const TYPED_ARRAYS = {
+  '|u1': Uint8Array,
+  '|i1': Int8Array,
+  '<u2': Uint16Array,
+  '<i2': Int16Array,
+  '<u4': Uint32Array,
+  '<i4': Int32Array,
+  '<f4': Float32Array,
+  '<f8': Float64Array,
+};
+// Largest element size above; typed array views must start at a multiple of their element size
+const MAX_ALIGNMENT = 8;
+
+class PythonIpc {
+  constructor(options = {}) {
+    const script = options.script || process.env.WSI_IPC_SERVER
+      || path.join(__dirname, '../../wsi-backend/ipc_server.py');
+    const python = options.python || process.env.WSI_PYTHON || (process.platform === 'win32' ? 'python' : 'python3');
+
+    this.child = spawn(python, [script, '--stdio'], {
+      cwd: path.dirname(script),
+      env: { ...process.env, ...options.env },
+      stdio: ['pipe', 'pipe', 'inherit'],
+    });
+    this.nextId = 1;
+    this.pending = new Map();
+    this.buffer = Buffer.alloc(0);
+    this.closed = false;
+
+    this.child.stdout.on('data', (chunk) => this.onData(chunk));
+    this.child.on('exit', (code) => this.onExit(code));
+    this.ready = this.call('hello', { version: 1, sharedMemory: SHARED_MEMORY });
+  }
+
+  // Send a request; resolves to { result, arrays } where arrays maps names to typed arrays.
+  // An AbortSignal in options.signal cancels the request on the Python side.
+  call(method, params = {}, options = {}) {
+    if (this.closed) {
+      return Promise.reject(new Error('Python backend is not running'));
+    }
+    const requestId = this.nextId++;
+    return new Promise((resolve, reject) => {
+      this.pending.set(requestId, { resolve, reject });
+      this.send(REQUEST, requestId, { method, params });
+      if (options.signal) {
+        if (options.signal.aborted) {
+          this.cancel(requestId);
+        } else {
+          options.signal.addEventListener('abort', () => this.cancel(requestId), { once: true });
+        }
+      }
+    });
+  }
+
+  cancel(requestId) {
+    if (this.pending.has(requestId)) {
+      this.send(CANCEL, requestId);
+    }
+  }
+
+  send(kind, requestId, meta = null) {
+    const metaBytes = meta ? Buffer.from(JSON.stringify(meta), 'utf8') : Buffer.alloc(0);
+    const header = Buffer.alloc(HEADER_SIZE);
+    header.writeUInt32LE(metaBytes.length, 0);
+    header.writeUInt32LE(requestId, 4);
+    header.writeUInt8(kind, 8);
+    header.writeUInt32LE(metaBytes.length, 12);
+    this.child.stdin.write(Buffer.concat([header, metaBytes]));
+  }
+
+  onData(chunk) {
+    this.buffer = this.buffer.length ? Buffer.concat([this.buffer, chunk]) : chunk;
+    while (this.buffer.length >= HEADER_SIZE) {
+      const bodyLength = this.buffer.readUInt32LE(0);
+      if (this.buffer.length < HEADER_SIZE + bodyLength) {
+        break;
+      }
+      const requestId = this.buffer.readUInt32LE(4);
+      const kind = this.buffer.readUInt8(8);
+      const metaLength = this.buffer.readUInt32LE(12);
+      const body = this.buffer.subarray(HEADER_SIZE, HEADER_SIZE + bodyLength);
+      this.buffer = this.buffer.subarray(HEADER_SIZE + bodyLength);
+      this.onFrame(kind, requestId, metaLength ? JSON.parse(body.subarray(0, metaLength).toString('utf8')) : {},
+        body.subarray(metaLength));
+    }
+  }
+
+  onFrame(kind, requestId, meta, payload) {
+    const pending = this.pending.get(requestId);
+    if (!pending) {
+      return;
+    }
+    this.pending.delete(requestId);
+    if (kind === ERROR) {
+      const error = new Error(meta.message);
+      error.code = meta.code;
+      pending.reject(error);
+      return;
+    }
+    const specs = meta.arrays || [];
+    let data = payload;
+    if (meta.shm) {
+      // Copy the arrays (not the whole power-of-two segment) out, then hand the segment back to the server
+      data = Buffer.from(new ArrayBuffer(payloadSize(specs)));
+      const fd = fs.openSync(path.join(SHM_DIR, meta.shm.name.replace(/^\//, '')), 'r');
+      try {
+        fs.readSync(fd, data, 0, data.length, 0);
+      } finally {
+        fs.closeSync(fd);
+      }
+      this.send(RELEASE, 0, { name: meta.shm.name });
+    } else if (data.byteOffset % MAX_ALIGNMENT !== 0) {
+      // Typed array views need their element size as alignment; payload offsets are only aligned
+      // relative to the payload, which can start anywhere in the read buffer
+      data = Buffer.from(new Uint8Array(data));
+    }
+    pending.resolve({ result: meta.result, arrays: unpackArrays(data, specs) });
+  }
+
+  onExit(code) {
+    this.closed = true;
+    for (const { reject } of this.pending.values()) {
+      reject(new Error(`Python backend exited with code ${code}`));
+    }
+    this.pending.clear();
+  }
+
+  close() {
+    if (!this.closed) {
+      this.child.stdin.end();
+    }
+  }
+}
+
+// Bytes of the payload covered by the arrays described by `specs`
+function payloadSize(specs) {
+  let size = 0;
+  for (const spec of specs) {
+    const TypedArray = TYPED_ARRAYS[spec.dtype];
+    const count = spec.shape.reduce((a, b) => a * b, 1);
+    size = Math.max(size, spec.offset + count * TypedArray.BYTES_PER_ELEMENT);
+  }
+  return size;
+}
+
+// Typed array views over `data`, which must start at a multiple of MAX_ALIGNMENT
+function unpackArrays(data, specs) {
+  const arrays = {};
+  for (const spec of specs) {
+    const TypedArray = TYPED_ARRAYS[spec.dtype];
+    const count = spec.shape.reduce((a, b) => a * b, 1);
+    arrays[spec.name] = { data: new TypedArray(data.buffer, data.byteOffset + spec.offset, count), shape: spec.shape };
+  }
+  return arrays;
+}
+
+module.exports = { PythonIpc };
@@ -2,6 +2,14 @@
 interface ElectronAPI {
   openFileDialog: () => Promise<string | null>;
   checkApi: (apiUrl: string) => Promise<boolean>;
+  pythonCall: (method: string, params?: Record<string, unknown>, callId?: string) => Promise<PythonReply>;
+  pythonCancel: (callId: string) => Promise<boolean>;
+}
+
+// Reply of a Python IPC call; arrays hold the binary payload (tile pixels, contour buffers)
+interface PythonReply {
+  result: any;
+  arrays: Record<string, { data: ArrayLike<number>; shape: number[] }>;
 }
 
 // Add to global Window interface
@@ -161,6 +161,34 @@ export const getSegmentationContours = async (slideName: string, bounds: any) =>
   return await api.get(`/slides/${slideName}/segmentation/contours?${params}`);
 };
 
+// Get only the contours entering a viewport, plus the labels that left it.
+// Pass the previous viewport and/or the labels already held by the client.
+export const getSegmentationContoursDelta = async (slideName: string, bounds: any, previous?: any, known?: number[]) => {
+  if (USE_MOCK_API) {
+    const response = await mockApi.getSegmentationContours(slideName, bounds);
+    return { ...response, data: { added: response.data, removed: [], count: response.data.length } };
+  }
+
+  return await api.post(`/slides/${slideName}/segmentation/contours/delta`, {
+    x: bounds.x,
+    y: bounds.y,
+    width: bounds.width,
+    height: bounds.height,
+    previous,
+    known,
+  });
+};
+
+// Count the instances inside drawn regions (level 0 polygons), with class histograms and area statistics
+export const getSegmentationAggregate = async (slideName: string, polygons: number[][][]) => {
+  if (USE_MOCK_API) {
+    console.warn('Mock API does not support polygon aggregates');
+    return { data: { results: polygons.map(() => ({ count: 0, classes: {}, area: null })), classes: [] } };
+  }
+
+  return await api.post(`/slides/${slideName}/segmentation/aggregate`, { polygons });
+};
+
 // Get segmentation results
 export const getSegmentationResults = async (slideName: string) => {
   if (USE_MOCK_API) {
@@ -190,6 +218,18 @@ export const getSegmentationH5 = (slideName: string) => {
   return `${API_URL}/segmentation/${slideName}/h5`;
 };
 
+// Get a cell-density overlay tile (same grid as getSlideTile); className is a class name or 'all'
+export const getDensityTile = (slideName: string, level: number, x: number, y: number, className = 'all') => {
+  if (USE_MOCK_API) {
+    console.warn('Mock API does not support density overlays');
+    return '';
+  }
+  const safeLevel = Math.max(0, Math.floor(level));
+  const safeX = Math.max(0, Math.floor(x));
+  const safeY = Math.max(0, Math.floor(y));
+  return `${API_URL}/slides/${encodeURIComponent(slideName)}/density/tile/${safeLevel}/${safeX}/${safeY}?class=${encodeURIComponent(className)}`;
+};
+
 // Attach all exported functions to the api object for default export
 api.checkHealth = checkHealth;
 api.uploadWSI = uploadWSI;